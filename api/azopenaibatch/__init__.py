@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import asyncio
+import logging
+import os
+import azure.functions as func
+from shared_lib import metrics
+from shared_lib.cache import RedisClientInst
+from shared_lib.cache.session import getSessionStore
+from shared_lib.compaction import CompactionJob, claimCompaction, saveTurn
+from shared_lib.db import AsyncPersistenceLayer, isOwnedBy, loadContextAsList
+from shared_lib.cache.redis import TokenQuota
+from shared_lib.handler import CompactionMode, CompactionQueue, CreateCORSResponseHeaders, Message, OpenaiHandler, Response
+from shared_lib.middlewares.throttle import QuotaMode, QuotaTokenReservation, QuotaTokens, authenticateRequest, claimQuote, unauthorizedResponse
+from shared_lib.tokens import preloadEncoding
+from shared_lib.tracing import stage, traced
+from shared_lib.types.errors import AuthError
+
+# Items of one batch request, and how many of them run upstream at once.
+BatchMaxItems = int(os.getenv('BATCH_MAX_ITEMS', '100'))
+BatchConcurrency = int(os.getenv('BATCH_CONCURRENCY', '8'))
+# Session writes of a batch within this many milliseconds share a transaction
+# per partition, see TABLE_WRITE_BATCH_MS.
+BatchWriteDelayMs = float(os.getenv('BATCH_WRITE_MS', '20'))
+
+db = AsyncPersistenceLayer(batchDelaySeconds=BatchWriteDelayMs / 1000)
+store = getSessionStore(db)
+preloadEncoding()
+
+
+# Chat turns of many sessions in one request:
+# {"items": [{"sessionId": ..., "pk": ..., "promo": ..., "context": [...]}, ...]}
+# Items without sessionId start a new session. In requests mode one unit per
+# item is charged in one Redis call, items past the quota left are answered
+# as exceeded. In tokens mode every item reserves QUOTA_TOKEN_RESERVATION
+# tokens before it runs and settles them with its usage once it is done;
+# once a reservation is refused the items left are answered as exceeded.
+# Items of one session run in order, at most BATCH_CONCURRENCY upstream calls
+# at once. The reply has the result of every item by its index, like a chat
+# reply in delta mode, and the counts of answered, failed and exceeded items.
+@traced
+async def main(req: func.HttpRequest, compactionQueue: func.Out[list[str]]) -> func.HttpResponse:
+    logging.info('Batch chat api triggered.')
+    try:
+        with stage('auth'):
+            user = await authenticateRequest(req)
+    except AuthError as ex:
+        return unauthorizedResponse(ex)
+
+    try:
+        items = req.get_json().get('items')
+        if type(items) is not list or len(items) == 0:
+            raise ValueError('items must be a non-empty list')
+    except ValueError:
+        return func.HttpResponse(f'Input is not valid', status_code=400, headers=CreateCORSResponseHeaders())
+    if len(items) > BatchMaxItems:
+        return func.HttpResponse(f'At most {BatchMaxItems} items per batch', status_code=413, headers=CreateCORSResponseHeaders())
+
+    results: list[dict | None] = [None] * len(items)
+    counts = {"ok": 0, "failed": 0, "exceeded": 0}
+    def publish(index: int, response: Response, outcome: str) -> None:
+        counts[outcome] += 1
+        results[index] = response.toDict()
+
+    turns = []
+    for index, item in enumerate(items):
+        try:
+            turns.append((index, parseItem(item)))
+        except ValueError as ex:
+            publish(index, errorResponse(f'Input is not valid: {ex}'), 'failed')
+
+    if QuotaMode != QuotaTokens:
+        with stage('quota'):
+            allowed = await claimQuote(user, len(turns))
+        for index, _ in turns[allowed:]:
+            publish(index, exceededResponse(user), 'exceeded')
+        turns = turns[:allowed]
+
+    # New sessions of a batch share a partition, their writes share transactions
+    newSessionPk = Message.generateSession()[0]
+    semaphore = asyncio.Semaphore(BatchConcurrency)
+    sessionLocks: dict[str, asyncio.Lock] = {}
+    compactionJobs: list[str] = []
+    refused = [False]
+
+    async def runTurn(index: int, item: dict) -> None:
+        sessionId = item['sessionId']
+        lock = sessionLocks.setdefault(sessionId, asyncio.Lock()) if sessionId else asyncio.Lock()
+        async with lock:
+            reservation = None
+            if QuotaMode == QuotaTokens:
+                reservation = await reserveItem(user, refused)
+                if reservation is None:
+                    publish(index, exceededResponse(user), 'exceeded')
+                    return
+            usedTokens = 0
+            try:
+                response, usedTokens = await chatTurn(user, item, newSessionPk, semaphore, compactionJobs)
+            except Exception as ex:
+                logging.warning(f'Batch item {index} failed: {ex}')
+                response = errorResponse(f'Error: {ex}')
+            finally:
+                if reservation is not None:
+                    await settleItem(user, usedTokens, reservation)
+            publish(index, response.toDelta(), 'ok' if response.code >= 0 else 'failed')
+
+    await asyncio.gather(*[runTurn(index, item) for index, item in turns])
+    metrics.incr('batch.items', len(items))
+
+    if compactionJobs:
+        compactionQueue.set(compactionJobs)
+
+    reply = Response()
+    reply.data = {"results": results, "counts": counts}
+    return func.HttpResponse(reply.toJson(compact=True), status_code=200, headers=CreateCORSResponseHeaders(), mimetype='application/json', charset='utf-8')
+
+def parseItem(item) -> dict:
+    if type(item) is not dict:
+        raise ValueError('item must be an object')
+    promo = item.get('promo')
+    if not promo or type(promo) is not str:
+        raise ValueError('promo must be a non-empty string')
+    return {
+        "sessionId": item.get('sessionId') or '',
+        "pk": item.get('pk') or '',
+        "promo": promo,
+        "context": loadContextAsList(item.get('context')),
+    }
+
+# Reserve the tokens of one item, None once a reservation of the batch was
+# refused: the items left must not take tokens freed by items that finish.
+async def reserveItem(user: str, refused: list[bool]) -> TokenQuota | None:
+    if refused[0]:
+        return None
+    with stage('quota'):
+        reservation = await RedisClientInst.ReserveUserTokens(userId=user, tokens=QuotaTokenReservation)
+    if not reservation:
+        refused[0] = True
+        return None
+    return reservation
+
+async def settleItem(user: str, tokens: int, reservation: TokenQuota) -> None:
+    with stage('quotaCharge'):
+        try:
+            await RedisClientInst.SettleUserTokens(userId=user, tokens=tokens, reservation=reservation)
+        except Exception as ex:
+            logging.error(f'Charge {tokens} tokens to user {user} failed: {ex}')
+
+# One turn, as azopenaitrigger runs it. Only the upstream call takes a slot of
+# the semaphore, session loads and saves of other items overlap with it.
+# Returns the reply and the tokens used upstream.
+async def chatTurn(user: str, item: dict, newSessionPk: str, semaphore: asyncio.Semaphore, compactionJobs: list[str]) -> tuple[Response, int]:
+    sessionId, pk, context = item['sessionId'], item['pk'], item['context']
+    sessionData = None
+    if sessionId:
+        with stage('sessionLoad'):
+            sessionData = await store.checkIfSessionExist(sessionId=sessionId, pk=pk)
+    if sessionId and (sessionData is None or not isOwnedBy(sessionData, user)):
+        return errorResponse(f'Session {sessionId} not found'), 0
+    if sessionData is not None:
+        context = sessionData['context'] + context
+        pk = sessionData['pk']
+    else:
+        sessionId, pk = '', newSessionPk
+
+    message = Message(pk, sessionId, context, item['promo'])
+    if sessionData is not None:
+        message.restoreStoreState(sessionData)
+    if not message.owner:
+        message.owner = user
+    handler = OpenaiHandler(message)
+    async with semaphore:
+        response = await handler.arunChatCompletion()
+    if response.code >= 0:
+        await saveTurn(store, handler)
+        if CompactionMode == CompactionQueue and message.needsCompaction() and await claimCompaction(message.sessionId):
+            compactionJobs.append(CompactionJob(message.pk, message.sessionId).toJson())
+    return response, handler.usedTokens
+
+def errorResponse(message: str) -> Response:
+    response = Response()
+    response.code = -1
+    response.message = message
+    response.data = None
+    return response
+
+def exceededResponse(user: str) -> Response:
+    return errorResponse(f'API quote for user {user} is exceeded.')
@@ -1,33 +1,37 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import asyncio
 import json
 import logging
 import os
-from shared_lib.middlewares.throttle import RedisThrottle
+from shared_lib.middlewares.throttle import RedisThrottle, currentUser, recordTokenUsage, waitForQuota
 from shared_lib.cache import RedisClientInst
 from shared_lib.cache.redis import QuoteState
+from shared_lib.cache.session import getSessionStore
+from shared_lib.coalesce import CoalescedReply, requestCoalescer
+from shared_lib.compaction import CompactionJob, claimCompaction, saveTurn
+from shared_lib.tokens import preloadEncoding
+from shared_lib.tracing import stage
+from shared_lib.types.errors import ContextTooLargeError
 from shared_lib.types.models import UserInfo
-from shared_lib.db import PersistenceLayer, loadContextAsList
-from shared_lib.handler import CreateCORSResponseHeaders, Message, OpenaiHandler, Response
-from azure.data.tables import TableServiceClient
+from shared_lib.db import AsyncPersistenceLayer, isOwnedBy, loadContextAsList
+from shared_lib.handler import CompactionMode, CompactionQueue, CreateCORSResponseHeaders, Message, OpenaiHandler, Response, ResponseMode, ResponseModeDelta
 
 import azure.functions as func
 
 app = func.FunctionApp()
 
-db = PersistenceLayer()
+db = AsyncPersistenceLayer()
+store = getSessionStore(db)
+preloadEncoding()
 
 @RedisThrottle
-def main(req: func.HttpRequest) -> func.HttpResponse:
+async def main(req: func.HttpRequest, compactionQueue: func.Out[str]) -> func.HttpResponse:
     logging.info('Python HTTP trigger function processed a request.')
 
     name = req.params.get('version')
-    
-    token = req.headers['Authorization'].lstrip("Bearer ")
-    logging.info('Receive auth token: ' + token)
-    logging.info(f'X-MS-CLIENT-PRINCIPAL-NAME is {req.headers.get("X-MS-CLIENT-PRINCIPAL-NAME", "N/A")}')
-    logging.info(f'X-MS-CLIENT-PRINCIPAL is {req.headers.get("X-MS-CLIENT-PRINCIPAL", "N/A")}')
+    logging.debug('X-MS-CLIENT-PRINCIPAL-NAME is %s', req.headers.get("X-MS-CLIENT-PRINCIPAL-NAME", "N/A"))
     
     if name:
         chatgpt_model_name = os.getenv("CHATGPT_MODEL")
@@ -36,42 +40,88 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
     
     try:
         req_body = req.get_json()
-        logging.info(f"reveived request body: {req_body}")
+        logging.debug('reveived request body: %s', req_body)
         pk = req_body.get('pk', '')
         sessionId = req_body.get('sessionId')
         context = loadContextAsList(req_body.get('context'))
         promo = req_body.get('promo')
-        
-        # check is session exist
-        if sessionId is not None and len(sessionId) > 0:
-            sessionData = db.checkIfSessionExist(sessionId=sessionId)
-            # session exist, merge it with user input
-            if sessionData is not None:
-                for c in context:
-                    sessionData.get('context', []).append(c)
-                context = sessionData.get('context')
-                pk = sessionData.get('pk')
-                
+        stream = bool(req_body.get('stream'))
+        delta = (req_body.get('responseMode') or ResponseMode) == ResponseModeDelta
     except ValueError:
         return func.HttpResponse(f'Input is not valid', status_code=400, headers=CreateCORSResponseHeaders())
-    
+    # The v1 host sends a response once its body is complete, server-sent
+    # events would only arrive with the whole answer.
+    if stream:
+        return func.HttpResponse(f'Streaming is not supported, send the request without stream', status_code=400, headers=CreateCORSResponseHeaders())
+
+    # check is session exist, while the quota check is still running
+    sessionData = None
+    if sessionId is not None and len(sessionId) > 0:
+        sessionData = await loadSession(sessionId, pk)
+
+    # Duplicates of a turn in flight, e.g. a double submit, wait for its reply
+    # instead of asking upstream again and racing its session save.
+    key = requestCoalescer.key(currentUser(), sessionId, sessionVersion(sessionData), req_body)
+    reply = await requestCoalescer.do(key, lambda: chatTurn(pk, sessionId, sessionData, context, promo, delta, compactionQueue))
+    return reply.toHttpResponse()
+
+# One turn of a chat: merge the input into the session, complete it upstream
+# and save it.
+async def chatTurn(pk: str, sessionId: str | None, sessionData: dict | None, context: list, promo: str, delta: bool, compactionQueue: func.Out[str]) -> CoalescedReply:
+    if sessionId is not None and len(sessionId) > 0:
+        # Unknown sessions, and those of other users, are not found, as in the
+        # sessions function. New sessions are started without sessionId.
+        if sessionData is None or not isOwnedBy(sessionData, currentUser()):
+            return CoalescedReply(f'Session {sessionId} not found', 404, CreateCORSResponseHeaders())
+        # session exist, merge it with user input
+        for c in context:
+            sessionData.get('context', []).append(c)
+        context = sessionData.get('context')
+        pk = sessionData.get('pk')
+
+    await waitForQuota()
     message = Message(pk, sessionId, context, promo) # type: ignore
+    if sessionData is not None:
+        message.restoreStoreState(sessionData)
+    # New sessions, and those of older versions, go to the history of the user
+    if not message.owner:
+        message.owner = currentUser()
     handler = OpenaiHandler(message)
-    
+
     try:
-        response = handler.runChatCompletion()
+        response = await handler.arunChatCompletion()
+        try:
+            if response.code >= 0:
+                await saveTurn(store, handler)
+        finally:
+            # Includes the summary calls of a compaction before the save
+            recordTokenUsage(handler.usedTokens)
         if response.code >= 0:
-            db.saveSession(message)
+            await enqueueCompactionIfNeed(message, compactionQueue)
+        if delta:
+            response = response.toDelta()
         headers = CreateCORSResponseHeaders()
-        headers['Content-Type'] = 'application/json'
-
-        return func.HttpResponse(
-            response.toJson(),
-            status_code=200,
-            headers=headers)
+        headers['Content-Type'] = 'application/json; charset=utf-8'
+        return CoalescedReply(response.toJson(compact=True), 200, headers)
+    except ContextTooLargeError as ex:
+        return CoalescedReply(f"Error: {ex}", 413, CreateCORSResponseHeaders())
     except Exception as ex:
-        return func.HttpResponse(
-             f"Error: {ex}",
-             status_code=500,
-             headers=CreateCORSResponseHeaders(),
-        )
+        return CoalescedReply(f"Error: {ex}", 500, CreateCORSResponseHeaders())
+
+# Changes with every save of the session, None for sessions that are not stored.
+def sessionVersion(sessionData: dict | None) -> str | None:
+    if sessionData is None:
+        return None
+    return f"{sessionData.get('cacheVersion', 0)}.{sessionData.get('etag') or ''}"
+
+async def loadSession(sessionId: str, pk: str) -> dict | None:
+    with stage('sessionLoad'):
+        return await store.checkIfSessionExist(sessionId=sessionId, pk=pk)
+
+async def enqueueCompactionIfNeed(message: Message, compactionQueue: func.Out[str]) -> None:
+    if CompactionMode != CompactionQueue:
+        return
+    with stage('compaction'):
+        if message.needsCompaction() and await claimCompaction(message.sessionId):
+            logging.info(f"Chat of session {message.sessionId} is too long, enqueue compaction")
+            compactionQueue.set(CompactionJob(message.pk, message.sessionId).toJson())
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Time and Table Storage round trips of many new chat sessions, sent as one
+# azopenaitrigger call per prompt (BATCH_CONCURRENCY calls at once) and as
+# azopenaibatch calls of BATCH_MAX_ITEMS prompts, against a local fake OpenAI
+# endpoint, the in-memory tables and fakeredis (pip install "fakeredis[lua]").
+# Run from the api folder: python -m benchmarks.batch_chat
+
+import asyncio
+import importlib
+import os
+import time
+from benchmarks.end_to_end import FakeOut, Password, connectRedis, httpRequest
+from benchmarks.fakes import AsyncInMemoryTableService, FakeOpenaiServer
+
+Prompts = 200
+OpenaiLatencySeconds = 0.05
+TableLatencySeconds = 0.005
+
+
+async def main() -> None:
+    server = FakeOpenaiServer(latencySeconds=OpenaiLatencySeconds)
+    url = await server.start()
+    # Read when the function modules are imported
+    os.environ.update({
+        'OPENAI_API_TYPE': 'azure',
+        'OPENAI_API_BASE': url,
+        'OPENAI_API_KEY': 'fake-key',
+        'OPENAI_API_VERSION': '2023-05-15',
+        'CHATGPT_MODEL': 'gpt-35-turbo',
+    })
+    os.environ.pop('OPENAI_ENDPOINTS', None)
+
+    from shared_lib import clients
+    from shared_lib.cache import RedisClientInst
+    asyncTableService = AsyncInMemoryTableService(latencySeconds=TableLatencySeconds)
+    clients.useClients(asyncTableService=asyncTableService, redisClient=await connectRedis(''))
+    userCreate = importlib.import_module('userCreate')
+    userLogin = importlib.import_module('userLogin')
+    trigger = importlib.import_module('azopenaitrigger')
+    batch = importlib.import_module('azopenaibatch')
+
+    email = 'bench-batch@example.com'
+    await userCreate.main(httpRequest('userCreate', {"Email": email, "Password": Password}))
+    await RedisClientInst.SetUserQuote(email, 10 ** 9)
+    token = (await userLogin.main(httpRequest('userLogin', {"Email": email, "Password": Password}))).get_body().decode()
+
+    async def singleCalls() -> None:
+        semaphore = asyncio.Semaphore(batch.BatchConcurrency)
+        async def one(i: int) -> None:
+            async with semaphore:
+                await trigger.main(httpRequest('azopenaitrigger', {"promo": f"prompt {i}"}, token), compactionQueue=FakeOut())
+        await asyncio.gather(*[one(i) for i in range(Prompts)])
+
+    async def batchCalls() -> None:
+        for start in range(0, Prompts, batch.BatchMaxItems):
+            items = [{"promo": f"prompt {i}"} for i in range(start, min(Prompts, start + batch.BatchMaxItems))]
+            response = await batch.main(httpRequest('azopenaibatch', {"items": items}, token), compactionQueue=FakeOut())
+            assert response.status_code == 200
+
+    print(f'prompts: {Prompts}, concurrency: {batch.BatchConcurrency}, batch size: {batch.BatchMaxItems}, '
+        f'openai latency: {OpenaiLatencySeconds * 1000:.0f}ms, table latency: {TableLatencySeconds * 1000:.0f}ms')
+    print(f"{'mode':>8} {'seconds':>8} {'prompts/s':>10} {'table calls':>12} {'upstream calls':>15}")
+    try:
+        for name, run in (('single', singleCalls), ('batch', batchCalls)):
+            tableCalls, upstreamCalls = asyncTableService.calls, server.calls
+            start = time.perf_counter()
+            await run()
+            elapsed = time.perf_counter() - start
+            print(f'{name:>8} {elapsed:>8.2f} {Prompts / elapsed:>10.1f} {asyncTableService.calls - tableCalls:>12} {server.calls - upstreamCalls:>15}')
+    finally:
+        await server.stop()
+        await clients.closeAsyncClients()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Import time of every function entry point in a fresh interpreter, as a cold
+# start of the Functions host pays it, and which of the deferred client
+# libraries the import loaded. The eager row of each function imports those
+# libraries first, as the modules did before they were deferred.
+# Run from the api folder: python -m benchmarks.cold_start
+
+import glob
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+Repeats = 5
+# Libraries the functions import on first use only
+DeferredModules = ['openai', 'aiohttp', 'requests', 'bcrypt', 'alipay']
+
+Probe = '''
+import importlib, json, sys, time
+eager = {eager}
+before = len(sys.modules)
+start = time.perf_counter()
+for name in eager:
+    try:
+        importlib.import_module(name)
+    except ImportError:
+        pass
+importlib.import_module({function!r})
+elapsed = time.perf_counter() - start
+print(json.dumps({{"ms": elapsed * 1000, "modules": len(sys.modules) - before,
+    "loaded": [name for name in {deferred!r} if name in sys.modules and name not in eager]}}))
+'''
+
+
+def entryPoints() -> list[str]:
+    return sorted(os.path.basename(os.path.dirname(path)) for path in glob.glob('*/function.json'))
+
+
+def measure(function: str, eager: bool) -> tuple[float, int, list[str]]:
+    code = Probe.format(function=function, eager=DeferredModules if eager else [], deferred=DeferredModules)
+    samples = []
+    for _ in range(Repeats):
+        output = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True).stdout
+        samples.append(json.loads(output.strip().splitlines()[-1]))
+    return statistics.median(sample['ms'] for sample in samples), samples[-1]['modules'], samples[-1]['loaded']
+
+
+def main() -> None:
+    print(f"{'function':>17} {'imports':>8} {'import (ms)':>12} {'modules':>8}  deferred libraries loaded")
+    for function in entryPoints():
+        for eager in (True, False):
+            ms, modules, loaded = measure(function, eager)
+            print(f"{function:>17} {'eager' if eager else 'lazy':>8} {ms:>12.1f} {modules:>8}  {', '.join(loaded) or '-'}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Prompt tokens per upstream call over chats of growing length against a local
+# fake OpenAI endpoint: without compaction, and compacting inline with the
+# running summary of shared_lib.summary (COMPACTION_KEEP_TURNS,
+# COMPACTION_SUMMARY_TOKEN_RATIO apply as set in the environment).
+# Run from the api folder: python -m benchmarks.compaction_window
+
+import asyncio
+import os
+import statistics
+from benchmarks.fakes import FakeOpenaiServer
+
+Turns = [20, 100, 400]
+Question = 'Can you explain how the retry policy of the storage client works when the service is throttling? '
+Answer = 'The client retries with exponential backoff and honours the Retry-After header of the service. ' * 4
+
+
+async def chat(turns: int, compact: bool) -> tuple[list[int], int, int]:
+    from shared_lib.handler import Message, OpenaiHandler
+    from shared_lib.tokens import countMessageTokens
+    message = Message('bench', f'bench-{turns}-{compact}', [])
+    handler = OpenaiHandler(message)
+    prompts = []
+    compactions = 0
+    for turn in range(turns):
+        message.promo = f'{turn}: {Question}'
+        # The prompt is the context and the new question
+        prompts.append(message.tokenTotal + countMessageTokens({"role": "user", "content": message.promo}))
+        await handler.acompletion()
+        if compact and message.needsCompaction():
+            await handler.acompactMsgContextWithSummary()
+            compactions += 1
+    return prompts, compactions, handler.usedTokens
+
+
+async def main() -> None:
+    server = FakeOpenaiServer(latencySeconds=0, answer=Answer)
+    url = await server.start()
+    # Read when the handler is imported
+    os.environ.update({
+        'OPENAI_API_TYPE': 'azure',
+        'OPENAI_API_BASE': url,
+        'OPENAI_API_KEY': 'fake-key',
+        'OPENAI_API_VERSION': '2023-05-15',
+        'CHATGPT_MODEL': 'gpt-35-turbo',
+    })
+    os.environ.pop('OPENAI_ENDPOINTS', None)
+    from shared_lib import clients
+    from shared_lib.tokens import getTokenBudget
+
+    print(f'token budget: {getTokenBudget()}')
+    print(f"{'turns':>6} {'compaction':>11} {'mean prompt':>12} {'max prompt':>11} {'compactions':>12} {'upstream calls':>15} {'used tokens':>12}")
+    try:
+        for turns in Turns:
+            for compact in (False, True):
+                calls = server.calls
+                prompts, compactions, usedTokens = await chat(turns, compact)
+                print(f"{turns:>6} {'rolling' if compact else 'none':>11} {statistics.fmean(prompts):>12.0f} {max(prompts):>11} {compactions:>12} {server.calls - calls:>15} {usedTokens:>12}")
+    finally:
+        await server.stop()
+        await clients.closeAsyncClients()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Stored size and encode/decode time of session contexts as text (json) and
+# in the compressed binary format (SESSION_CONTEXT_ENCODING=binary), for
+# generated chat transcripts of varied text.
+# Run from the api folder: python -m benchmarks.context_encoding
+
+import random
+import statistics
+import time
+from shared_lib.codec import ContextEncodingBinary, ContextEncodingJson, MaxContextChunks, MaxPropertyBytes, contextProperties, joinContextProperties
+from shared_lib.db import loadContextAsList
+from shared_lib.types.errors import ContextTooLargeError
+
+Turns = [10, 100, 500]
+Repeats = 20
+Seed = 7
+# Transcripts are made of varied prose, code and numbers, as real chats are;
+# repeated text would compress far better than stored sessions do.
+Words = (
+    'the a an to of and in for on with as by from at about into over after before between under '
+    'is are was were be been can could should would will may might must do does did have has had '
+    'I you we they it this that these those my your our their which what when where why how '
+    'file line list value key table row column query index cache request response error retry '
+    'timeout connection session user token model prompt answer summary context chat message '
+    'function method class module package import return loop condition branch test case result '
+    'read write open close save load parse format convert sort filter group count sum average '
+    'first last next previous small large fast slow new old simple better worse same different '
+    'data input output string number date time day week month year price cost budget plan trip '
+    'hotel flight train museum city river market dinner recipe flavor garlic onion butter oven '
+    'minutes hours people team project meeting deadline review draft email report chart slide '
+    'because however instead therefore although unless while since until also only just still '
+    'usually often sometimes never always probably exactly roughly quickly carefully'
+).split()
+Cjk = ['我想', '要一个', '例子', '请解释', '为什么', '这个', '函数', '返回', '错误', '谢谢', '今天', '天气',
+    '怎么', '安排', '行程', '预算', '大概', '多少', '时间', '比较好']
+Names = ['rows', 'items', 'userId', 'total', 'path', 'config', 'retries', 'buffer', 'result', 'index', 'payload', 'lines']
+
+
+def sentence(rng: random.Random) -> str:
+    words = [rng.choice(Words) for _ in range(rng.randint(6, 20))]
+    if rng.random() < 0.3:
+        words.insert(rng.randrange(len(words)), str(rng.randint(2, 5000)))
+    return ' '.join(words).capitalize() + rng.choice(['.', '.', '.', '?', '!'])
+
+def codeBlock(rng: random.Random) -> str:
+    a, b = rng.sample(Names, 2)
+    lines = [f'def {rng.choice(Words)}_{a}({a}, {b}={rng.randint(0, 100)}):']
+    for _ in range(rng.randint(2, 8)):
+        lines.append(f'    {rng.choice(Names)} = {rng.choice(Names)}.{rng.choice(Words)}({rng.choice(Names)}, {rng.randint(0, 999)})')
+    lines.append(f'    return {rng.choice(Names)}')
+    return '```python\n' + '\n'.join(lines) + '\n```'
+
+def question(rng: random.Random) -> str:
+    if rng.random() < 0.2:
+        return ''.join(rng.choice(Cjk) for _ in range(rng.randint(5, 20))) + '？'
+    return ' '.join(sentence(rng) for _ in range(rng.randint(1, 3)))
+
+def answer(rng: random.Random) -> str:
+    paragraphs = [' '.join(sentence(rng) for _ in range(rng.randint(2, 6))) for _ in range(rng.randint(1, 4))]
+    if rng.random() < 0.35:
+        paragraphs.insert(rng.randint(0, len(paragraphs)), codeBlock(rng))
+    if rng.random() < 0.25:
+        paragraphs.append('\n'.join(f'{i + 1}. {sentence(rng)}' for i in range(rng.randint(2, 5))))
+    return '\n\n'.join(paragraphs)
+
+def transcript(turns: int) -> list[dict]:
+    rng = random.Random(Seed + turns)
+    context = []
+    for _ in range(turns):
+        context.append({"role": "user", "content": question(rng)})
+        context.append({"role": "system", "content": answer(rng)})
+    return context
+
+
+def measure(call) -> float:
+    samples = []
+    for _ in range(Repeats):
+        start = time.perf_counter()
+        call()
+        samples.append((time.perf_counter() - start) * 1e6)
+    return statistics.median(samples)
+
+
+def storedBytes(properties: dict) -> int:
+    return sum(len(value.encode() if isinstance(value, str) else value) for key, value in properties.items() if key != 'contextChunks')
+
+
+def main() -> None:
+    print(f"{'turns':>6} {'encoding':>9} {'bytes':>9} {'chunks':>7} {'encode (us)':>12} {'decode (us)':>12}")
+    for turns in Turns:
+        context = transcript(turns)
+        for encoding in (ContextEncodingJson, ContextEncodingBinary):
+            try:
+                properties = contextProperties(context, encoding)
+            except ContextTooLargeError:
+                print(f'{turns:>6} {encoding:>9} {"too large for one session row":>50}')
+                continue
+            assert loadContextAsList(joinContextProperties(properties)) == context
+            encodeUs = measure(lambda: contextProperties(context, encoding))
+            decodeUs = measure(lambda: loadContextAsList(joinContextProperties(properties)))
+            print(f'{turns:>6} {encoding:>9} {storedBytes(properties):>9} {properties.get("contextChunks", 1):>7} {encodeUs:>12.1f} {decodeUs:>12.1f}')
+    print(f'binary contexts are capped at {MaxContextChunks * MaxPropertyBytes} bytes, json contexts at 64KiB of UTF-16')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Throughput and latency of the function entry points, run offline: userCreate,
+# userLogin, RedisThrottle around a no-op function, and azopenaitrigger, against
+# a local fake OpenAI endpoint, an in-memory Table service and fakeredis
+# (pip install "fakeredis[lua]") or a local Redis given with --redis-url.
+#
+# Every profile runs --concurrency virtual users at once. Each user signs up,
+# logs in and chats --sessions sessions of --turns turns. Besides the entry
+# points, the stages the function app times itself (shared_lib.tracing) are
+# reported, e.g. stage.upstream. Results are printed and saved as JSON, by
+# default to benchmarks/results/<commit>.json; pass an earlier result as
+# --baseline to compare.
+#
+# Run from the api folder, e.g.:
+#   python -m benchmarks.end_to_end --concurrency 1,16 --turns 2,20
+# Settings of the function app, e.g. QUOTA_MODE or SESSION_CACHE, apply as set
+# in the environment.
+
+import argparse
+import asyncio
+import datetime
+import importlib
+import json
+import os
+import statistics
+import subprocess
+import time
+import azure.functions as func
+from benchmarks.fakes import AsyncInMemoryTableService, FakeOpenaiServer
+
+Password = 'correct horse battery staple'
+
+
+class FakeOut:
+    def __init__(self) -> None:
+        self.value = None
+
+    def set(self, value) -> None:
+        self.value = value
+
+    def get(self):
+        return self.value
+
+
+class Stages:
+    def __init__(self) -> None:
+        self.samples: dict[str, list[float]] = {}
+        self.errors: dict[str, int] = {}
+        self.elapsed: dict[str, float] = {}
+
+    async def time(self, stage: str, call, isOk=lambda result: True):
+        start = time.perf_counter()
+        try:
+            result = await call()
+        except Exception:
+            result = None
+        self.samples.setdefault(stage, []).append((time.perf_counter() - start) * 1000)
+        if result is None or not isOk(result):
+            self.errors[stage] = self.errors.get(stage, 0) + 1
+        return result
+
+    def report(self) -> dict[str, dict]:
+        return {stage: summarize(samples, self.errors.get(stage, 0), self.elapsed.get(stage, 0)) for stage, samples in self.samples.items()}
+
+
+def summarize(samples: list[float], errors: int, elapsed: float) -> dict:
+    ordered = sorted(samples)
+    def percentile(p: float) -> float:
+        return round(ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))], 2)
+    return {
+        "count": len(samples),
+        "errors": errors,
+        "throughputPerSecond": round(len(samples) / elapsed, 1) if elapsed else None,
+        "meanMs": round(statistics.fmean(samples), 2),
+        "p50Ms": percentile(50),
+        "p95Ms": percentile(95),
+        "p99Ms": percentile(99),
+    }
+
+
+def httpRequest(path: str, body: dict | None = None, token: str = '', method: str = 'POST') -> func.HttpRequest:
+    headers = {'Content-Type': 'application/json'}
+    if token:
+        headers['Authorization'] = f'Bearer {token}'
+    return func.HttpRequest(method, f'http://localhost/api/{path}', headers=headers, params={},
+        body=json.dumps(body or {}).encode())
+
+
+def isChatOk(response: func.HttpResponse) -> bool:
+    if response.status_code != 200:
+        return False
+    body = response.get_body().decode()
+    return json.loads(body).get('code', -1) >= 0
+
+
+def sessionIdOf(response: func.HttpResponse) -> str | None:
+    body = response.get_body().decode()
+    return (json.loads(body).get('data') or {}).get('sessionId')
+
+
+async def runProfile(modules: dict, concurrency: int, sessions: int, turns: int, tag: str) -> tuple[dict, dict]:
+    from shared_lib import metrics
+    from shared_lib.cache import RedisClientInst
+    metrics.reset()
+    stages = Stages()
+    users = [f'bench-{tag}-{i}@example.com' for i in range(concurrency)]
+    tokens: dict[str, str] = {}
+
+    async def phase(stage: str, work) -> None:
+        start = time.perf_counter()
+        await asyncio.gather(*[work(i, email) for i, email in enumerate(users)])
+        stages.elapsed[stage] = time.perf_counter() - start
+
+    async def create(i: int, email: str) -> None:
+        await stages.time('userCreate', lambda: modules['userCreate'].main(httpRequest('userCreate', {"Email": email, "Password": Password})),
+            lambda response: response.status_code == 200)
+        # Enough quota for every turn in requests quota mode
+        await RedisClientInst.SetUserQuote(email, 10 ** 9)
+
+    async def login(i: int, email: str) -> None:
+        response = await stages.time('userLogin', lambda: modules['userLogin'].main(httpRequest('userLogin', {"Email": email, "Password": Password})),
+            lambda response: response.status_code == 200)
+        if response is not None:
+            tokens[email] = response.get_body().decode()
+
+    async def throttle(i: int, email: str) -> None:
+        for _ in range(sessions * turns):
+            await stages.time('throttle', lambda: modules['throttled'](httpRequest('noop', token=tokens.get(email, ''))),
+                lambda response: response.status_code == 200)
+
+    async def chat(i: int, email: str) -> None:
+        for session in range(sessions):
+            sessionId = None
+            for turn in range(turns):
+                body = {"promo": f"question {turn} of session {session} from user {i}"}
+                if sessionId:
+                    body["sessionId"] = sessionId
+                response = await stages.time('chat', lambda: modules['azopenaitrigger'].main(
+                    httpRequest('azopenaitrigger', body, tokens.get(email, '')), compactionQueue=FakeOut()), isChatOk)
+                if response is not None and isChatOk(response):
+                    sessionId = sessionIdOf(response)
+
+    await phase('userCreate', create)
+    await phase('userLogin', login)
+    await phase('throttle', throttle)
+    await phase('chat', chat)
+    return stages.report(), metrics.timings()
+
+
+def loadModules() -> dict:
+    from shared_lib.middlewares.throttle import RedisThrottle
+
+    async def noop(req: func.HttpRequest) -> func.HttpResponse:
+        return func.HttpResponse('ok')
+
+    return {
+        'userCreate': importlib.import_module('userCreate'),
+        'userLogin': importlib.import_module('userLogin'),
+        'azopenaitrigger': importlib.import_module('azopenaitrigger'),
+        'throttled': RedisThrottle(noop),
+    }
+
+
+async def connectRedis(url: str):
+    if url:
+        import redis.asyncio as redis
+        return redis.from_url(url, decode_responses=True)
+    try:
+        import fakeredis
+    except ImportError:
+        raise SystemExit('Install fakeredis with Lua support (pip install "fakeredis[lua]") or pass --redis-url')
+    return fakeredis.aioredis.FakeRedis(decode_responses=True)
+
+
+def currentCommit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return 'unknown'
+
+
+def profileKey(profile: dict) -> tuple:
+    return (profile['concurrency'], profile['sessions'], profile['turns'])
+
+
+def printResults(results: list[dict], baseline: dict | None) -> None:
+    previous = {}
+    for result in (baseline or {}).get('results', []):
+        previous[profileKey(result['profile'])] = result['stages']
+    print(f"{'profile':>22} {'stage':>10} {'count':>6} {'errors':>6} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}" + (f" {'p95 vs base':>12}" if baseline else ''))
+    for result in results:
+        profile = result['profile']
+        name = f"c{profile['concurrency']} s{profile['sessions']} t{profile['turns']}"
+        for stage, summary in result['stages'].items():
+            line = f"{name:>22} {stage:>10} {summary['count']:>6} {summary['errors']:>6} {summary['throughputPerSecond'] or 0:>8.1f} {summary['p50Ms']:>8.1f} {summary['p95Ms']:>8.1f} {summary['p99Ms']:>8.1f}"
+            before = previous.get(profileKey(profile), {}).get(stage)
+            if before and before['p95Ms']:
+                line += f" {(summary['p95Ms'] / before['p95Ms'] - 1) * 100:>+11.1f}%"
+            print(line)
+        for name, timing in sorted(result.get('timings', {}).items()):
+            print(f"{name:>33} {timing['samples']:>6} {'':>6} {'':>8} {timing['p50Ms']:>8.1f} {timing['p95Ms']:>8.1f} {timing['p99Ms']:>8.1f}")
+
+
+async def main(args: argparse.Namespace) -> None:
+    server = FakeOpenaiServer(latencySeconds=args.openai_latency_ms / 1000, failureRate=args.openai_failure_rate)
+    url = await server.start()
+    # Read when the function modules are imported
+    os.environ.update({
+        'OPENAI_API_TYPE': 'azure',
+        'OPENAI_API_BASE': url,
+        'OPENAI_API_KEY': 'fake-key',
+        'OPENAI_API_VERSION': '2023-05-15',
+        'CHATGPT_MODEL': 'gpt-35-turbo',
+    })
+    os.environ.pop('OPENAI_ENDPOINTS', None)
+
+    from shared_lib import clients
+    clients.useClients(
+        asyncTableService=AsyncInMemoryTableService(latencySeconds=args.table_latency_ms / 1000),
+        redisClient=await connectRedis(args.redis_url))
+    modules = loadModules()
+
+    results = []
+    try:
+        for concurrency in args.concurrency:
+            for turns in args.turns:
+                profile = {"concurrency": concurrency, "sessions": args.sessions, "turns": turns}
+                stages, timings = await runProfile(modules, concurrency, args.sessions, turns, f'{len(results)}-{time.time_ns()}')
+                results.append({"profile": profile, "stages": stages, "timings": timings})
+    finally:
+        await server.stop()
+        await clients.closeAsyncClients()
+
+    output = {
+        "commit": currentCommit(),
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "settings": {
+            "openaiLatencyMs": args.openai_latency_ms,
+            "openaiFailureRate": args.openai_failure_rate,
+            "tableLatencyMs": args.table_latency_ms,
+            "redis": 'local' if args.redis_url else 'fakeredis',
+            "env": {key: os.environ[key] for key in sorted(os.environ) if key.startswith(('QUOTA_', 'SESSION_', 'COMPLETION_', 'COALESCE_', 'BCRYPT_', 'TABLE_', 'RESPONSE_', 'UPSTREAM_'))},
+        },
+        "results": results,
+    }
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+    printResults(results, baseline)
+
+    path = args.output or os.path.join('benchmarks', 'results', f"{output['commit']}.json")
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'w') as file:
+        json.dump(output, file, indent=2)
+    print(f'Saved to {path}')
+
+
+def intList(value: str) -> list[int]:
+    return [int(item) for item in value.split(',') if item]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Offline end-to-end benchmark of the function entry points.')
+    parser.add_argument('--concurrency', type=intList, default=[1, 8, 32], help='virtual users at once, comma separated profiles')
+    parser.add_argument('--turns', type=intList, default=[2, 10], help='turns per session, comma separated profiles')
+    parser.add_argument('--sessions', type=int, default=2, help='sessions per user')
+    parser.add_argument('--openai-latency-ms', type=float, default=50, help='answer time of the fake OpenAI endpoint')
+    parser.add_argument('--openai-failure-rate', type=float, default=0, help='share of fake OpenAI calls that fail with 503')
+    parser.add_argument('--table-latency-ms', type=float, default=5, help='round trip of the in-memory Table service')
+    parser.add_argument('--redis-url', default='', help='local Redis to use instead of fakeredis, e.g. redis://localhost:6379')
+    parser.add_argument('--output', default='', help='result file, default benchmarks/results/<commit>.json')
+    parser.add_argument('--baseline', default='', help='earlier result file to compare p95 latency with')
+    asyncio.run(main(parser.parse_args()))
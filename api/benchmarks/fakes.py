@@ -0,0 +1,348 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# In-memory stand-ins for the storage services and local fake OpenAI
+# endpoints, so benchmarks run offline.
+
+import asyncio
+import base64
+import bisect
+import json
+import random
+import re
+import time
+import uuid
+from aiohttp import web
+from azure.core import MatchConditions
+from azure.core.exceptions import ResourceExistsError, ResourceModifiedError, ResourceNotFoundError
+from azure.data.tables import RequestTooLargeError, TableEntity, TableErrorCode, TableTransactionError, UpdateMode
+
+_FilterTerm = re.compile(r"\s*(\w+)\s+(eq|ne|gt|ge|lt|le)\s+('(?:[^']|'')*'|@\w+|[\w.-]+)\s*")
+_Operators = {
+    'eq': lambda a, b: a == b,
+    'ne': lambda a, b: a != b,
+    'gt': lambda a, b: a > b,
+    'ge': lambda a, b: a >= b,
+    'lt': lambda a, b: a < b,
+    'le': lambda a, b: a <= b,
+}
+
+# Request body limit of a transaction, its entities are sent as JSON with
+# binary values in base64.
+MaxTransactionBytes = 4 * 1024 * 1024
+
+_ErrorCodes = {
+    ResourceModifiedError: TableErrorCode.UPDATE_CONDITION_NOT_SATISFIED,
+    ResourceExistsError: TableErrorCode.ENTITY_ALREADY_EXISTS,
+    ResourceNotFoundError: TableErrorCode.RESOURCE_NOT_FOUND,
+}
+
+
+def _transactionBytes(operations: list) -> int:
+    def encode(value):
+        if isinstance(value, (bytes, bytearray)):
+            return base64.b64encode(value).decode()
+        return str(value)
+    return sum(len(json.dumps(op[1], default=encode)) for op in operations)
+
+
+def _parseFilter(queryFilter: str, parameters: dict | None) -> list:
+    terms = []
+    for part in re.split(r'\s+and\s+', queryFilter.strip()):
+        match = _FilterTerm.fullmatch(part)
+        if not match:
+            raise ValueError(f'Unsupported filter: {part}')
+        prop, op, raw = match.groups()
+        if raw.startswith("'"):
+            value = raw[1:-1].replace("''", "'")
+        elif raw.startswith('@'):
+            value = (parameters or {})[raw[1:]]
+        else:
+            value = int(raw) if raw.isdigit() else raw
+        terms.append((prop, _Operators[op], value))
+    return terms
+
+
+class InMemoryTableClient:
+    def __init__(self, tableName: str, table: 'InMemoryTable') -> None:
+        self.table_name = tableName
+        self.table = table
+        self.scannedEntities = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args) -> None:
+        return
+
+    def close(self) -> None:
+        return
+
+    @property
+    def rows(self) -> dict:
+        return self.table.rows
+
+    def _entity(self, stored: dict) -> TableEntity:
+        entity = TableEntity(stored['data'])
+        entity._metadata = {'etag': stored['etag'], 'timestamp': None}
+        return entity
+
+    def _store(self, entity: dict) -> None:
+        key = (entity['PartitionKey'], entity['RowKey'])
+        self.table.put(key, {'data': dict(entity), 'etag': str(uuid.uuid4())})
+
+    def _checkEtag(self, key, etag, matchCondition) -> None:
+        if matchCondition == MatchConditions.IfNotModified and self.rows[key]['etag'] != etag:
+            raise ResourceModifiedError('The update condition specified in the request was not satisfied.')
+
+    def get_entity(self, partition_key: str, row_key: str, **kwargs) -> TableEntity:
+        stored = self.rows.get((partition_key, row_key))
+        if stored is None:
+            raise ResourceNotFoundError('The specified resource does not exist.')
+        return self._entity(stored)
+
+    def query_entities(self, query_filter: str, parameters: dict | None = None, select=None, **kwargs):
+        terms = _parseFilter(query_filter, parameters)
+        partitionKey, low, high = None, None, None
+        for prop, op, value in terms:
+            if prop == 'PartitionKey' and op is _Operators['eq']:
+                partitionKey = value
+            elif prop == 'RowKey' and op in (_Operators['ge'], _Operators['gt']):
+                low = value
+            elif prop == 'RowKey' and op in (_Operators['lt'], _Operators['le']):
+                high = value
+        # Like Table Storage, a query with a PartitionKey only visits that
+        # partition, and RowKey bounds turn it into a range scan.
+        if partitionKey is not None:
+            candidates = self.table.scan(partitionKey, low, high)
+        else:
+            candidates = list(self.rows.values())
+        for stored in candidates:
+            self.scannedEntities += 1
+            data = stored['data']
+            if all(prop in data and op(data[prop], value) for prop, op, value in terms):
+                yield self._entity(stored)
+
+    def list_entities(self, **kwargs):
+        for stored in list(self.rows.values()):
+            yield self._entity(stored)
+
+    def create_entity(self, entity: dict, **kwargs) -> dict:
+        key = (entity['PartitionKey'], entity['RowKey'])
+        if key in self.rows:
+            raise ResourceExistsError('The specified entity already exists.')
+        self._store(entity)
+        return {'etag': self.rows[key]['etag']}
+
+    def upsert_entity(self, entity: dict, mode=UpdateMode.MERGE, **kwargs) -> dict:
+        key = (entity['PartitionKey'], entity['RowKey'])
+        if mode == UpdateMode.MERGE and key in self.rows:
+            entity = {**self.rows[key]['data'], **entity}
+        self._store(entity)
+        return {'etag': self.rows[key]['etag']}
+
+    def update_entity(self, entity: dict, mode=UpdateMode.MERGE, etag=None, match_condition=None, **kwargs) -> dict:
+        key = (entity['PartitionKey'], entity['RowKey'])
+        if key not in self.rows:
+            raise ResourceNotFoundError('The specified resource does not exist.')
+        self._checkEtag(key, etag, match_condition)
+        if mode == UpdateMode.MERGE:
+            entity = {**self.rows[key]['data'], **entity}
+        self._store(entity)
+        return {'etag': self.rows[key]['etag']}
+
+    def delete_entity(self, partition_key: str, row_key: str, etag=None, match_condition=None, **kwargs) -> None:
+        key = (partition_key, row_key)
+        if key not in self.rows:
+            return
+        self._checkEtag(key, etag, match_condition)
+        self.table.remove(key)
+
+    def submit_transaction(self, operations: list, **kwargs) -> list:
+        if len(operations) > 100 or len({op[1]['PartitionKey'] for op in operations}) > 1:
+            raise ValueError('A transaction holds at most 100 operations of one partition.')
+        if _transactionBytes(operations) > MaxTransactionBytes:
+            raise RequestTooLargeError(message='The request body is too large and exceeds the maximum permissible limit.')
+        partitionKey = operations[0][1]['PartitionKey']
+        snapshot = self.table.scan(partitionKey, None, None)
+        results = []
+        for index, operation in enumerate(operations):
+            action, entity = operation[0], operation[1]
+            options = operation[2] if len(operation) > 2 else {}
+            try:
+                if action == 'delete':
+                    self.delete_entity(entity['PartitionKey'], entity['RowKey'], **options)
+                    results.append({})
+                else:
+                    results.append(getattr(self, f'{action}_entity')(entity, **options))
+            except Exception as ex:
+                self.table.restorePartition(partitionKey, snapshot)
+                # Like the service, name the failed operation and its error code
+                error = TableTransactionError(message=f'{index}:{ex}')
+                error.error_code = _ErrorCodes.get(type(ex))
+                raise error
+        return results
+
+
+class InMemoryTable:
+    def __init__(self) -> None:
+        self.rows: dict[tuple[str, str], dict] = {}
+        # Sorted RowKeys of every partition
+        self.partitions: dict[str, list[str]] = {}
+
+    def put(self, key: tuple[str, str], stored: dict) -> None:
+        if key not in self.rows:
+            bisect.insort(self.partitions.setdefault(key[0], []), key[1])
+        self.rows[key] = stored
+
+    def remove(self, key: tuple[str, str]) -> None:
+        del self.rows[key]
+        rowKeys = self.partitions[key[0]]
+        del rowKeys[bisect.bisect_left(rowKeys, key[1])]
+
+    def scan(self, partitionKey: str, low: str | None, high: str | None) -> list[dict]:
+        rowKeys = self.partitions.get(partitionKey, [])
+        start = 0 if low is None else bisect.bisect_left(rowKeys, low)
+        end = len(rowKeys) if high is None else bisect.bisect_right(rowKeys, high)
+        return [self.rows[(partitionKey, rowKey)] for rowKey in rowKeys[start:end]]
+
+    def restorePartition(self, partitionKey: str, snapshot: list[dict]) -> None:
+        for rowKey in self.partitions.pop(partitionKey, []):
+            del self.rows[(partitionKey, rowKey)]
+        for stored in snapshot:
+            self.put((partitionKey, stored['data']['RowKey']), stored)
+
+
+class InMemoryTableService:
+    def __init__(self) -> None:
+        self.tables: dict[str, InMemoryTable] = {}
+
+    def get_table_client(self, table_name: str) -> InMemoryTableClient:
+        return InMemoryTableClient(table_name, self.tables.setdefault(table_name, InMemoryTable()))
+
+    def create_table_if_not_exists(self, table_name: str) -> InMemoryTableClient:
+        return self.get_table_client(table_name)
+
+
+# Async API of azure.data.tables.aio over the same in-memory tables. Every
+# call is counted on the service and takes its simulated round trip.
+class AsyncInMemoryTableClient:
+    def __init__(self, client: InMemoryTableClient, service: 'AsyncInMemoryTableService') -> None:
+        self.client = client
+        self.service = service
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args) -> None:
+        return
+
+    async def close(self) -> None:
+        return
+
+    def query_entities(self, *args, **kwargs):
+        return self._roundTrip(lambda: self.client.query_entities(*args, **kwargs))
+
+    def list_entities(self, *args, **kwargs):
+        return self._roundTrip(lambda: self.client.list_entities(*args, **kwargs))
+
+    async def _roundTrip(self, query):
+        self.service.calls += 1
+        if self.service.latencySeconds > 0:
+            await asyncio.sleep(self.service.latencySeconds)
+        for entity in query():
+            yield entity
+
+    def __getattr__(self, name: str):
+        method = getattr(self.client, name)
+
+        async def call(*args, **kwargs):
+            self.service.calls += 1
+            if self.service.latencySeconds > 0:
+                await asyncio.sleep(self.service.latencySeconds)
+            return method(*args, **kwargs)
+        return call
+
+
+class AsyncInMemoryTableService:
+    def __init__(self, service: InMemoryTableService | None = None, latencySeconds: float = 0) -> None:
+        self.service = service or InMemoryTableService()
+        self.latencySeconds = latencySeconds
+        self.calls = 0
+
+    def get_table_client(self, table_name: str) -> AsyncInMemoryTableClient:
+        return AsyncInMemoryTableClient(self.service.get_table_client(table_name), self)
+
+    async def create_table_if_not_exists(self, table_name: str) -> AsyncInMemoryTableClient:
+        return self.get_table_client(table_name)
+
+
+# Local HTTP endpoint answering chat completions like Azure OpenAI
+# (/openai/deployments/<name>/chat/completions) and OpenAI (/v1/chat/completions),
+# streamed or not. Every answer takes latencySeconds; a failureRate share of
+# the calls fails with failStatus, e.g. 429 with a Retry-After of retryAfter.
+class FakeOpenaiServer:
+    def __init__(self, latencySeconds: float = 0.05, failureRate: float = 0, failStatus: int = 503,
+            retryAfter: int | None = None, answer: str = 'Hello from the fake endpoint.') -> None:
+        self.latencySeconds = latencySeconds
+        self.failureRate = failureRate
+        self.failStatus = failStatus
+        self.retryAfter = retryAfter
+        self.answer = answer
+        self.calls = 0
+        self.failures = 0
+        self._runner: web.AppRunner | None = None
+        self.url = ''
+
+    async def start(self) -> str:
+        app = web.Application()
+        app.router.add_post('/openai/deployments/{deployment}/chat/completions', self._complete)
+        app.router.add_post('/v1/chat/completions', self._complete)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1] # type: ignore
+        self.url = f'http://127.0.0.1:{port}'
+        return self.url
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def _complete(self, request: web.Request) -> web.StreamResponse:
+        self.calls += 1
+        body = await request.json()
+        await asyncio.sleep(self.latencySeconds)
+        if random.random() < self.failureRate:
+            self.failures += 1
+            headers = {'Retry-After': str(self.retryAfter)} if self.retryAfter is not None else {}
+            return web.json_response({"error": {"message": f"fake failure {self.failStatus}", "type": "fake"}},
+                status=self.failStatus, headers=headers)
+
+        prompt = sum(len(item.get('content', '')) for item in body.get('messages', [])) // 4
+        completion = len(self.answer) // 4
+        created = int(time.time())
+        if not body.get('stream'):
+            return web.json_response({
+                "id": f"chatcmpl-{uuid.uuid4().hex}",
+                "object": "chat.completion",
+                "created": created,
+                "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": self.answer}}],
+                "usage": {"prompt_tokens": prompt, "completion_tokens": completion, "total_tokens": prompt + completion},
+            })
+
+        response = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+        await response.prepare(request)
+        for word in self.answer.split(' '):
+            chunk = {
+                "id": "chatcmpl-fake",
+                "object": "chat.completion.chunk",
+                "created": created,
+                "choices": [{"index": 0, "finish_reason": None, "delta": {"content": word + ' '}}],
+            }
+            await response.write(f'data: {json.dumps(chunk)}\n\n'.encode())
+        await response.write(b'data: [DONE]\n\n')
+        await response.write_eof()
+        return response
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Login throughput and event loop responsiveness, before and after password
+# checks hash once on the bcrypt thread pool.
+# Run from the api folder: python -m benchmarks.login_throughput
+# BCRYPT_ROUNDS and BCRYPT_WORKERS apply as in the function app.
+
+import asyncio
+import time
+import bcrypt
+from benchmarks.fakes import AsyncInMemoryTableService, InMemoryTableService
+from shared_lib import passwords
+from shared_lib.db import AsyncPersistenceLayer, UserTableName
+from shared_lib.types.models import UserInfo
+
+Users = 8
+Logins = 32
+Password = 'correct horse battery staple'
+
+
+def legacyCheckUserPassword(service: InMemoryTableService, inputUser: UserInfo) -> bool:
+    # Check as done before, with the synchronous table client: a throwaway
+    # entity with a fresh hash for its keys, then the hash that is compared.
+    tableClient = service.get_table_client(table_name=UserTableName)
+    inputUserEntity = inputUser.toTableEntity()
+    existingUser = tableClient.get_entity(partition_key=inputUserEntity['PartitionKey'], row_key=inputUserEntity['RowKey'])
+    return bcrypt.hashpw(inputUser.Password.encode(), existingUser['Salt']) == existingUser['HashedPassword']
+
+
+# Measure the longest delay of a 10ms ticker while logins run.
+async def runMeasured(logins) -> tuple[float, float]:
+    lag = 0.0
+    done = asyncio.Event()
+
+    async def ticker() -> None:
+        nonlocal lag
+        while not done.is_set():
+            start = time.perf_counter()
+            await asyncio.sleep(0.01)
+            lag = max(lag, time.perf_counter() - start - 0.01)
+
+    tick = asyncio.create_task(ticker())
+    start = time.perf_counter()
+    await logins()
+    elapsed = time.perf_counter() - start
+    done.set()
+    await tick
+    return Logins / elapsed, lag * 1000
+
+
+async def main() -> None:
+    service = InMemoryTableService()
+    asyncDb = AsyncPersistenceLayer(service=AsyncInMemoryTableService(service), batchDelaySeconds=0) # type: ignore
+    emails = [f'user{i}@example.com' for i in range(Users)]
+    for email in emails:
+        await asyncDb.saveUser(UserInfo(email, Password))
+
+    # The function was synchronous, every login ran on the worker's own thread.
+    async def legacy() -> None:
+        for i in range(Logins):
+            assert legacyCheckUserPassword(service, UserInfo(emails[i % Users], Password))
+            await asyncio.sleep(0)
+
+    async def pooled() -> None:
+        results = await asyncio.gather(*[asyncDb.checkUserPassword(UserInfo(emails[i % Users], Password)) for i in range(Logins)])
+        assert all(results)
+
+    print(f'bcrypt rounds: {passwords.BcryptRounds}, workers: {passwords.BcryptWorkers}, logins: {Logins}')
+    print(f"{'path':>8} {'logins/s':>10} {'max loop lag (ms)':>18}")
+    for name, logins in (('legacy', legacy), ('pooled', pooled)):
+        throughput, lag = await runMeasured(logins)
+        print(f'{name:>8} {throughput:>10.1f} {lag:>18.1f}')
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
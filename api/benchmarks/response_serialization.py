@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Payload size and serialization time of chat replies as sessions grow:
+# the pretty printed full reply as before, the compact full reply, and the
+# compact delta reply (RESPONSE_MODE=delta).
+# Run from the api folder: python -m benchmarks.response_serialization
+
+import statistics
+import time
+from shared_lib.handler import Message, Response
+
+Turns = [10, 100, 500]
+Repeats = 50
+Answer = 'Sure, here is a longer answer with some code and 中文 text. ' * 8
+
+
+def reply(turns: int) -> Response:
+    message = Message('20230801', Message.generateSessionId('20230801'), [])
+    for i in range(turns):
+        message.pushContext(role='user', content=f'question {i}: how do I do this?')
+        message.pushContext(role='assistant', content=Answer)
+    response = Response()
+    response.code = 0
+    response.message = Answer
+    response.data = message
+    return response
+
+
+def measure(serialize) -> tuple[int, float]:
+    samples = []
+    for _ in range(Repeats):
+        start = time.perf_counter()
+        body = serialize()
+        samples.append((time.perf_counter() - start) * 1e6)
+    return len(body.encode()), statistics.median(samples)
+
+
+def main() -> None:
+    print(f"{'turns':>6} {'mode':>13} {'bytes':>9} {'time (us)':>10}")
+    for turns in Turns:
+        response = reply(turns)
+        modes = (
+            ('full pretty', lambda: response.toJson()),
+            ('full compact', lambda: response.toJson(compact=True)),
+            ('delta', lambda: response.toDelta().toJson(compact=True)),
+        )
+        for name, serialize in modes:
+            size, elapsed = measure(serialize)
+            print(f'{turns:>6} {name:>13} {size:>9} {elapsed:>10.1f}')
+
+
+if __name__ == '__main__':
+    main()
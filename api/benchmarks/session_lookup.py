@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Session lookup latency as openaiSessionTable grows.
+# Run from the api folder: python -m benchmarks.session_lookup
+
+import asyncio
+import json
+import statistics
+import time
+import uuid
+from benchmarks.fakes import AsyncInMemoryTableService, InMemoryTableService
+from shared_lib.db import AsyncPersistenceLayer, TableName, sessionFromEntity
+from shared_lib.handler import Message
+
+TableSizes = [1000, 10000, 100000]
+Days = 365
+Lookups = 200
+
+
+# Legacy ids are returned with their pk, which clients send along with them.
+def populate(service: InMemoryTableService, size: int) -> tuple[list[str], list[str], dict[str, str]]:
+    newIds, legacyIds, legacyPks = [], [], {}
+    with service.get_table_client(table_name=TableName) as tableClient:
+        for i in range(size):
+            pk = f'2023{i % Days:04d}'
+            if i % 2:
+                sessionId = Message.generateSessionId(pk)
+                newIds.append(sessionId)
+            else:
+                sessionId = str(uuid.uuid4())
+                legacyIds.append(sessionId)
+                legacyPks[sessionId] = pk
+            tableClient.upsert_entity({
+                "PartitionKey": pk,
+                "RowKey": sessionId,
+                "context": json.dumps([{"role": "user", "content": "hello"}]),
+                "sessionId": sessionId,
+                "date": pk,
+            })
+    return newIds, legacyIds, legacyPks
+
+
+async def scanLookup(db: AsyncPersistenceLayer, sessionId: str) -> dict | None:
+    # Lookup as done before sessions could be resolved with point reads.
+    async with db.service.get_table_client(table_name=TableName) as tableClient:
+        async for entity in tableClient.query_entities(query_filter=f"RowKey eq '{sessionId}'"):
+            return sessionFromEntity(entity)
+    return None
+
+
+async def measure(lookup, ids: list[str], found: bool = True) -> float:
+    samples = []
+    for sessionId in ids[:Lookups]:
+        start = time.perf_counter()
+        assert (await lookup(sessionId) is not None) == found
+        samples.append((time.perf_counter() - start) * 1e6)
+    return statistics.median(samples)
+
+
+async def main() -> None:
+    print(f"{'rows':>8} {'new id (us)':>12} {'legacy id (us)':>15} {'missing id (us)':>16} {'scan (us)':>12}")
+    for size in TableSizes:
+        service = InMemoryTableService()
+        db = AsyncPersistenceLayer(service=AsyncInMemoryTableService(service)) # type: ignore
+        newIds, legacyIds, legacyPks = populate(service, size)
+        # Unknown ids are never scanned for
+        missingIds = [str(uuid.uuid4()) for _ in range(Lookups)]
+        newLatency = await measure(db.checkIfSessionExist, newIds)
+        legacyLatency = await measure(lambda sessionId: db.checkIfSessionExist(sessionId, legacyPks[sessionId]), legacyIds)
+        missingLatency = await measure(db.checkIfSessionExist, missingIds, found=False)
+        scanLatency = await measure(lambda sessionId: scanLookup(db, sessionId), legacyIds)
+        print(f'{size:>8} {newLatency:>12.1f} {legacyLatency:>15.1f} {missingLatency:>16.1f} {scanLatency:>12.1f}')
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
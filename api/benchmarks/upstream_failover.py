@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Success rate, latency and routing of chat completions against local fake
+# endpoints: a fast one, a slow one and one failing half of its calls, first
+# with only the failing endpoint and no retries as before the pool, then with
+# the pool of all three.
+# Run from the api folder: python -m benchmarks.upstream_failover
+
+import asyncio
+import statistics
+import time
+import openai
+from benchmarks.fakes import FakeOpenaiServer
+from shared_lib import clients, upstream
+from shared_lib.upstream import UpstreamEndpoint, UpstreamPool
+
+Requests = 300
+Concurrency = 20
+
+
+async def run(pool: UpstreamPool) -> tuple[float, float, float, dict[str, int]]:
+    semaphore = asyncio.Semaphore(Concurrency)
+    latencies: list[float] = []
+    routed: dict[str, int] = {}
+    succeeded = 0
+
+    async def complete(endpoint: UpstreamEndpoint):
+        routed[endpoint.name] = routed.get(endpoint.name, 0) + 1
+        return await openai.ChatCompletion.acreate(messages=[{"role": "user", "content": "hello"}], **endpoint.requestArgs())
+
+    async def one() -> None:
+        nonlocal succeeded
+        async with semaphore:
+            clients.useOpenaiSession()
+            start = time.perf_counter()
+            try:
+                await pool.call(complete)
+                succeeded += 1
+            except Exception:
+                pass
+            latencies.append((time.perf_counter() - start) * 1000)
+
+    await asyncio.gather(*[one() for _ in range(Requests)])
+    quantiles = statistics.quantiles(latencies, n=100)
+    return succeeded / Requests, quantiles[49], quantiles[94], routed
+
+
+async def main() -> None:
+    servers = {
+        'fast': FakeOpenaiServer(latencySeconds=0.02),
+        'slow': FakeOpenaiServer(latencySeconds=0.15),
+        'flaky': FakeOpenaiServer(latencySeconds=0.02, failureRate=0.5, failStatus=503),
+    }
+    endpoints = {}
+    for name, server in servers.items():
+        url = await server.start()
+        endpoints[name] = lambda name=name, url=url: UpstreamEndpoint(name, url, 'fake-key', 'gpt-35-turbo', 'azure', '2023-05-15')
+    upstream.UpstreamBackoffSeconds = 0.01
+    maxAttempts = upstream.UpstreamMaxAttempts
+
+    print(f'requests: {Requests}, concurrency: {Concurrency}')
+    print(f"{'setup':>16} {'success':>8} {'p50 (ms)':>9} {'p95 (ms)':>9}  routed calls")
+    scenarios = (
+        ('flaky, no retry', 1, lambda: UpstreamPool([endpoints['flaky']()])),
+        ('flaky, retries', maxAttempts, lambda: UpstreamPool([endpoints['flaky']()])),
+        ('pool of three', maxAttempts, lambda: UpstreamPool([create() for create in endpoints.values()])),
+    )
+    try:
+        for name, attempts, createPool in scenarios:
+            upstream.UpstreamMaxAttempts = attempts
+            success, p50, p95, routed = await run(createPool())
+            print(f'{name:>16} {success:>8.1%} {p50:>9.1f} {p95:>9.1f}  {routed}')
+    finally:
+        upstream.UpstreamMaxAttempts = maxAttempts
+        for server in servers.values():
+            await server.stop()
+        await clients.closeAsyncClients()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Storage calls and wall time of a burst of session saves of one day, with and
+# without TABLE_WRITE_BATCH_MS.
+# Run from the api folder: python -m benchmarks.write_batching
+
+import asyncio
+import time
+from azure.core.exceptions import HttpResponseError
+from benchmarks.fakes import AsyncInMemoryTableService
+from shared_lib.db import AsyncPersistenceLayer, isConditionNotSatisfied
+from shared_lib.handler import Message
+
+Sessions = 200
+# Simulated round trip of a table call
+LatencySeconds = 0.005
+BatchDelays = [0, 0.005, 0.02]
+# A failed write costs the other writes of its transaction a resubmit
+StaleEvery = [0, 50, 10]
+Pk = '20230801'
+
+
+# Save every session twice, the second time with every staleEvery-th save
+# stale: those writes must fail alone. Returns calls, wall time and conflicts
+# of the second round.
+async def burst(batchDelaySeconds: float, staleEvery: int) -> tuple[int, float, int]:
+    service = AsyncInMemoryTableService(latencySeconds=LatencySeconds)
+    db = AsyncPersistenceLayer(service=service, batchDelaySeconds=batchDelaySeconds) # type: ignore
+    messages = [Message(Pk, Message.generateSessionId(Pk), [{"role": "user", "content": f"hello {i}"}]) for i in range(Sessions)]
+    await asyncio.gather(*[db.saveSession(message) for message in messages])
+
+    for i, message in enumerate(messages):
+        message.context.append({"role": "assistant", "content": f"answer {i}"})
+        if staleEvery and i % staleEvery == 0:
+            message._etag = 'W/"stale"'
+    service.calls = 0
+    start = time.perf_counter()
+    results = await asyncio.gather(*[db.saveSession(message, rebaseOnConflict=False) for message in messages], return_exceptions=True)
+    elapsed = time.perf_counter() - start
+
+    conflicts = 0
+    for i, result in enumerate(results):
+        if isinstance(result, HttpResponseError) and isConditionNotSatisfied(result):
+            conflicts += 1
+            assert staleEvery and i % staleEvery == 0
+        else:
+            assert result is None and not (staleEvery and i % staleEvery == 0), result
+    return service.calls, elapsed * 1000, conflicts
+
+
+async def main() -> None:
+    print(f'sessions: {Sessions}, latency per call: {LatencySeconds * 1000:.0f}ms')
+    print(f"{'batch ms':>9} {'stale':>6} {'calls':>7} {'wall (ms)':>10} {'conflicts':>10}")
+    for delay in BatchDelays:
+        for staleEvery in StaleEvery:
+            calls, elapsed, conflicts = await burst(delay, staleEvery)
+            stale = f'1/{staleEvery}' if staleEvery else '0'
+            print(f'{delay * 1000:>9.0f} {stale:>6} {calls:>7} {elapsed:>10.1f} {conflicts:>10}')
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,23 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+
+import azure.functions as func
+from shared_lib.cache.session import getSessionStore
+from shared_lib.compaction import CompactionJob, compactSession, releaseCompaction
+from shared_lib.db import AsyncPersistenceLayer
+from shared_lib.tokens import preloadEncoding
+
+store = getSessionStore(AsyncPersistenceLayer())
+preloadEncoding()
+
+
+async def main(msg: func.QueueMessage) -> None:
+    logging.info('Session compaction worker triggered.')
+
+    job = CompactionJob.fromJson(msg.get_body())
+    try:
+        await compactSession(store, job)
+    finally:
+        await releaseCompaction(job.sessionId)
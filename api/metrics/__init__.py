@@ -0,0 +1,26 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+
+import azure.functions as func
+from shared_lib import clients, metrics
+from shared_lib.handler import CreateCORSResponseHeaders
+from shared_lib.upstream import upstreamPool
+
+
+# Counters and stage timings of the worker that serves the request, the health
+# of the shared clients and how the worker sees the upstream endpoints.
+async def main(req: func.HttpRequest) -> func.HttpResponse:
+    logging.info('Metrics api triggered.')
+
+    body = {
+        "metrics": metrics.snapshot(),
+        "timings": metrics.timings(),
+        "health": await clients.checkHealth(),
+        "upstream": upstreamPool.stats(),
+    }
+    headers = CreateCORSResponseHeaders()
+    headers['Content-Type'] = 'application/json'
+    return func.HttpResponse(json.dumps(body, sort_keys=True), status_code=200, headers=headers)
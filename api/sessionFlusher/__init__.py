@@ -0,0 +1,20 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+
+import azure.functions as func
+from shared_lib.cache.session import SessionCache, SessionCacheEnabled
+from shared_lib.db import AsyncPersistenceLayer
+
+cache = SessionCache(AsyncPersistenceLayer())
+
+
+# Write sessions to the table that their worker didn't flush in time, e.g.
+# because it was recycled. Nothing to do unless SESSION_CACHE is on.
+async def main(timer: func.TimerRequest) -> None:
+    if not SessionCacheEnabled:
+        return
+    flushed = await cache.flushOverdue()
+    if flushed > 0:
+        logging.info(f'Flushed {flushed} overdue sessions.')
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+
+import azure.functions as func
+from shared_lib.cache.session import getSessionStore
+from shared_lib.db import AsyncPersistenceLayer, MaxSessionPageSize
+from shared_lib.handler import CreateCORSResponseHeaders, Message, Response
+from shared_lib.middlewares.throttle import authenticateRequest, unauthorizedResponse
+from shared_lib.tracing import stage
+from shared_lib.types.errors import AuthError
+
+DefaultPageSize = 20
+
+db = AsyncPersistenceLayer()
+store = getSessionStore(db)
+
+
+# Sessions of the caller, newest first, a page at a time:
+# GET ?pageSize=20&continuationToken=<continuationToken of the previous page>.
+# Only their metadata is read from the owner index. GET ?sessionId=<id>
+# opens one of them with its context, as the chat trigger returns it.
+async def main(req: func.HttpRequest) -> func.HttpResponse:
+    logging.info('Session list api triggered.')
+
+    try:
+        with stage('auth'):
+            user = await authenticateRequest(req)
+    except AuthError as ex:
+        return unauthorizedResponse(ex)
+
+    sessionId = req.params.get('sessionId')
+    if sessionId:
+        return await openSession(user, sessionId, req.params.get('pk', ''))
+
+    try:
+        pageSize = min(MaxSessionPageSize, max(1, int(req.params.get('pageSize') or DefaultPageSize)))
+        with stage('sessionList'):
+            sessions, continuationToken = await db.listSessions(user, pageSize, req.params.get('continuationToken', ''))
+    except ValueError:
+        return func.HttpResponse(f'Input is not valid', status_code=400, headers=CreateCORSResponseHeaders())
+
+    response = Response()
+    response.code = 0
+    response.data = {"sessions": sessions, "continuationToken": continuationToken}
+    return jsonResponse(response)
+
+# Sessions of other users, and of older versions that have no owner, are not found.
+async def openSession(user: str, sessionId: str, pk: str) -> func.HttpResponse:
+    with stage('sessionLoad'):
+        sessionData = await store.checkIfSessionExist(sessionId=sessionId, pk=pk)
+    if sessionData is None or sessionData.get('owner') != user:
+        return func.HttpResponse(f'Session {sessionId} not found', status_code=404, headers=CreateCORSResponseHeaders())
+
+    response = Response()
+    response.code = 0
+    response.data = Message(sessionData['pk'], sessionId, sessionData['context'])
+    return jsonResponse(response)
+
+def jsonResponse(response: Response) -> func.HttpResponse:
+    headers = CreateCORSResponseHeaders()
+    headers['Content-Type'] = 'application/json; charset=utf-8'
+    return func.HttpResponse(response.toJson(compact=True), status_code=200, headers=headers)
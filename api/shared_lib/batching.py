@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import asyncio
+import json
+import logging
+import os
+from typing import Callable
+from azure.data.tables import RequestTooLargeError, TableTransactionError
+from azure.data.tables.aio import TableClient as AsyncTableClient
+
+# Writes to the same table and partition that arrive within this many
+# milliseconds share one transaction. 0 turns batching off.
+WriteBatchDelayMs = float(os.getenv('TABLE_WRITE_BATCH_MS', '0'))
+# Table Storage transactions hold at most 100 operations of one partition,
+# and 4MiB. Operations are sized by operationBytes, an estimate of their part
+# of the request body.
+MaxBatchOperations = 100
+MaxBatchBytes = 4 * 1024 * 1024
+# Part headers of an operation, and the name, quotes and type annotation of a property.
+OperationOverheadBytes = 1024
+PropertyOverheadBytes = 64
+
+# Size of an operation in a transaction: its entity as JSON, binary values in base64.
+def operationBytes(operation: tuple) -> int:
+    size = OperationOverheadBytes
+    for key, value in operation[1].items():
+        if isinstance(value, (bytes, bytearray)):
+            size += (len(value) + 2) // 3 * 4
+        else:
+            size += len(json.dumps(value, default=str))
+        size += len(key) + PropertyOverheadBytes
+    return size
+
+# Split operations into transactions within the limits above, in order.
+def splitTransactions(operations: list) -> list[list]:
+    transactions: list[list] = []
+    size = 0
+    for operation in operations:
+        operationSize = operationBytes(operation)
+        if not transactions or len(transactions[-1]) == MaxBatchOperations or size + operationSize > MaxBatchBytes:
+            transactions.append([])
+            size = 0
+        transactions[-1].append(operation)
+        size += operationSize
+    return transactions
+
+class _PendingWrite:
+    def __init__(self, operations: list, future: asyncio.Future) -> None:
+        self.operations = operations
+        self.future = future
+        self.rowKeys = {op[1]['RowKey'] for op in operations}
+        self.bytes = sum(operationBytes(op) for op in operations)
+
+class _Batch:
+    def __init__(self) -> None:
+        self.writes: list[_PendingWrite] = []
+        self.size = 0
+        self.bytes = 0
+        self.rowKeys: set[str] = set()
+        self.timer: asyncio.TimerHandle | None = None
+
+    def add(self, write: _PendingWrite) -> None:
+        self.writes.append(write)
+        self.size += len(write.operations)
+        self.bytes += write.bytes
+        self.rowKeys |= write.rowKeys
+
+# Groups writes of one table and partition into submit_transaction calls,
+# flushed when a batch is full or delaySeconds after its first write.
+# A write is a list of submit_transaction operations that commit together.
+# Every write gets its own result: the results of its operations, or the
+# error of the operation that failed. A failed write is dropped from the
+# transaction and the other writes of it are submitted again. An error of the
+# whole transaction fails all of its writes, except a request too large,
+# which is submitted again in halves.
+class TableWriteBatcher:
+    def __init__(self, getTableClient: Callable[[str], AsyncTableClient], delaySeconds: float = WriteBatchDelayMs / 1000) -> None:
+        self.getTableClient = getTableClient
+        self.delaySeconds = delaySeconds
+        self._batches: dict[tuple[str, str], _Batch] = {}
+
+    async def submit(self, tableName: str, operations: list) -> list:
+        write = _PendingWrite(operations, asyncio.get_running_loop().create_future())
+        if len(operations) > MaxBatchOperations or write.bytes > MaxBatchBytes:
+            return await self.getTableClient(tableName).submit_transaction(operations)
+
+        key = (tableName, operations[0][1]['PartitionKey'])
+        batch = self._batches.get(key)
+        # A transaction can't touch an entity twice
+        if batch is not None and (batch.size + len(operations) > MaxBatchOperations or batch.bytes + write.bytes > MaxBatchBytes
+                or batch.rowKeys & write.rowKeys):
+            self._flush(key)
+            batch = None
+        if batch is None:
+            batch = _Batch()
+            batch.timer = asyncio.get_running_loop().call_later(self.delaySeconds, self._flush, key)
+            self._batches[key] = batch
+        batch.add(write)
+        if batch.size == MaxBatchOperations:
+            self._flush(key)
+        return await write.future
+
+    def _flush(self, key: tuple[str, str]) -> None:
+        batch = self._batches.pop(key, None)
+        if batch is None:
+            return
+        if batch.timer is not None:
+            batch.timer.cancel()
+        asyncio.ensure_future(self._commit(key[0], batch.writes))
+
+    async def _commit(self, tableName: str, writes: list[_PendingWrite]) -> None:
+        tableClient = self.getTableClient(tableName)
+        while writes:
+            operations = [op for write in writes for op in write.operations]
+            try:
+                results = await tableClient.submit_transaction(operations)
+            except RequestTooLargeError as err:
+                # The estimate of operationBytes fell short
+                if len(writes) == 1:
+                    _failWrites(writes, err)
+                    return
+                half = len(writes) // 2
+                logging.info(f'Write batch of {tableName} is too large, resubmitting it in two')
+                await asyncio.gather(self._commit(tableName, writes[:half]), self._commit(tableName, writes[half:]))
+                return
+            except TableTransactionError as err:
+                index = failedOperationIndex(err)
+                if index is None:
+                    _failWrites(writes, err)
+                    return
+                failed = _writeOfOperation(writes, index)
+                if not failed.future.done():
+                    failed.future.set_exception(err)
+                writes = [write for write in writes if write is not failed]
+                if writes:
+                    logging.info(f'Write batch of {tableName} failed at operation {index}, resubmitting {len(writes)} writes')
+                continue
+            except Exception as err:
+                _failWrites(writes, err)
+                return
+
+            start = 0
+            for write in writes:
+                if not write.future.done():
+                    write.future.set_result(results[start:start + len(write.operations)])
+                start += len(write.operations)
+            return
+
+# Index of the operation a transaction error names, the service prefixes the
+# message with it. None for errors of the whole transaction, whose index
+# defaults to 0.
+def failedOperationIndex(err: TableTransactionError) -> int | None:
+    prefix = (getattr(err, 'message', None) or '').split(':', 1)[0]
+    return int(prefix) if prefix.isdigit() else None
+
+def _failWrites(writes: list[_PendingWrite], err: Exception) -> None:
+    for write in writes:
+        if not write.future.done():
+            write.future.set_exception(err)
+
+def _writeOfOperation(writes: list[_PendingWrite], index: int) -> _PendingWrite:
+    start = 0
+    for write in writes:
+        start += len(write.operations)
+        if index < start:
+            return write
+    return writes[-1]
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import hashlib
+import json
+import logging
+import os
+from shared_lib import metrics
+from shared_lib.cache import RedisClientInst
+from shared_lib.cache.local import LocalCache
+
+# Answers of identical chats are reused when COMPLETION_CACHE is set. Chats are
+# identical when model, messages and sampling parameters match after
+# normalization, see CompletionCache.key.
+CompletionCacheEnabled = os.getenv('COMPLETION_CACHE', '').lower() in ('1', 'true')
+CompletionCacheTtlSeconds = int(os.getenv('COMPLETION_CACHE_TTL_SECONDS', '3600'))
+# Entries kept in Redis, the oldest are evicted first.
+CompletionCacheMaxEntries = int(os.getenv('COMPLETION_CACHE_MAX_ENTRIES', '10000'))
+# Entries kept in process, in front of Redis.
+CompletionCacheLocalSize = int(os.getenv('COMPLETION_CACHE_LOCAL_SIZE', '1000'))
+CompletionCacheLocalTtlSeconds = 60
+# Longer answers are not cached.
+CompletionCacheMaxChars = int(os.getenv('COMPLETION_CACHE_MAX_CHARS', '32768'))
+# Request parameters that change the answer. Unset ones take the defaults of
+# the API and are left out of the key.
+SamplingParams = ('temperature', 'top_p', 'max_tokens', 'n')
+
+class CachedCompletion:
+    # tokens and latencyMs are what the upstream call cost, i.e. what a hit saves.
+    def __init__(self, content: str, tokens: int = 0, latencyMs: float = 0) -> None:
+        self.content = content
+        self.tokens = tokens
+        self.latencyMs = latencyMs
+
+    def toJson(self) -> str:
+        return json.dumps(self.__dict__, separators=(',', ':'))
+
+    @staticmethod
+    def fromJson(raw: str) -> 'CachedCompletion':
+        jsonDict = json.loads(raw)
+        return CachedCompletion(jsonDict['content'], jsonDict.get('tokens', 0), jsonDict.get('latencyMs', 0))
+
+# Two-level cache of answers: a LocalCache per worker, then Redis. The async
+# methods use both levels; the sync ones, used by the compaction worker, only
+# the local one. Hits and misses are counted in shared_lib.metrics.
+class CompletionCache:
+    def __init__(self, enabled: bool = CompletionCacheEnabled) -> None:
+        self.enabled = enabled
+        self.local = LocalCache(CompletionCacheLocalSize, CompletionCacheLocalTtlSeconds)
+
+    # Role and content of every message, with line endings and surrounding
+    # whitespace normalized, so resent chats hit even if a client reformats them,
+    # and the sampling parameters of params, the other arguments of the call.
+    # None while the cache is off, the other methods then do nothing.
+    def key(self, model: str, messages: list[dict[str, str]], params: dict | None = None) -> str | None:
+        if not self.enabled:
+            return None
+        normalized = [
+            [item.get('role', '').strip().lower(), item.get('content', '').replace('\r\n', '\n').strip()]
+            for item in messages]
+        sampling = {name: value for name, value in (params or {}).items() if name in SamplingParams and value is not None}
+        raw = json.dumps([model, normalized, sampling], ensure_ascii=False, sort_keys=True, separators=(',', ':'))
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    async def get(self, key: str | None) -> CachedCompletion | None:
+        if key is None:
+            return None
+        cached = self.local.get(key)
+        if cached is not None:
+            self._count(cached, 'local')
+            return cached
+        try:
+            raw = await RedisClientInst.GetCompletion(key)
+        except Exception as ex:
+            logging.warning(f'Completion cache read failed: {ex}')
+            raw = None
+        cached = CachedCompletion.fromJson(raw) if raw else None
+        if cached is not None:
+            self.local.put(key, cached)
+        self._count(cached, 'redis')
+        return cached
+
+    async def put(self, key: str | None, completion: CachedCompletion) -> None:
+        if key is None or len(completion.content) > CompletionCacheMaxChars:
+            return
+        self.local.put(key, completion)
+        try:
+            await RedisClientInst.SetCompletion(key, completion.toJson(), CompletionCacheTtlSeconds, CompletionCacheMaxEntries)
+        except Exception as ex:
+            logging.warning(f'Completion cache write failed: {ex}')
+
+    def _count(self, cached: CachedCompletion | None, level: str) -> None:
+        if cached is None:
+            metrics.incr('completionCache.misses')
+            return
+        metrics.incr('completionCache.hits')
+        metrics.incr(f'completionCache.hits.{level}')
+        metrics.incr('completionCache.savedTokens', cached.tokens)
+        metrics.incr('completionCache.savedLatencyMs', cached.latencyMs)
+
+completionCache = CompletionCache()
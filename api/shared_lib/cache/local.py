@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable
+
+# Bounded in-process LRU cache. Entries expire ttlSeconds after they are put,
+# so a value changed elsewhere, e.g. a revoked token, is seen at most
+# ttlSeconds late.
+class LocalCache:
+    def __init__(self, maxSize: int, ttlSeconds: float) -> None:
+        self.maxSize = maxSize
+        self.ttlSeconds = ttlSeconds
+        self._entries: OrderedDict[Any, tuple[float, Any]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Any) -> Any | None:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expiresAt, value = entry
+        if expiresAt <= time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def put(self, key: Any, value: Any) -> None:
+        if self.maxSize <= 0:
+            return
+        self._entries[key] = (time.monotonic() + self.ttlSeconds, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxSize:
+            self._entries.popitem(last=False)
+
+    def pop(self, key: Any) -> None:
+        self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+# Concurrent calls with the same key share one run of the coroutine, e.g. one
+# Redis or Table round trip for a burst of requests of the same user.
+class SingleFlight:
+    def __init__(self) -> None:
+        self._calls: dict[Any, asyncio.Future] = {}
+
+    def __len__(self) -> int:
+        return len(self._calls)
+
+    def __contains__(self, key: Any) -> bool:
+        return key in self._calls
+
+    async def do(self, key: Any, fn: Callable[[], Awaitable[Any]]) -> Any:
+        call = self._calls.get(key)
+        if call is None:
+            call = asyncio.ensure_future(fn())
+            self._calls[key] = call
+            call.add_done_callback(lambda done: self._forget(key, done))
+        # A cancelled caller must not cancel the call the others wait for.
+        return await asyncio.shield(call)
+
+    def _forget(self, key: Any, call: asyncio.Future) -> None:
+        if self._calls.get(key) is call:
+            del self._calls[key]
@@ -1,12 +1,25 @@
+import asyncio
+import hashlib
+import logging
 import os
-import redis
+import time
+import redis.asyncio as redis
+from redis.commands.core import AsyncScript
 from redis.commands.json.path import Path
 from datetime import datetime, timedelta
 
+from shared_lib import clients
+from shared_lib.cache.local import SingleFlight
 from shared_lib.types.models import BaseEnum
 
-redisHost = os.getenv('AZURE_REDIS_HOST', '')
-redisSecret = os.getenv('AZURE_REDIS_SECRET', '')
+# Quota units a worker claims from Redis at once and spends locally. 1 turns
+# leasing off, every request then decrements the quota in Redis.
+QuotaLeaseSize = int(os.getenv('QUOTA_LEASE_SIZE', '1'))
+# Units of a lease not spent within this many seconds go back to Redis.
+QuotaLeaseSeconds = float(os.getenv('QUOTA_LEASE_SECONDS', '30'))
+# One worker loads a missing quota from the user table, the others wait for it
+# this long before they load it themselves.
+QuotaInitLockSeconds = 10
 
 SetUserQuoteScript = '''local userid = ARGV[1]
 local userQuoteKey = string.format("users.quote.%s", userid)
@@ -23,6 +36,173 @@ redis.call("DECR", userQuoteKey)
 return "OK"
 '''
 
+# Claim up to ARGV[2] units, returns the number of units claimed.
+ClaimUserQuoteScript = '''local userid = ARGV[1]
+local userQuoteKey = string.format("users.quote.%s", userid)
+local leftQuoteVal = redis.call("GET", userQuoteKey)
+if not leftQuoteVal or leftQuoteVal == "" then
+    return "NOTEXIST"
+end
+local leftQuote = tonumber(leftQuoteVal)
+if leftQuote <= 0 then
+    return "EXCEEDED"
+end
+
+local claimed = math.min(leftQuote, tonumber(ARGV[2]))
+redis.call("DECRBY", userQuoteKey, claimed)
+return tostring(claimed)
+'''
+
+# Give back ARGV[2] unspent units, unless the quota expired meanwhile.
+ReturnUserQuoteScript = '''local userid = ARGV[1]
+local userQuoteKey = string.format("users.quote.%s", userid)
+if redis.call("EXISTS", userQuoteKey) == 1 then
+    redis.call("INCRBY", userQuoteKey, tonumber(ARGV[2]))
+end
+return "OK"
+'''
+
+# Token usage of a user in the current minute and day, windows start at full
+# minutes and days of the Redis clock. A limit of 0 or less leaves its window
+# unlimited.
+# ARGV: userid, cost, minute limit, day limit, reserve flag, minute start, day start.
+# Charges cost tokens to both windows, 0 only reads them. With the reserve
+# flag cost is only charged if every window has tokens left, so concurrent
+# requests can't all pass a check of an almost used up budget. A negative cost
+# refunds an unused reservation; the window starts name the windows it was
+# charged to, a refund to a window that ended is dropped.
+# Returns {allowed, remaining in minute, remaining in day, retry after seconds,
+# minute start, day start}. allowed is whether a reservation was taken, else
+# whether every window has tokens left; unlimited windows report -1 remaining.
+TokenQuotaScript = '''local userid = ARGV[1]
+local cost = tonumber(ARGV[2])
+local reserve = ARGV[5] == "1"
+local now = tonumber(redis.call("TIME")[1])
+local windows = {{"m", 60, tonumber(ARGV[3]), tonumber(ARGV[6])}, {"d", 86400, tonumber(ARGV[4]), tonumber(ARGV[7])}}
+local starts, keys, used = {}, {}, {}
+local open = 1
+for i, window in ipairs(windows) do
+    starts[i] = now - (now % window[2])
+    keys[i] = string.format("users.usage.%s.%s.%d", userid, window[1], starts[i])
+    used[i] = tonumber(redis.call("GET", keys[i]) or "0")
+    if window[3] > 0 and used[i] >= window[3] then
+        open = 0
+    end
+end
+if cost ~= 0 and (open == 1 or not reserve) then
+    for i, window in ipairs(windows) do
+        if cost > 0 or starts[i] == window[4] then
+            used[i] = redis.call("INCRBY", keys[i], cost)
+            if used[i] < 0 then
+                used[i] = 0
+                redis.call("SET", keys[i], 0)
+            end
+            redis.call("EXPIRE", keys[i], window[2])
+        end
+    end
+end
+local allowed = 1
+local retryAfter = 0
+local remaining = {}
+for i, window in ipairs(windows) do
+    if window[3] <= 0 then
+        remaining[i] = -1
+    else
+        remaining[i] = math.max(window[3] - used[i], 0)
+        if remaining[i] == 0 then
+            allowed = 0
+            retryAfter = math.max(retryAfter, starts[i] + window[2] - now)
+        end
+    end
+end
+if reserve then
+    allowed = open
+end
+return {allowed, remaining[1], remaining[2], retryAfter, starts[1], starts[2]}
+'''
+
+# Store answer ARGV[2] under key ARGV[1] for ARGV[3] seconds. An index sorted by
+# write time keeps at most ARGV[4] entries, the oldest are evicted.
+SetCompletionScript = '''local index = "completions.index"
+local now = tonumber(redis.call("TIME")[1])
+redis.call("SET", ARGV[1], ARGV[2], "EX", tonumber(ARGV[3]))
+redis.call("ZREMRANGEBYSCORE", index, "-inf", now - tonumber(ARGV[3]))
+redis.call("ZADD", index, now, ARGV[1])
+local excess = redis.call("ZCARD", index) - tonumber(ARGV[4])
+if excess > 0 then
+    local evicted = redis.call("ZRANGE", index, 0, excess - 1)
+    redis.call("ZREMRANGEBYRANK", index, 0, excess - 1)
+    redis.call("DEL", unpack(evicted))
+end
+return math.max(excess, 0)
+'''
+
+# Cached sessions are hashes "sessions.<sessionId>" with fields
+#   version:  bumped by every save, saves are conditional on it
+#   data:     JSON of pk, sessionId, context and tokenCounts
+#   store:    JSON of the table bookkeeping (turnStart, nextTurn, etag, listed) as of the last flush
+#   prefix:   how many leading context entries the table already holds
+#   rewrites: bumped by every save that rewrote the context, e.g. a compaction
+#   flushed:  last version written to the table
+# Sessions with unflushed saves are in the sorted set "sessions.dirty", scored
+# by the time of their first unflushed save. Dirty sessions never expire.
+SessionDirtyKey = 'sessions.dirty'
+
+# Put a session loaded from the table, unless it is cached already.
+# ARGV: key, data, store, prefix, ttl. Returns 1 if it was put.
+FillSessionScript = '''local key = ARGV[1]
+if redis.call("EXISTS", key) == 1 then
+    return 0
+end
+redis.call("HSET", key, "version", 1, "data", ARGV[2], "store", ARGV[3], "prefix", tonumber(ARGV[4]), "rewrites", 0, "flushed", 1)
+redis.call("EXPIRE", key, tonumber(ARGV[5]))
+return 1
+'''
+
+# Save a session if it is still at the expected version.
+# ARGV: key, expected version, data, rewrite flag, sessionId, now.
+# Returns the new version, -1 if the session changed meanwhile.
+SaveSessionScript = '''local key = ARGV[1]
+local version = tonumber(redis.call("HGET", key, "version") or "0")
+if version ~= tonumber(ARGV[2]) then
+    return -1
+end
+version = version + 1
+redis.call("HSET", key, "version", version, "data", ARGV[3])
+if ARGV[4] == "1" then
+    redis.call("HSET", key, "prefix", 0)
+    redis.call("HINCRBY", key, "rewrites", 1)
+end
+redis.call("PERSIST", key)
+redis.call("ZADD", "sessions.dirty", "NX", tonumber(ARGV[6]), ARGV[5])
+return version
+'''
+
+# Record that a version was written to the table. The context of that version
+# is the stored prefix, unless a save rewrote the context meanwhile.
+# ARGV: key, flushed version, rewrites when read, store, context length, ttl, sessionId.
+# Returns 1 if the session is clean now.
+SessionFlushedScript = '''local key = ARGV[1]
+if redis.call("EXISTS", key) == 0 then
+    redis.call("ZREM", "sessions.dirty", ARGV[7])
+    return 1
+end
+redis.call("HSET", key, "store", ARGV[4], "flushed", tonumber(ARGV[2]))
+if tonumber(redis.call("HGET", key, "rewrites") or "0") == tonumber(ARGV[3]) then
+    redis.call("HSET", key, "prefix", tonumber(ARGV[5]))
+end
+if tonumber(redis.call("HGET", key, "version")) == tonumber(ARGV[2]) then
+    redis.call("ZREM", "sessions.dirty", ARGV[7])
+    redis.call("EXPIRE", key, tonumber(ARGV[6]))
+    return 1
+end
+return 0
+'''
+
+# Token budgets of every user, see TokenQuotaScript
+QuotaTokensPerMinute = int(os.getenv('QUOTA_TOKENS_PER_MINUTE', '20000'))
+QuotaTokensPerDay = int(os.getenv('QUOTA_TOKENS_PER_DAY', '200000'))
+
 # Enum string of flags
 QUOTE_EXCEED = 'EXCEEDED'
 QUOTE_OK = 'OK'
@@ -34,25 +214,303 @@ class QuoteState(BaseEnum):
     NOTEXIST = 'NOTEXIST'
 
 
+# Quota units claimed by this worker for one user. timer gives the unspent
+# units back once the lease expires, also if the worker goes idle.
+class QuotaLease:
+    def __init__(self, units: int, expiresAt: float) -> None:
+        self.units = units
+        self.expiresAt = expiresAt
+        self.timer: asyncio.Future | None = None
+
+    def expired(self) -> bool:
+        return self.expiresAt <= time.monotonic()
+
+    def take(self) -> bool:
+        if self.units <= 0 or self.expired():
+            return False
+        self.units -= 1
+        return True
+
+
+# Result of TokenQuotaScript. -1 remaining means the window is unlimited.
+# reserved is the number of tokens a reservation took, windows the starts of
+# the windows they were charged to.
+class TokenQuota:
+    def __init__(self, allowed: bool, remainingMinute: int, remainingDay: int, retryAfter: int,
+            reserved: int = 0, windows: tuple[int, int] = (0, 0)) -> None:
+        self.allowed = allowed
+        self.remainingMinute = remainingMinute
+        self.remainingDay = remainingDay
+        self.retryAfter = retryAfter
+        self.reserved = reserved
+        self.windows = windows
+
+    def __bool__(self) -> bool:
+        return self.allowed
+
+
 class CacheManager:
-    def __init__(self) -> None:
-        self.client = redis.Redis(host=redisHost, port=6380, password=redisSecret, decode_responses=True, ssl=True)
+    # The pooled client of the registry is used unless a client is passed in.
+    def __init__(self, client: redis.Redis | None = None, leaseSize: int = QuotaLeaseSize) -> None:
+        self._client = client
+        self.leaseSize = leaseSize
+        self._leases: dict[str, QuotaLease] = {}
+        self._leaseFlight = SingleFlight()
+        self._scripts: dict[str, AsyncScript] = {}
+        self._scriptClient: redis.Redis | None = None
         return
+
+    @property
+    def client(self) -> redis.Redis:
+        return self._client or clients.getRedis()
     
     def _getUserQuoteKey(self, userId: str):
         return f'users.quote.{userId}'
+
+    def _getUserQuoteInitKey(self, userId: str):
+        return f'users.quote.init.{userId}'
+
+    # Scripts are sent once and then called by their SHA with EVALSHA. Scripts
+    # belong to a client, they are registered again when the client changes.
+    def _script(self, source: str) -> AsyncScript:
+        client = self.client
+        if client is not self._scriptClient:
+            self._scriptClient = client
+            self._scripts = {}
+        script = self._scripts.get(source)
+        if script is None:
+            script = client.register_script(source)
+            self._scripts[source] = script
+        return script
+
+    # Tokens are stored by their hash, a leaked key list doesn't leak tokens.
+    def _getUserTokenKey(self, token: str):
+        return f'users.token.{hashlib.sha256(token.encode()).hexdigest()}'
+
+    # Keys of the live tokens of a user, to revoke all of them at once.
+    def _getUserTokensKey(self, userId: str):
+        return f'users.tokens.{userId}'
     
-    def CheckUserQuote(self, userId: str) -> QuoteState:
-        res = self.client.eval(SetUserQuoteScript, 0, userId)
-        if type(res) is not str or res not in QuoteState:
-            raise ValueError("Redis SetUserQuote return invalid value: " + res)
-        
-        return QuoteState[res]
-    
+    async def CheckUserQuote(self, userId: str) -> QuoteState:
+        if self.leaseSize <= 1:
+            res = await self._script(SetUserQuoteScript)(args=[userId])
+            if type(res) is not str or res not in QuoteState:
+                raise ValueError("Redis SetUserQuote return invalid value: " + str(res))
+            return QuoteState[res]
+
+        # Spend from the local lease, a burst of one user renews it once.
+        while True:
+            lease = self._leases.get(userId)
+            if lease is not None and lease.take():
+                return QuoteState.OK
+            state = await self._leaseFlight.do(userId, lambda: self._renewLease(userId))
+            if state != QuoteState.OK:
+                return state
+
+    async def _renewLease(self, userId: str) -> QuoteState:
+        lease = self._leases.pop(userId, None)
+        if lease is not None:
+            await self._returnLease(userId, lease)
+        res = await self._script(ClaimUserQuoteScript)(args=[userId, self.leaseSize])
+        if res in QuoteState:
+            return QuoteState[res]
+        if type(res) is not str or not res.isdigit():
+            raise ValueError("Redis ClaimUserQuote return invalid value: " + str(res))
+        lease = QuotaLease(int(res), time.monotonic() + QuotaLeaseSeconds)
+        lease.timer = asyncio.ensure_future(self._expireLease(userId, lease))
+        self._leases[userId] = lease
+        return QuoteState.OK
+
+    async def _expireLease(self, userId: str, lease: QuotaLease) -> None:
+        try:
+            await asyncio.sleep(QuotaLeaseSeconds)
+            # A renewal may have replaced the lease meanwhile
+            if self._leases.get(userId) is lease:
+                del self._leases[userId]
+            lease.timer = None
+            await self._returnLease(userId, lease)
+        except Exception as ex:
+            logging.error(f'Return quota lease of user {userId} failed: {ex}')
+
+    # Give back the unspent units of a lease. They are taken from the lease
+    # first, so a request of this worker can't spend them meanwhile.
+    async def _returnLease(self, userId: str, lease: QuotaLease) -> None:
+        if lease.timer is not None:
+            lease.timer.cancel()
+            lease.timer = None
+        units, lease.units = lease.units, 0
+        if units > 0:
+            await self._script(ReturnUserQuoteScript)(args=[userId, units])
+
+    # Take units of quota in one call, e.g. one per item of a batch. Returns
+    # how many were taken, fewer than asked once the quota runs out, or
+    # QuoteState.NOTEXIST if the quota of the user is not loaded. Leases of
+    # this worker are left alone.
+    async def ClaimUserQuote(self, userId: str, units: int) -> int | QuoteState:
+        res = await self._script(ClaimUserQuoteScript)(args=[userId, units])
+        if res == QUOTE_EXCEED:
+            return 0
+        if res == QUOTE_NOT_EXIST:
+            return QuoteState.NOTEXIST
+        if type(res) is not str or not res.isdigit():
+            raise ValueError("Redis ClaimUserQuote return invalid value: " + str(res))
+        return int(res)
+
+    # Whether the user has tokens left in every window, without charging any.
+    async def CheckUserTokens(self, userId: str) -> TokenQuota:
+        return await self._tokenQuota(userId, 0)
+
+    # Charge an estimate of what a request will use before it runs, if the user
+    # has tokens left. Usage is only known after the upstream call, the
+    # reservation is then settled with SettleUserTokens.
+    async def ReserveUserTokens(self, userId: str, tokens: int) -> TokenQuota:
+        quota = await self._tokenQuota(userId, tokens, reserve=True)
+        if quota.allowed:
+            quota.reserved = tokens
+        return quota
+
+    # Charge what a request used beyond its reservation, or refund what it
+    # did not use.
+    async def SettleUserTokens(self, userId: str, tokens: int, reservation: TokenQuota) -> TokenQuota:
+        return await self._tokenQuota(userId, tokens - reservation.reserved, windows=reservation.windows)
+
+    async def ChargeUserTokens(self, userId: str, tokens: int) -> TokenQuota:
+        return await self._tokenQuota(userId, tokens)
+
+    async def _tokenQuota(self, userId: str, tokens: int, reserve: bool = False, windows: tuple[int, int] = (0, 0)) -> TokenQuota:
+        res = await self._script(TokenQuotaScript)(args=[userId, tokens, QuotaTokensPerMinute, QuotaTokensPerDay, int(reserve), *windows])
+        if not isinstance(res, list) or len(res) != 6:
+            raise ValueError("Redis TokenQuota return invalid value: " + str(res))
+        allowed, remainingMinute, remainingDay, retryAfter, minuteStart, dayStart = (int(value) for value in res)
+        return TokenQuota(allowed == 1, remainingMinute, remainingDay, retryAfter, windows=(minuteStart, dayStart))
+
+    def _getCompletionKey(self, key: str):
+        return f'completions.{key}'
+
+    async def GetCompletion(self, key: str) -> str | None:
+        return await self.client.get(self._getCompletionKey(key))
+
+    async def SetCompletion(self, key: str, value: str, ttlSeconds: int, maxEntries: int):
+        return await self._script(SetCompletionScript)(args=[self._getCompletionKey(key), value, ttlSeconds, maxEntries])
+
+    def _getRequestKey(self, key: str):
+        return f'requests.{key}'
+
+    # Claim a request for this worker, False if another worker runs it or
+    # ran it lately, see GetRequestReply.
+    async def ClaimRequest(self, key: str, ttlSeconds: int) -> bool:
+        return bool(await self.client.set(name=self._getRequestKey(key), value='', nx=True, ex=ttlSeconds))
+
+    # The reply of a claimed request: '' while it runs, None if it is not claimed.
+    async def GetRequestReply(self, key: str) -> str | None:
+        return await self.client.get(self._getRequestKey(key))
+
+    async def SetRequestReply(self, key: str, reply: str, ttlSeconds: int):
+        return await self.client.set(name=self._getRequestKey(key), value=reply, ex=ttlSeconds)
+
+    async def ReleaseRequest(self, key: str):
+        return await self.client.delete(self._getRequestKey(key))
+
+    def _getSessionKey(self, sessionId: str):
+        return f'sessions.{sessionId}'
+
+    def _getSessionFlushKey(self, sessionId: str):
+        return f'sessions.flush.{sessionId}'
+
+    def _getCompactionKey(self, sessionId: str):
+        return f'sessions.compaction.{sessionId}'
+
+    async def GetSessionVersion(self, sessionId: str) -> int:
+        return int(await self.client.hget(self._getSessionKey(sessionId), 'version') or 0)
+
+    # Return the fields of a cached session, None if it is not cached.
+    async def GetSession(self, sessionId: str) -> dict | None:
+        fields = ['version', 'data', 'store', 'prefix', 'rewrites']
+        values = await self.client.hmget(self._getSessionKey(sessionId), fields)
+        if values[0] is None:
+            return None
+        return dict(zip(fields, values))
+
+    async def FillSession(self, sessionId: str, data: str, store: str, prefix: int, ttlSeconds: int) -> bool:
+        return await self._script(FillSessionScript)(args=[self._getSessionKey(sessionId), data, store, prefix, ttlSeconds]) == 1
+
+    async def SaveSession(self, sessionId: str, expectedVersion: int, data: str, rewrite: bool) -> int:
+        return int(await self._script(SaveSessionScript)(args=[
+            self._getSessionKey(sessionId), expectedVersion, data, int(rewrite), sessionId, int(time.time())]))
+
+    async def MarkSessionFlushed(self, sessionId: str, version: int, rewrites: int, store: str, prefix: int, ttlSeconds: int) -> bool:
+        return await self._script(SessionFlushedScript)(args=[
+            self._getSessionKey(sessionId), version, rewrites, store, prefix, ttlSeconds, sessionId]) == 1
+
+    async def LockSessionFlush(self, sessionId: str, ttlSeconds: int) -> bool:
+        return bool(await self.client.set(name=self._getSessionFlushKey(sessionId), value=1, nx=True, ex=ttlSeconds))
+
+    async def UnlockSessionFlush(self, sessionId: str):
+        return await self.client.delete(self._getSessionFlushKey(sessionId))
+
+    # Mark a compaction of the session as queued, False if one already is.
+    async def LockCompactionPending(self, sessionId: str, ttlSeconds: int) -> bool:
+        return bool(await self.client.set(name=self._getCompactionKey(sessionId), value=1, nx=True, ex=ttlSeconds))
+
+    async def UnlockCompactionPending(self, sessionId: str):
+        return await self.client.delete(self._getCompactionKey(sessionId))
+
+    # Sessions whose first unflushed save is older than the given time.
+    async def GetDirtySessions(self, before: float, limit: int) -> list[str]:
+        return await self.client.zrangebyscore(SessionDirtyKey, '-inf', before, start=0, num=limit)
+
+    # Return the unspent units of every lease before they expire, see
+    # clients.closeAsyncClients.
+    async def ReleaseQuotaLeases(self):
+        leases, self._leases = self._leases, {}
+        for userId, lease in leases.items():
+            await self._returnLease(userId, lease)
+
+    # Return whether this worker should load the missing quota of a user.
+    async def LockUserQuoteInit(self, userId: str) -> bool:
+        return bool(await self.client.set(
+            name=self._getUserQuoteInitKey(userId=userId),
+            value=1,
+            nx=True,
+            ex=QuotaInitLockSeconds,
+            ))
+
+    async def UserQuoteExists(self, userId: str) -> bool:
+        return bool(await self.client.exists(self._getUserQuoteKey(userId=userId)))
+
     # Set user left quote. Let expire time to 1 day.
-    def SetUserQuote(self, userId: str, quote: int):
-        return self.client.set(
+    # With nx, a quota that is already set is kept.
+    async def SetUserQuote(self, userId: str, quote: int, nx: bool = False):
+        return await self.client.set(
             name=self._getUserQuoteKey(userId=userId),
             value=quote,
             ex=timedelta(days=1),
+            nx=nx,
             )
+
+    async def SetUserToken(self, token: str, userId: str, ttl: timedelta):
+        tokenKey = self._getUserTokenKey(token)
+        tokensKey = self._getUserTokensKey(userId)
+        async with self.client.pipeline(transaction=True) as pipe:
+            pipe.set(name=tokenKey, value=userId, ex=ttl)
+            pipe.sadd(tokensKey, tokenKey)
+            pipe.expire(tokensKey, ttl)
+            await pipe.execute()
+
+    # Return the user of a token, None if the token expired or was revoked.
+    async def GetTokenUser(self, token: str) -> str | None:
+        return await self.client.get(self._getUserTokenKey(token))
+
+    async def DeleteUserToken(self, token: str):
+        tokenKey = self._getUserTokenKey(token)
+        userId = await self.client.get(tokenKey)
+        async with self.client.pipeline(transaction=True) as pipe:
+            pipe.delete(tokenKey)
+            if userId is not None:
+                pipe.srem(self._getUserTokensKey(userId), tokenKey)
+            await pipe.execute()
+
+    async def DeleteUserTokens(self, userId: str):
+        tokensKey = self._getUserTokensKey(userId)
+        tokenKeys = await self.client.smembers(tokensKey)
+        await self.client.delete(tokensKey, *tokenKeys)
@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import asyncio
+import json
+import logging
+import os
+import time
+from azure.core.exceptions import HttpResponseError, ResourceModifiedError
+from shared_lib import metrics
+from shared_lib.cache import RedisClientInst
+from shared_lib.cache.local import LocalCache
+from shared_lib.codec import SessionStorageMode, SessionStorageTurns, contextProperties
+from shared_lib.db import AsyncPersistenceLayer, MaxSaveAttempts, isSaveConflict, rebaseMessage, stampSessionCreated
+from shared_lib.handler import Message
+
+# Sessions are read from and saved to Redis when SESSION_CACHE is set, and
+# written behind to Table Storage.
+SessionCacheEnabled = os.getenv('SESSION_CACHE', '').lower() in ('1', 'true')
+# Durability bound: a save reaches the table at most this many seconds later,
+# plus the interval of the sessionFlusher function if the worker is recycled
+# before. 0 writes through to the table on every save.
+SessionWriteBehindSeconds = float(os.getenv('SESSION_WRITE_BEHIND_SECONDS', '5'))
+# Clean sessions expire from Redis after this many seconds.
+SessionCacheTtlSeconds = int(os.getenv('SESSION_CACHE_TTL_SECONDS', '3600'))
+# Sessions kept per worker in front of Redis.
+SessionCacheLocalSize = int(os.getenv('SESSION_CACHE_LOCAL_SIZE', '1000'))
+SessionCacheLocalTtlSeconds = 300
+# One worker flushes a session at a time, for at most this long.
+SessionFlushLockSeconds = 30
+
+# Session store with the session methods of AsyncPersistenceLayer, and the same
+# semantics: saves are conditional on the version the message was loaded at
+# and rebase or raise on conflict.
+#
+# A cached session is validated against its version in Redis before use, so
+# the hot path of a turn is one small Redis read and one Redis write instead
+# of a table query and a table write. Every save marks the session dirty;
+# flush() writes it to the table, scheduled on this worker after
+# SESSION_WRITE_BEHIND_SECONDS and swept by flushOverdue() for sessions of
+# recycled workers.
+class SessionCache:
+    def __init__(self, db: AsyncPersistenceLayer) -> None:
+        self.db = db
+        # sessionId: (version, data)
+        self.local = LocalCache(SessionCacheLocalSize, SessionCacheLocalTtlSeconds)
+        self._scheduled: dict[str, asyncio.Task] = {}
+
+    async def checkIfSessionExist(self, sessionId: str, pk: str = '') -> dict | None:
+        sessionData = await self._getCached(sessionId)
+        if sessionData is None:
+            sessionData = await self._fill(sessionId, await self.db.checkIfSessionExist(sessionId=sessionId, pk=pk))
+        return sessionData
+
+    async def loadSession(self, pk: str, sessionId: str) -> dict | None:
+        sessionData = await self._getCached(sessionId)
+        if sessionData is None:
+            sessionData = await self._fill(sessionId, await self.db.loadSession(pk, sessionId))
+        return sessionData
+
+    async def saveSession(self, message: Message, rebaseOnConflict: bool = True) -> None:
+        stampSessionCreated(message)
+        # A session its row can't hold is refused before it is cached, its
+        # flushes would fail until it expired
+        if SessionStorageMode != SessionStorageTurns:
+            contextProperties(message.context)
+        for _ in range(MaxSaveAttempts):
+            data = {
+                "pk": message.pk,
+                "sessionId": message.sessionId,
+                "context": message.context,
+                "tokenCounts": message.contextTokenCounts(),
+                "owner": message.owner,
+                "created": message.created,
+                "listed": message.listed,
+            }
+            # A message that stored nothing of its context rewrites the session
+            version = await RedisClientInst.SaveSession(message.sessionId, message._cacheVersion, json.dumps(data), message._storedTurns == 0)
+            if version >= 0:
+                message._cacheVersion = version
+                message._storedTurns = len(message.context)
+                self.local.put(message.sessionId, (version, json.loads(json.dumps(data))))
+                break
+            if not rebaseOnConflict:
+                raise ResourceModifiedError(f'Session {message.sessionId} changed while saving')
+            logging.info(f'Session {message.sessionId} changed while saving, rebasing')
+            sessionData = await self._getCached(message.sessionId)
+            if sessionData is None:
+                raise ResourceModifiedError(f'Session {message.sessionId} was evicted while saving')
+            rebaseMessage(message, sessionData)
+        else:
+            raise ResourceModifiedError(f'Session {message.sessionId} kept changing while saving')
+
+        if SessionWriteBehindSeconds <= 0:
+            await self.flush(message.sessionId)
+        else:
+            self._scheduleFlush(message.sessionId)
+
+    # Write the cached session to the table, returns whether it was written.
+    async def flush(self, sessionId: str) -> bool:
+        if not await RedisClientInst.LockSessionFlush(sessionId, SessionFlushLockSeconds):
+            return False
+        try:
+            cached = await RedisClientInst.GetSession(sessionId)
+            if cached is None:
+                return False
+            data = json.loads(cached['data'])
+            store = json.loads(cached['store'] or '{}')
+            prefix = int(cached['prefix'] or 0)
+            tokenCounts = data.get('tokenCounts') or []
+
+            message = Message(data['pk'], sessionId, data['context'])
+            # Flushes stamp when the owner index was last written, saves keep the
+            # stamp the session was loaded with. The later one counts.
+            listed = max(data.get('listed') or '', store.get('listed') or '') or None
+            message.restoreStoreState({**store, "storedTurns": prefix, "tokenCounts": tokenCounts[:prefix],
+                "owner": data.get('owner'), "created": data.get('created'), "listed": listed})
+            try:
+                await self.db.saveSession(message, rebaseOnConflict=False)
+            except HttpResponseError as err:
+                if not isSaveConflict(message, err):
+                    raise
+                # The row changed outside of the cache, the cache wins.
+                logging.warning(f'Session {sessionId} changed in the table, rewriting it from the cache')
+                sessionData = await self.db.loadSession(data['pk'], sessionId) or {}
+                message.pk = sessionData.get('pk') or message.pk
+                message.restoreStoreState({**sessionData, "storedTurns": 0, "tokenCounts": []})
+                await self.db.saveSession(message, rebaseOnConflict=False)
+
+            store = {"turnStart": message._turnStart, "nextTurn": message._nextTurn, "etag": message._etag, "listed": message.listed}
+            await RedisClientInst.MarkSessionFlushed(sessionId, int(cached['version']), int(cached['rewrites'] or 0),
+                json.dumps(store), len(message.context), SessionCacheTtlSeconds)
+            metrics.incr('sessionCache.flushes')
+            return True
+        finally:
+            await RedisClientInst.UnlockSessionFlush(sessionId)
+
+    # Flush sessions that stayed dirty past the durability bound, e.g. because
+    # the worker that saved them was recycled. Returns how many were written.
+    async def flushOverdue(self, limit: int = 100) -> int:
+        flushed = 0
+        for sessionId in await RedisClientInst.GetDirtySessions(time.time() - SessionWriteBehindSeconds, limit):
+            try:
+                flushed += await self.flush(sessionId)
+            except Exception as ex:
+                logging.error(f'Flush session {sessionId} failed: {ex}')
+        return flushed
+
+    def _scheduleFlush(self, sessionId: str) -> None:
+        if sessionId not in self._scheduled:
+            self._scheduled[sessionId] = asyncio.ensure_future(self._flushLater(sessionId))
+
+    async def _flushLater(self, sessionId: str) -> None:
+        try:
+            await asyncio.sleep(SessionWriteBehindSeconds)
+            # Saves from now on schedule a new flush
+            del self._scheduled[sessionId]
+            await self.flush(sessionId)
+        except Exception as ex:
+            logging.error(f'Flush session {sessionId} failed: {ex}')
+
+    async def _getCached(self, sessionId: str) -> dict | None:
+        local = self.local.get(sessionId)
+        if local is not None and local[0] == await RedisClientInst.GetSessionVersion(sessionId):
+            metrics.incr('sessionCache.hits.local')
+            return sessionFromCache(sessionId, *local)
+
+        cached = await RedisClientInst.GetSession(sessionId)
+        if cached is None:
+            metrics.incr('sessionCache.misses')
+            return None
+        metrics.incr('sessionCache.hits.redis')
+        version = int(cached['version'])
+        data = json.loads(cached['data'])
+        self.local.put(sessionId, (version, data))
+        return sessionFromCache(sessionId, version, data)
+
+    # Cache a session loaded from the table, return it as cached.
+    async def _fill(self, sessionId: str, sessionData: dict | None) -> dict | None:
+        if sessionData is None:
+            return None
+        data = {
+            "pk": sessionData['pk'],
+            "sessionId": sessionId,
+            "context": sessionData['context'],
+            "tokenCounts": sessionData.get('tokenCounts') or [],
+            "owner": sessionData.get('owner'),
+            "created": sessionData.get('created'),
+            "listed": sessionData.get('listed'),
+        }
+        store = {key: sessionData[key] for key in ('turnStart', 'nextTurn', 'etag', 'listed') if sessionData.get(key) is not None}
+        await RedisClientInst.FillSession(sessionId, json.dumps(data), json.dumps(store), len(sessionData['context']), SessionCacheTtlSeconds)
+        return await self._getCached(sessionId)
+
+# Session as returned by AsyncPersistenceLayer, with copies callers may change.
+def sessionFromCache(sessionId: str, version: int, data: dict) -> dict:
+    context = [dict(item) for item in data.get('context', [])]
+    return {
+        "context": context,
+        "pk": data.get('pk'),
+        "sessionId": sessionId,
+        "storedTurns": len(context),
+        "tokenCounts": list(data.get('tokenCounts') or []),
+        "cacheVersion": version,
+        "owner": data.get('owner'),
+        "created": data.get('created'),
+        "listed": data.get('listed'),
+    }
+
+# The session store of the function app: the cache if it is on, else the table.
+def getSessionStore(db: AsyncPersistenceLayer) -> 'SessionCache | AsyncPersistenceLayer':
+    if SessionCacheEnabled:
+        return SessionCache(db)
+    return db
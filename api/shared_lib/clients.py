@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Process-wide registry of service clients. Every client is created on first
+# use and then shared, so steady-state requests reuse warm keep-alive
+# connections instead of paying client construction and TLS handshakes.
+# The client libraries are imported on first use as well: a cold start only
+# loads those of the clients its function asks for, e.g. userLogin never
+# loads openai.
+
+import asyncio
+import functools
+import logging
+import os
+from types import ModuleType
+from typing import TYPE_CHECKING, Awaitable, Callable
+import redis.asyncio as redis
+
+if TYPE_CHECKING:
+    import aiohttp
+    from azure.data.tables.aio import TableServiceClient as AsyncTableServiceClient
+
+connectionString = os.getenv('AzureDataStorage', '')
+redisHost = os.getenv('AZURE_REDIS_HOST', '')
+redisSecret = os.getenv('AZURE_REDIS_SECRET', '')
+
+# Connections kept open per service
+TablePoolSize = int(os.getenv('TABLE_POOL_SIZE', '20'))
+RedisMaxConnections = int(os.getenv('REDIS_MAX_CONNECTIONS', '50'))
+OpenaiPoolSize = int(os.getenv('OPENAI_POOL_SIZE', '20'))
+# Idle connections are closed after this many seconds
+KeepAliveSeconds = int(os.getenv('CLIENT_KEEPALIVE_SECONDS', '60'))
+# Redis connections idle for longer are checked with a PING before use
+RedisHealthCheckInterval = int(os.getenv('REDIS_HEALTH_CHECK_INTERVAL', '30'))
+
+_asyncTableService: 'AsyncTableServiceClient | None' = None
+_asyncTableSession: 'aiohttp.ClientSession | None' = None
+_asyncTableLoop: asyncio.AbstractEventLoop | None = None
+_redis: redis.Redis | None = None
+_redisLoop: asyncio.AbstractEventLoop | None = None
+_openaiSession: 'aiohttp.ClientSession | None' = None
+_openaiLoop: asyncio.AbstractEventLoop | None = None
+_openai: ModuleType | None = None
+# Clients set with useClients, in place of those of the configured services.
+_overrides: dict[str, object] = {}
+
+
+# Use the given clients instead of connecting to the configured services, e.g.
+# the local stand-ins of the benchmarks. Clients not given are created as usual.
+def useClients(asyncTableService=None, redisClient=None) -> None:
+    for name, client in (('asyncTable', asyncTableService), ('redis', redisClient)):
+        if client is not None:
+            _overrides[name] = client
+
+
+# aiohttp sessions belong to the event loop they were created on, a session of
+# a closed or foreign loop is replaced.
+def _isUsable(session: 'aiohttp.ClientSession | None', loop: asyncio.AbstractEventLoop | None) -> bool:
+    if session is None or session.closed or loop is None:
+        return False
+    return not loop.is_closed() and loop is asyncio.get_running_loop()
+
+
+# Close a replaced client on the loop it belongs to, if that loop still runs.
+# The connections of a closed loop go with the client.
+def _closeReplaced(close: Callable[[], Awaitable[None]], loop: asyncio.AbstractEventLoop | None) -> None:
+    if loop is None or loop.is_closed():
+        return
+    try:
+        if loop is asyncio.get_running_loop():
+            asyncio.ensure_future(close())
+        else:
+            asyncio.run_coroutine_threadsafe(close(), loop) # type: ignore
+    except Exception as ex:
+        logging.warning(f'Close replaced client failed: {ex}')
+
+
+async def _closeAioClients(*clients) -> None:
+    for client in clients:
+        if client is not None and not getattr(client, 'closed', False):
+            await client.close()
+
+
+def _newAioSession(poolSize: int) -> 'aiohttp.ClientSession':
+    import aiohttp
+    connector = aiohttp.TCPConnector(limit=poolSize, keepalive_timeout=KeepAliveSeconds)
+    return aiohttp.ClientSession(connector=connector)
+
+
+# Must be called from a coroutine.
+def getAsyncTableService() -> 'AsyncTableServiceClient':
+    global _asyncTableService, _asyncTableSession, _asyncTableLoop
+    if 'asyncTable' in _overrides:
+        return _overrides['asyncTable'] # type: ignore
+    if _asyncTableService is None or not _isUsable(_asyncTableSession, _asyncTableLoop):
+        from azure.core.pipeline.transport import AioHttpTransport
+        from azure.data.tables.aio import TableServiceClient as AsyncTableServiceClient
+        _closeReplaced(functools.partial(_closeAioClients, _asyncTableService, _asyncTableSession), _asyncTableLoop)
+        _asyncTableLoop = asyncio.get_running_loop()
+        _asyncTableSession = _newAioSession(TablePoolSize)
+        _asyncTableService = AsyncTableServiceClient.from_connection_string(
+            conn_str=connectionString,
+            transport=AioHttpTransport(session=_asyncTableSession, session_owner=False))
+    return _asyncTableService
+
+
+# Like aiohttp sessions, asyncio Redis connections belong to one event loop.
+# Must be called from a coroutine.
+def getRedis() -> redis.Redis:
+    global _redis, _redisLoop
+    if 'redis' in _overrides:
+        return _overrides['redis'] # type: ignore
+    loop = asyncio.get_running_loop()
+    if _redis is None or _redisLoop is not loop:
+        if _redis is not None:
+            _closeReplaced(functools.partial(_redis.close, close_connection_pool=True), _redisLoop)
+        _redisLoop = loop
+        pool = redis.BlockingConnectionPool(
+            connection_class=redis.SSLConnection,
+            host=redisHost,
+            port=6380,
+            password=redisSecret,
+            decode_responses=True,
+            max_connections=RedisMaxConnections,
+            health_check_interval=RedisHealthCheckInterval,
+            socket_keepalive=True)
+        _redis = redis.Redis(connection_pool=pool)
+    return _redis
+
+
+# The openai module, imported and set to the endpoint settings once per
+# process instead of per request.
+def getOpenai() -> ModuleType:
+    global _openai
+    if _openai is None:
+        import openai
+        # This is set to `azure`
+        # openai.api_type = "azure"
+        openai.api_type = os.getenv("OPENAI_API_TYPE")
+        # The API key for your Azure OpenAI resource.
+        openai.api_key = os.getenv("OPENAI_API_KEY")
+        # The base URL for your Azure OpenAI resource. e.g. "https://<your resource name>.openai.azure.com"
+        openai.api_base = os.getenv('OPENAI_API_BASE')
+        # Currently Chat Completion API have the following versions available: 2023-03-15-preview
+        openai.api_version = os.getenv('OPENAI_API_VERSION')
+        _openai = openai
+    return _openai
+
+
+# The openai package opens a new aiohttp session per async call unless one is
+# set in its aiosession context variable. Must be called from a coroutine,
+# before the upstream call of the current request.
+def useOpenaiSession() -> None:
+    global _openaiSession, _openaiLoop
+    if not _isUsable(_openaiSession, _openaiLoop):
+        _closeReplaced(functools.partial(_closeAioClients, _openaiSession), _openaiLoop)
+        _openaiLoop = asyncio.get_running_loop()
+        _openaiSession = _newAioSession(OpenaiPoolSize)
+    getOpenai().aiosession.set(_openaiSession)
+
+
+# Probe every shared client, returns the health of each as a flag.
+async def checkHealth() -> dict[str, bool]:
+    health = {}
+    try:
+        health['redis'] = bool(await getRedis().ping())
+    except Exception as ex:
+        logging.warning(f'Redis health check failed: {ex}')
+        health['redis'] = False
+    try:
+        async for _ in getAsyncTableService().list_tables(results_per_page=1):
+            break
+        health['table'] = True
+    except Exception as ex:
+        logging.warning(f'Table Storage health check failed: {ex}')
+        health['table'] = False
+    return health
+
+
+# Close the async clients, e.g. when a benchmark or script ends its event loop.
+# Quota leases of the worker go back to Redis first.
+async def closeAsyncClients() -> None:
+    global _asyncTableService, _asyncTableSession, _asyncTableLoop, _redis, _redisLoop, _openaiSession, _openaiLoop
+    from shared_lib.cache import RedisClientInst
+    if _redis is not None:
+        try:
+            await RedisClientInst.ReleaseQuotaLeases()
+        except Exception as ex:
+            logging.warning(f'Return quota leases failed: {ex}')
+    await _closeAioClients(_asyncTableService, _asyncTableSession, _openaiSession)
+    if _redis is not None:
+        await _redis.close(close_connection_pool=True)
+    _asyncTableService, _asyncTableSession, _asyncTableLoop = None, None, None
+    _redis, _redisLoop = None, None
+    _openaiSession, _openaiLoop = None, None
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+from typing import Awaitable, Callable
+import azure.functions as azfunc
+from shared_lib import metrics
+from shared_lib.cache import RedisClientInst
+from shared_lib.cache.local import SingleFlight
+
+# Identical chat requests of a user on the same version of a session, e.g. a
+# double submit, share one upstream call and one session save. "local" joins
+# duplicates that reach the same worker, "redis" also those of other workers,
+# which then wait for the reply of the first. "off" runs every request.
+CoalesceOff = 'off'
+CoalesceLocal = 'local'
+CoalesceRedis = 'redis'
+CoalesceMode = os.getenv('COALESCE_MODE', CoalesceLocal)
+# In redis mode a reply is kept this many seconds for duplicates that loaded
+# the session before it was saved but poll for the reply after.
+CoalesceReplySeconds = int(os.getenv('COALESCE_REPLY_SECONDS', '10'))
+# A worker that claimed a request and stopped is given up on after this long.
+CoalesceClaimSeconds = 180
+CoalescePollSeconds = 0.2
+
+# Reply of a chat request, shared by its duplicates. Each caller makes its own
+# HttpResponse of it, the throttle adds headers per request.
+class CoalescedReply:
+    def __init__(self, body: str, statusCode: int = 200, headers: dict[str, str] | None = None) -> None:
+        self.body = body
+        self.statusCode = statusCode
+        self.headers = headers or {}
+
+    def toJson(self) -> str:
+        return json.dumps(self.__dict__, ensure_ascii=False, separators=(',', ':'))
+
+    @staticmethod
+    def fromJson(raw: str) -> 'CoalescedReply':
+        jsonDict = json.loads(raw)
+        return CoalescedReply(jsonDict['body'], jsonDict.get('statusCode', 200), jsonDict.get('headers'))
+
+    def toHttpResponse(self) -> azfunc.HttpResponse:
+        return azfunc.HttpResponse(self.body, status_code=self.statusCode, headers=dict(self.headers))
+
+class RequestCoalescer:
+    def __init__(self, mode: str = CoalesceMode) -> None:
+        self.mode = mode
+        self.local = SingleFlight()
+
+    # Key of a chat request: the session and a hash of the user, the version of
+    # the session the request loaded and the request body. Once a turn is
+    # saved the version changes, the same question asked again, e.g.
+    # "continue", runs a new turn. None for requests without a stored session,
+    # there is no turn of theirs to join.
+    def key(self, user: str, sessionId: str | None, version: str | None, body: dict) -> str | None:
+        if self.mode == CoalesceOff or not sessionId or version is None:
+            return None
+        raw = json.dumps([user, version, body], ensure_ascii=False, sort_keys=True, separators=(',', ':'))
+        return f'{sessionId}.{hashlib.sha256(raw.encode()).hexdigest()}'
+
+    # Run fn once for all callers with the same key, they all get its reply.
+    async def do(self, key: str | None, fn: Callable[[], Awaitable[CoalescedReply]]) -> CoalescedReply:
+        if key is None:
+            return await fn()
+        if key in self.local:
+            metrics.incr('coalesce.joined.local')
+        return await self.local.do(key, lambda: self._acrossWorkers(key, fn))
+
+    async def _acrossWorkers(self, key: str, fn: Callable[[], Awaitable[CoalescedReply]]) -> CoalescedReply:
+        if self.mode != CoalesceRedis:
+            return await fn()
+        try:
+            while not await RedisClientInst.ClaimRequest(key, CoalesceClaimSeconds):
+                reply = await self._waitForReply(key)
+                if reply is not None:
+                    metrics.incr('coalesce.joined.redis')
+                    return reply
+                # The worker that claimed it gave up, claim it again
+        except Exception as ex:
+            logging.warning(f'Coalescing request {key} failed, running it: {ex}')
+            return await fn()
+
+        try:
+            reply = await fn()
+        except BaseException:
+            await self._release(key)
+            raise
+        # Only answers are shared, a duplicate of a failed request runs again
+        try:
+            if reply.statusCode < 400 and CoalesceReplySeconds > 0:
+                await RedisClientInst.SetRequestReply(key, reply.toJson(), CoalesceReplySeconds)
+            else:
+                await RedisClientInst.ReleaseRequest(key)
+        except Exception as ex:
+            logging.warning(f'Share reply of request {key} failed: {ex}')
+        return reply
+
+    # Poll the reply of a request another worker claimed, None once the claim is gone.
+    async def _waitForReply(self, key: str) -> CoalescedReply | None:
+        for _ in range(int(CoalesceClaimSeconds / CoalescePollSeconds)):
+            raw = await RedisClientInst.GetRequestReply(key)
+            if raw is None:
+                return None
+            if raw:
+                return CoalescedReply.fromJson(raw)
+            await asyncio.sleep(CoalescePollSeconds)
+        return None
+
+    async def _release(self, key: str) -> None:
+        try:
+            await RedisClientInst.ReleaseRequest(key)
+        except Exception as ex:
+            logging.warning(f'Release request {key} failed: {ex}')
+
+requestCoalescer = RequestCoalescer()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import zlib
+from shared_lib.types.errors import ContextTooLargeError
+
+# How chat contexts are written: "blob" rewrites the whole context into the
+# session row, "turns" appends one row per context entry. Both are readable.
+SessionStorageBlob = 'blob'
+SessionStorageTurns = 'turns'
+SessionStorageMode = os.getenv('SESSION_STORAGE_MODE', SessionStorageBlob)
+
+# How session rows store their context: "json" as text, "binary" in the
+# format below. Rows of either are read back alike, and every save writes the
+# whole row, so rows in the other format are migrated as sessions are saved.
+# Switch to binary once no worker of an older version is running.
+ContextEncodingJson = 'json'
+ContextEncodingBinary = 'binary'
+ContextEncoding = os.getenv('SESSION_CONTEXT_ENCODING', ContextEncodingJson)
+ContextCompressionLevel = int(os.getenv('SESSION_CONTEXT_COMPRESSION_LEVEL', '6'))
+
+# Binary format: magic, format version, codec, payload. JSON text never starts
+# with a NUL byte, so legacy text is told apart by the first byte.
+# Version 1 payload: the context as compact UTF-8 JSON, zlib compressed unless
+# that would make it larger.
+ContextMagic = b'\x00CX'
+ContextFormatVersion = 1
+CodecPlain = 0
+CodecZlib = 1
+# Table Storage binary properties hold at most 64KiB. Longer contexts are
+# split over context, context1, context2, ... and contextChunks is set.
+MaxPropertyBytes = 64000
+# Entities hold at most 1MiB, these chunks leave room for the other properties.
+MaxContextChunks = 15
+# String properties hold at most 64KiB of UTF-16, the limit of json contexts.
+MaxStringPropertyBytes = 65536
+
+# Characters of context JSON a session row holds at least, None if contexts are
+# not kept in one row. Compressed binary contexts hold more, depending on how
+# well they compress.
+def contextCapacityChars(encoding: str | None = None) -> int | None:
+    if SessionStorageMode == SessionStorageTurns:
+        return None
+    if (encoding or ContextEncoding) != ContextEncodingBinary:
+        return MaxStringPropertyBytes // 2
+    return MaxContextChunks * MaxPropertyBytes
+
+def encodeContext(context: list) -> bytes:
+    payload = json.dumps(context, ensure_ascii=False, separators=(',', ':')).encode()
+    compressed = zlib.compress(payload, ContextCompressionLevel)
+    if len(compressed) < len(payload):
+        return ContextMagic + bytes([ContextFormatVersion, CodecZlib]) + compressed
+    return ContextMagic + bytes([ContextFormatVersion, CodecPlain]) + payload
+
+def isEncodedContext(raw) -> bool:
+    return isinstance(raw, (bytes, bytearray)) and raw[:len(ContextMagic)] == ContextMagic
+
+def decodeContext(raw: bytes) -> list:
+    header = len(ContextMagic)
+    version, codec = raw[header], raw[header + 1]
+    if version != ContextFormatVersion:
+        raise ValueError(f'Unsupported context format version {version}')
+    payload = bytes(raw[header + 2:])
+    if codec == CodecZlib:
+        payload = zlib.decompress(payload)
+    elif codec != CodecPlain:
+        raise ValueError(f'Unsupported context codec {codec}')
+    return json.loads(payload)
+
+# Properties of a session row that store context. Raises ContextTooLargeError
+# if they don't fit in a row, such a session must be compacted first.
+def contextProperties(context: list, encoding: str | None = None) -> dict:
+    if (encoding or ContextEncoding) != ContextEncodingBinary:
+        text = json.dumps(context)
+        # json.dumps escapes non-ASCII characters, each takes two bytes of UTF-16
+        if len(text) * 2 > MaxStringPropertyBytes:
+            raise ContextTooLargeError(f'Session context of {len(context)} entries exceeds the {MaxStringPropertyBytes} bytes '
+                'of a json session row, compact the session or use SESSION_CONTEXT_ENCODING=binary')
+        return {"context": text}
+    raw = encodeContext(context)
+    if len(raw) <= MaxPropertyBytes:
+        return {"context": raw}
+    if len(raw) > MaxContextChunks * MaxPropertyBytes:
+        raise ContextTooLargeError(f'Session context of {len(context)} entries is {len(raw)} bytes encoded, '
+            f'more than the {MaxContextChunks * MaxPropertyBytes} bytes a session row holds, compact the session')
+    chunks = [raw[i:i + MaxPropertyBytes] for i in range(0, len(raw), MaxPropertyBytes)]
+    properties: dict = {"contextChunks": len(chunks)}
+    for i, chunk in enumerate(chunks):
+        properties[contextChunkName(i)] = chunk
+    return properties
+
+def contextChunkName(index: int) -> str:
+    return 'context' if index == 0 else f'context{index}'
+
+# The stored context of a session row, chunks joined, as loadContextAsList takes it.
+def joinContextProperties(entity) -> str | bytes | None:
+    chunks = entity.get('contextChunks')
+    if not chunks:
+        return entity.get('context')
+    return b''.join(bytes(entity.get(contextChunkName(i)) or b'') for i in range(int(chunks)))
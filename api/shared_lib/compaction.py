@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import asyncio
+import json
+import logging
+import os
+from azure.core.exceptions import HttpResponseError
+from shared_lib.cache import RedisClientInst
+from shared_lib.cache.session import SessionCache
+from shared_lib.db import AsyncPersistenceLayer, isSaveConflict
+from shared_lib.handler import Message, OpenaiHandler
+from shared_lib.tracing import stage
+from shared_lib.types.errors import ContextTooLargeError
+
+# Storage queue the chat trigger puts compaction jobs on, see compactionWorker/function.json
+CompactionQueueName = 'session-compaction'
+# While a compaction job of a session is queued no other is enqueued for it,
+# until the worker ran it or this many seconds passed, e.g. if it was lost.
+CompactionPendingSeconds = int(os.getenv('COMPACTION_PENDING_SECONDS', '300'))
+
+class CompactionJob:
+    def __init__(self, pk: str, sessionId: str) -> None:
+        self.pk = pk
+        self.sessionId = sessionId
+
+    def toJson(self) -> str:
+        return json.dumps({"pk": self.pk, "sessionId": self.sessionId})
+
+    @staticmethod
+    def fromJson(raw: str | bytes) -> 'CompactionJob':
+        jsonDict = json.loads(raw)
+        return CompactionJob(jsonDict['pk'], jsonDict['sessionId'])
+
+# Return whether a compaction job of the session should be enqueued, False
+# while one is pending. Without Redis the job is enqueued: compacting a
+# session twice costs a summary call, the second save is a conflict or a no-op.
+async def claimCompaction(sessionId: str) -> bool:
+    try:
+        return await RedisClientInst.LockCompactionPending(sessionId, CompactionPendingSeconds)
+    except Exception as ex:
+        logging.warning(f'Claim compaction of session {sessionId} failed: {ex}')
+        return True
+
+async def releaseCompaction(sessionId: str) -> None:
+    try:
+        await RedisClientInst.UnlockCompactionPending(sessionId)
+    except Exception as ex:
+        logging.warning(f'Release compaction of session {sessionId} failed: {ex}')
+
+# Summarize a saved session if it is still too long. The summary is only
+# written if no turn was saved since the session was loaded; if one was, the
+# job is dropped and the next turn of the session enqueues a new one.
+# Returns whether the session was compacted.
+# store is the session store of the chat trigger, so compaction sees and
+# writes cached sessions, see getSessionStore.
+async def compactSession(store: AsyncPersistenceLayer | SessionCache, job: CompactionJob) -> bool:
+    sessionData = await store.loadSession(job.pk, job.sessionId)
+    if sessionData is None:
+        logging.warning(f'Compaction of session {job.sessionId} skipped, session not found')
+        return False
+
+    message = Message(sessionData['pk'], sessionData['sessionId'], sessionData['context'])
+    message.restoreStoreState(sessionData)
+    if not message.needsCompaction():
+        return False
+
+    await OpenaiHandler(message).acompactMsgContextWithSummary()
+    try:
+        await store.saveSession(message, rebaseOnConflict=False)
+    except HttpResponseError as err:
+        if not isSaveConflict(message, err):
+            raise
+        logging.info(f'Compaction of session {job.sessionId} dropped, a newer turn was saved')
+        return False
+    logging.info(f'Session {job.sessionId} compacted')
+    return True
+
+# Save the session of a chat turn. A context that grew past what its session
+# row holds, e.g. while its compaction job was queued, is compacted right away
+# and saved again, the answer of the turn is already paid for. Raises
+# ContextTooLargeError if it still doesn't fit.
+async def saveTurn(store: AsyncPersistenceLayer | SessionCache, handler: OpenaiHandler) -> None:
+    message = handler.message
+    try:
+        with stage('save'):
+            await store.saveSession(message)
+        return
+    except ContextTooLargeError as ex:
+        logging.warning(f'Session {message.sessionId} does not fit in its row, compacting it before saving again: {ex}')
+    with stage('compaction'):
+        await handler.acompactMsgContextWithSummary()
+    with stage('save'):
+        await store.saveSession(message)
+
+# Runs compaction jobs as tasks of the running event loop. It has the set()
+# interface of the func.Out queue binding, so it can stand in for the storage
+# queue when the chat trigger runs outside the Functions host.
+class LocalCompactionQueue:
+    def __init__(self, store: AsyncPersistenceLayer | SessionCache) -> None:
+        self.store = store
+        self.pending: set[asyncio.Task] = set()
+
+    # Must be called from a coroutine.
+    def set(self, val: str) -> None:
+        task = asyncio.ensure_future(self._run(CompactionJob.fromJson(val)))
+        self.pending.add(task)
+        task.add_done_callback(self.pending.discard)
+
+    # Wait until every job enqueued so far is processed.
+    async def join(self) -> None:
+        while self.pending:
+            await asyncio.gather(*self.pending)
+
+    async def _run(self, job: CompactionJob) -> None:
+        try:
+            await compactSession(self.store, job)
+        except Exception as ex:
+            logging.error(f'Compaction of session {job.sessionId} failed: {ex}')
+        finally:
+            await releaseCompaction(job.sessionId)
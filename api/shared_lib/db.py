@@ -1,29 +1,76 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import base64
 import datetime
-import bcrypt
 import json
 import logging
 import os
 import zlib
-from azure.data.tables import TableServiceClient, UpdateMode
-from azure.core.exceptions import ResourceNotFoundError
+from azure.core import MatchConditions
+from azure.data.tables import TableErrorCode, UpdateMode
+from azure.data.tables.aio import TableClient as AsyncTableClient, TableServiceClient as AsyncTableServiceClient
+from azure.core.exceptions import HttpResponseError, ResourceModifiedError, ResourceNotFoundError
+from shared_lib import clients, metrics, passwords
+from shared_lib.codec import ContextEncoding, ContextEncodingBinary, SessionStorageMode, SessionStorageTurns, contextProperties, decodeContext, \
+    isEncodedContext, joinContextProperties
+from shared_lib.batching import TableWriteBatcher, WriteBatchDelayMs, splitTransactions
 from shared_lib.types.models import UserInfo
 from shared_lib.handler import Message
 
 TableName = 'openaiSessionTable'
 # Table Schema
 # {
-#     "PartitionKey": "2021-08-01",
+#     "PartitionKey": hash bucket of sessionId, or the day for older sessions, e.g. "20210801",
 #     "RowKey": "1234567890",
 #     "sessionId": "1234567890",
 #     "context": [
 #         {"role": "system", "content": "hello"},
 #         {"role": "user", "content": "hello"},
 #     ],
-#     "date": "2021-08-01",
+#     "contextTokens": [5, 5],
+#     "date": PartitionKey the session was created in,
+#     "owner": email of the user, see openaiSessionOwnerTable,
+#     "created": "2023-08-01T12:00:00.000+00:00",
+#     "listed": when the entry in openaiSessionOwnerTable was last written,
 # }
+# With SESSION_CONTEXT_ENCODING=binary, "context" holds the context in the
+# format of shared_lib.codec, split over "context", "context1", ... with
+# "contextChunks" set if it is too long for one property.
+
+SessionIndexTableName = 'openaiSessionIndexTable'
+# Table Schema
+# Only legacy sessions (plain uuid ids) are indexed; new session ids carry
+# their PartitionKey as a prefix, see Message.generateSessionId.
+# {
+#     "PartitionKey": hash partition of sessionId,
+#     "RowKey": sessionId,
+#     "SessionPartitionKey": "2021-08-01",
+# }
+# Ids that earlier versions scanned for in vain have an empty SessionPartitionKey.
+
+SessionOwnerTableName = 'openaiSessionOwnerTable'
+# Table Schema
+# Sessions of a user, newest first. saveSession writes the entry of every
+# session that has an owner, see Message.owner, when the session is created;
+# updated and turns are refreshed by saves at most every
+# SESSION_LIST_UPDATE_SECONDS. The table is created on first use.
+# {
+#     "PartitionKey": owner email,
+#     "RowKey": "<9999999999999 - created epoch ms>_<sessionId>",
+#     "sessionId": "1234567890",
+#     "pk": session PartitionKey,
+#     "title": start of the first question,
+#     "created": "2023-08-01T12:00:00.000+00:00",
+#     "updated": "2023-08-01T12:05:00.000+00:00",
+#     "turns": 4,
+# }
+SessionTitleLength = 80
+# Properties read to list sessions, the contexts are only read when a session is opened.
+SessionListFields = ['sessionId', 'pk', 'title', 'created', 'updated', 'turns']
+MaxSessionPageSize = 100
+OwnerRowKeyBase = 10 ** 13 - 1
+SessionListUpdateSeconds = float(os.getenv('SESSION_LIST_UPDATE_SECONDS', '300'))
 
 UserTableName = 'openaiUserTable'
 # Table Schema
@@ -36,88 +83,515 @@ UserTableName = 'openaiUserTable'
 #     "CreatedAt": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 # }
 
-connectionString = os.getenv('AzureDataStorage', '')
-
-class PersistenceLayer:
-    service: TableServiceClient
-
-    def __init__(self) -> None:
-        self.service = TableServiceClient.from_connection_string(conn_str=connectionString)
-
-    def checkIfSessionExist(self, sessionId:str) -> dict | None:
-        with self.service.get_table_client(table_name=TableName) as tableClient:
-            filterStr = f"RowKey eq '{sessionId}'"
-            entities = tableClient.query_entities(query_filter=filterStr)
-            if entities is None:
-                return None
-            for entity in entities:
-                context = loadContextAsList(entity.get('context'))
-                retval = {
-                    "context": context,
-                    "pk": entity.get('PartitionKey'),
-                    "sessionId": entity.get('RowKey')
-                }
-                
+# Turn rows of a session in turns mode, stored next to the session row.
+# {
+#     "PartitionKey": session PartitionKey,
+#     "RowKey": "<sessionId>.00000001",
+#     "sessionId": "1234567890",
+#     "turn": 1,
+#     "role": "user",
+#     "content": "hello",
+#     "tokens": 5,
+# }
+# The session row then carries "storageMode": "turns", "turnStart" and
+# "nextTurn" instead of "context".
+
+TurnRowKeySeparator = '.'
+# Upper bound of a session's row keys in range queries, sorts right after the separator.
+TurnRowKeyEnd = '/'
+# Saves of a turn that lost a concurrent update are rebased and retried this often.
+MaxSaveAttempts = 3
+
+class AsyncPersistenceLayer:
+    # The shared client of the registry is used unless a service is passed in.
+    # Table clients are kept until the registry replaces the service, they
+    # share its connection pool. With a batch delay, concurrent session and user writes of one partition
+    # are grouped into transactions, see TableWriteBatcher.
+    def __init__(self, service: AsyncTableServiceClient | None = None, batchDelaySeconds: float = WriteBatchDelayMs / 1000) -> None:
+        self._ownService = service
+        self._service = service
+        self._tableClients: dict[str, AsyncTableClient] = {}
+        self._ownerTableReady = False
+        self.batcher = TableWriteBatcher(self._getTableClient, batchDelaySeconds) if batchDelaySeconds > 0 else None
+
+    # The registry replaces its client when the event loop changes, table
+    # clients of a replaced service are dropped with it.
+    @property
+    def service(self) -> AsyncTableServiceClient:
+        service = self._ownService or clients.getAsyncTableService()
+        if service is not self._service:
+            self._service = service
+            self._tableClients = {}
+            self._ownerTableReady = False
+        return service
+
+    def _getTableClient(self, tableName: str) -> AsyncTableClient:
+        service = self.service
+        if tableName not in self._tableClients:
+            self._tableClients[tableName] = service.get_table_client(table_name=tableName)
+        return self._tableClients[tableName]
+
+    # Resolve the session with single-partition reads only. The partition comes
+    # from the caller's hint, the session id prefix or, for legacy ids, the index
+    # table. Ids found in none of them are unknown: they are never scanned for,
+    # so a client-chosen id costs a few point reads and no write. Legacy
+    # sessions that clients look up without their pk are found once
+    # tools.migrate_sessions moved them to their hash bucket.
+    async def checkIfSessionExist(self, sessionId:str, pk:str='') -> dict | None:
+        tableClient = self._getTableClient(TableName)
+        candidates = [pk, Message.parsePartitionKey(sessionId)]
+        if candidates[1] is None:
+            candidates.append(await self._lookupSessionIndex(sessionId))
+        # Sessions moved out of date partitions, see tools.migrate_sessions
+        candidates.append(Message.hashPartitionKey(sessionId))
+        tried = set()
+        for candidate in candidates:
+            if not candidate or candidate in tried:
+                continue
+            tried.add(candidate)
+            retval = await self._loadSession(tableClient, candidate, sessionId)
+            if retval is not None:
                 return retval
-        
-    def saveSession(self, message:Message) -> None:
-        with self.service.get_table_client(table_name=TableName) as tableClient:
-            data = {
-                    "PartitionKey": message.pk,
-                    "RowKey": message.sessionId,
-                    "context": json.dumps(message.context),
-                    "sessionId": message.sessionId,
-                    "date": message.pk
-                }
-            
-            tableClient.upsert_entity(data)
-
-    def saveUser(self, user: UserInfo, isCreate: bool = True) -> None:
-        with self.service.get_table_client(table_name=UserTableName) as tableClient:
-            entity = user.toTableEntity()
-
-            # Save the user to the database with the generated keys
-            # Replace the following line with your database save logic
-            logging.info(f"Saving user with PartitionKey: {entity.get('PartitionKey')} and RowKey: {entity.get('RowKey')}")
-
-            if isCreate:
-                tableClient.create_entity(entity)
+        return None
+
+    # A session moved to its hash bucket since pk was read is followed there.
+    async def loadSession(self, pk: str, sessionId: str) -> dict | None:
+        tableClient = self._getTableClient(TableName)
+        sessionData = await self._loadSession(tableClient, pk, sessionId)
+        movedPk = Message.hashPartitionKey(sessionId)
+        if sessionData is None and movedPk != pk:
+            sessionData = await self._loadSession(tableClient, movedPk, sessionId)
+        return sessionData
+
+    # One partition query returns the session row and, in turns mode, its turn rows.
+    async def _loadSession(self, tableClient, pk: str, sessionId: str) -> dict | None:
+        entities = tableClient.query_entities(**sessionRangeQuery(pk, sessionId))
+        return sessionFromEntities(sessionId, [entity async for entity in entities])
+
+    async def _lookupSessionIndex(self, sessionId: str) -> str | None:
+        try:
+            tableClient = self._getTableClient(SessionIndexTableName)
+            entity = await tableClient.get_entity(partition_key=generateSessionIndexPartitionKey(sessionId), row_key=sessionId)
+            return entity.get('SessionPartitionKey')
+        except ResourceNotFoundError:
+            return None
+
+    # A message loaded from the table is saved only if its session row did not
+    # change meanwhile. On conflict the turns added by this request are rebased
+    # onto the current session and saved again, unless rebaseOnConflict is
+    # False, then the conflict is raised to the caller.
+    async def saveSession(self, message:Message, rebaseOnConflict: bool = True) -> None:
+        tableClient = self._getTableClient(TableName)
+        for _ in range(MaxSaveAttempts - 1):
+            try:
+                return await self._saveSession(tableClient, message)
+            except HttpResponseError as err:
+                if not rebaseOnConflict or not isSaveConflict(message, err):
+                    raise
+            logging.info(f'Session {message.sessionId} changed while saving, rebasing')
+            sessionData = await self.loadSession(message.pk, message.sessionId)
+            if sessionData is None:
+                raise ResourceNotFoundError(f'Session {message.sessionId} was deleted while saving')
+            rebaseMessage(message, sessionData)
+        return await self._saveSession(tableClient, message)
+
+    async def _saveSession(self, tableClient, message:Message) -> None:
+        stampSessionCreated(message)
+        # Stamped before the session row is written, which keeps the stamp
+        listed = stampSessionListed(message)
+        if SessionStorageMode != SessionStorageTurns:
+            entity = sessionBlobEntity(message)
+            if self.batcher is not None:
+                result = (await self.batcher.submit(TableName, [sessionBlobOperation(message, entity)]))[0]
+            elif message._etag:
+                result = await tableClient.update_entity(entity, mode=UpdateMode.REPLACE,
+                    etag=message._etag, match_condition=MatchConditions.IfNotModified)
             else:
-                tableClient.upsert_entity(entity, mode = UpdateMode.REPLACE)
-                
-    def retrieveUser(self, userId: str) -> UserInfo | None:
+                result = await tableClient.upsert_entity(entity, mode=UpdateMode.REPLACE)
+            message._storedTurns = len(message.context)
+            message._etag = result.get('etag')
+        else:
+            for operations, headerIndex in sessionTransactions(sessionTurnOperations(message)):
+                if self.batcher is not None:
+                    results = await self.batcher.submit(TableName, operations)
+                else:
+                    results = await tableClient.submit_transaction(operations)
+                if headerIndex is not None:
+                    message._etag = results[headerIndex].get('etag')
+            markSessionStored(message)
+        if listed:
+            await self._saveSessionOwner(message)
+
+    # The owner index is derived from the session row, a failed write is
+    # corrected by a save of the session once SESSION_LIST_UPDATE_SECONDS passed.
+    async def _saveSessionOwner(self, message: Message) -> None:
         try:
-            with self.service.get_table_client(table_name=UserTableName) as tableClient:
-                entity = tableClient.get_entity(partition_key=UserInfo.generatePartitionKey(userId), row_key=userId)
-                retval = UserInfo(email=entity['Email'], quoteInDay=entity['QuoteInDay'])
-                retval.fromJson(entity)
-                return retval
+            entity = sessionOwnerEntity(message)
+            if entity is None:
+                return
+            if not self._ownerTableReady:
+                await self.service.create_table_if_not_exists(table_name=SessionOwnerTableName)
+                self._ownerTableReady = True
+            if self.batcher is not None:
+                await self.batcher.submit(SessionOwnerTableName, [('upsert', entity)])
+            else:
+                await self._getTableClient(SessionOwnerTableName).upsert_entity(entity)
+        except Exception as err:
+            logging.warning(f'Index owner of session {message.sessionId} failed: {err}')
+
+    # One page of the sessions of owner, newest first, and the token of the
+    # next page, None after the last one.
+    async def listSessions(self, owner: str, pageSize: int, continuationToken: str = '') -> tuple[list[dict], str | None]:
+        tableClient = self._getTableClient(SessionOwnerTableName)
+        entities = []
+        try:
+            async for entity in tableClient.query_entities(**sessionListQuery(owner, continuationToken, pageSize)):
+                entities.append(entity)
+                if len(entities) > pageSize:
+                    break
+        except ResourceNotFoundError:
+            # No session was indexed yet
+            return [], None
+        return sessionListPage(entities, pageSize)
+
+    async def saveUser(self, user: UserInfo, isCreate: bool = True) -> None:
+        tableClient = self._getTableClient(UserTableName)
+        entity = user.toTableEntity(await passwords.hashPasswordAsync(user.Password) if user.Password else b'')
+        logging.info(f"Saving user with PartitionKey: {entity.get('PartitionKey')} and RowKey: {entity.get('RowKey')}")
+        if self.batcher is not None:
+            operation = ('create', entity) if isCreate else ('upsert', entity, {'mode': UpdateMode.REPLACE})
+            await self.batcher.submit(UserTableName, [operation])
+        elif isCreate:
+            await tableClient.create_entity(entity)
+        else:
+            await tableClient.upsert_entity(entity, mode = UpdateMode.REPLACE)
+
+    async def retrieveUser(self, userId: str) -> UserInfo | None:
+        try:
+            tableClient = self._getTableClient(UserTableName)
+            entity = await tableClient.get_entity(partition_key=UserInfo.generatePartitionKey(userId), row_key=userId)
+            retval = UserInfo(email=entity['Email'], quoteInDay=entity['QuoteInDay'])
+            retval.fromJson(entity)
+            return retval
         except ResourceNotFoundError as err:
             logging.warning(f'User {userId} not found')
             return None
         except Exception as err:
             logging.error(f'Retrieve user err: {err}')
             raise
-    
-    def checkUserPassword(self, inputUser: UserInfo) -> bool:
-        with self.service.get_table_client(table_name=UserTableName) as tableClient:
-            inputUserEntity = inputUser.toTableEntity()
 
-            # Get existing user information
-            existingUser = tableClient.get_entity(partition_key=inputUserEntity.get('PartitionKey', ''), row_key=inputUserEntity.get('RowKey', ''))
-            if existingUser is None:
-                return False
-            
-            # Hash the password with the salt
-            input_hashed_password = bcrypt.hashpw(inputUser.Password.encode(), existingUser.get('Salt', ''))
+    # The stored hash carries its salt and cost, so the input password is hashed
+    # exactly once. Hashes of a lower cost than BCRYPT_ROUNDS are upgraded.
+    async def checkUserPassword(self, inputUser: UserInfo) -> bool:
+        tableClient = self._getTableClient(UserTableName)
+        try:
+            existingUser = await tableClient.get_entity(partition_key=UserInfo.generatePartitionKey(inputUser.Email), row_key=inputUser.Email)
+        except ResourceNotFoundError:
+            # Costs a bcrypt check as well, timing doesn't tell registered emails apart
+            return await passwords.verifyDummyPasswordAsync(inputUser.Password)
+
+        hashedPassword = existingUser.get('HashedPassword')
+        if not hashedPassword:
+            return await passwords.verifyDummyPasswordAsync(inputUser.Password)
+        if not await passwords.verifyPasswordAsync(inputUser.Password, hashedPassword):
+            return False
+        if passwords.needsRehash(hashedPassword):
+            try:
+                await tableClient.update_entity(
+                    userPasswordEntity(existingUser, await passwords.hashPasswordAsync(inputUser.Password)),
+                    mode=UpdateMode.MERGE, etag=existingUser.metadata.get('etag'), match_condition=MatchConditions.IfNotModified)
+            except HttpResponseError as err:
+                logging.warning(f'Upgrade password hash of user {inputUser.Email} failed: {err}')
+        return True
+
+# Merge entity that replaces the password hash of a stored user.
+def userPasswordEntity(existingUser: dict, hashedPassword: bytes) -> dict:
+    return {
+        "PartitionKey": existingUser['PartitionKey'],
+        "RowKey": existingUser['RowKey'],
+        "Salt": passwords.saltOf(hashedPassword),
+        "HashedPassword": hashedPassword,
+    }
+
+def generateSessionIndexPartitionKey(sessionId: str) -> str:
+    return str(zlib.crc32(sessionId.encode()) % 100)
+
+def sessionIndexEntity(sessionId: str, sessionPk: str) -> dict:
+    return {
+        "PartitionKey": generateSessionIndexPartitionKey(sessionId),
+        "RowKey": sessionId,
+        "SessionPartitionKey": sessionPk,
+    }
+
+def turnRowKey(sessionId: str, turn: int) -> str:
+    return f'{sessionId}{TurnRowKeySeparator}{turn:08d}'
+
+# Query arguments for the session row and its turn rows.
+def sessionRangeQuery(pk: str, sessionId: str) -> dict:
+    return {
+        "query_filter": "PartitionKey eq @pk and RowKey ge @sessionId and RowKey lt @rowKeyEnd",
+        "parameters": {"pk": pk, "sessionId": sessionId, "rowKeyEnd": sessionId + TurnRowKeyEnd},
+    }
+
+def sessionFromEntity(entity) -> dict:
+    rawContext = joinContextProperties(entity)
+    if ContextEncoding == ContextEncodingBinary and isinstance(rawContext, str):
+        # Rewritten in binary when the session is saved
+        metrics.incr('sessionContext.legacyReads')
+    context = loadContextAsList(rawContext)
+    return {
+        "context": context,
+        "pk": entity.get('PartitionKey'),
+        "sessionId": entity.get('RowKey'),
+        "storedTurns": len(context),
+        "tokenCounts": json.loads(entity.get('contextTokens') or '[]'),
+        "etag": entity.metadata.get('etag'),
+        "owner": entity.get('owner'),
+        "created": entity.get('created'),
+        "listed": entity.get('listed'),
+    }
+
+# Rebuild a session from its session row and turn rows. Only the turns in
+# [turnStart, nextTurn) are live: rows past nextTurn belong to a save that has
+# not committed its session row yet, rows before turnStart were compacted away.
+def sessionFromEntities(sessionId: str, entities: list) -> dict | None:
+    header = None
+    turns = []
+    for entity in entities:
+        rowKey = entity.get('RowKey')
+        if rowKey == sessionId:
+            header = entity
+        elif rowKey.startswith(sessionId + TurnRowKeySeparator):
+            turns.append(entity)
+    if header is None:
+        return None
+    if header.get('storageMode') != SessionStorageTurns:
+        return sessionFromEntity(header)
+
+    turnStart = header.get('turnStart', 0)
+    nextTurn = header.get('nextTurn', 0)
+    turns = sorted((t for t in turns if turnStart <= t.get('turn', -1) < nextTurn), key=lambda t: t['turn'])
+    tokenCounts = [t.get('tokens') for t in turns]
+    return {
+        "context": [{"role": t.get('role'), "content": t.get('content')} for t in turns],
+        "pk": header.get('PartitionKey'),
+        "sessionId": sessionId,
+        "turnStart": turnStart,
+        "nextTurn": nextTurn,
+        "storedTurns": len(turns),
+        "tokenCounts": tokenCounts if None not in tokenCounts else [],
+        "etag": header.metadata.get('etag'),
+        "owner": header.get('owner'),
+        "created": header.get('created'),
+        "listed": header.get('listed'),
+    }
+
+def sessionBlobEntity(message: Message) -> dict:
+    return {
+        "PartitionKey": message.pk,
+        "RowKey": message.sessionId,
+        **contextProperties(message.context),
+        "contextTokens": json.dumps(message.contextTokenCounts()),
+        "sessionId": message.sessionId,
+        "date": message.pk,
+        **sessionOwnerProperties(message),
+    }
+
+# Session rows written without these would lose them, saves REPLACE the row.
+def sessionOwnerProperties(message: Message) -> dict:
+    if not message.owner:
+        return {}
+    return {"owner": message.owner, "created": message.created, "listed": message.listed}
+
+# Whether user may go on with a loaded session. Sessions of older versions
+# have no owner, any user may.
+def isOwnedBy(sessionData: dict, user: str) -> bool:
+    owner = sessionData.get('owner')
+    return not owner or owner == user
+
+# Time a session is first saved with an owner, its entry in the owner index is keyed by it.
+def stampSessionCreated(message: Message) -> None:
+    if message.owner and not message.created:
+        message.created = utcNow()
+
+# Whether a save writes the entry of the session in the owner index: when the
+# session is created, or was last listed SESSION_LIST_UPDATE_SECONDS ago.
+def stampSessionListed(message: Message) -> bool:
+    if not message.owner:
+        return False
+    now = datetime.datetime.now(datetime.timezone.utc)
+    if message.listed:
+        listed = datetime.datetime.fromisoformat(message.listed)
+        if (now - listed).total_seconds() < SessionListUpdateSeconds:
+            return False
+    message.listed = now.isoformat(timespec='milliseconds')
+    return True
+
+def utcNow() -> str:
+    return datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='milliseconds')
+
+# Newest sessions sort first.
+def ownerRowKey(created: str, sessionId: str) -> str:
+    createdMs = int(datetime.datetime.fromisoformat(created).timestamp() * 1000)
+    return f'{OwnerRowKeyBase - createdMs:013d}{Message.SessionIdSeparator}{sessionId}'
+
+# Start of the first question. Compacted sessions start with their summary,
+# their title is left as it was.
+def sessionTitle(context: list) -> str | None:
+    if len(context) == 0 or context[0].get('role') == 'system':
+        return None
+    for item in context:
+        if item.get('role') == 'user':
+            title = ' '.join(str(item.get('content', '')).split())
+            return title[:SessionTitleLength]
+    return None
+
+def sessionOwnerEntity(message: Message) -> dict | None:
+    if not message.owner or not message.created:
+        return None
+    entity = {
+        "PartitionKey": message.owner,
+        "RowKey": ownerRowKey(message.created, message.sessionId),
+        "sessionId": message.sessionId,
+        "pk": message.pk,
+        "created": message.created,
+        "updated": message.listed,
+        "turns": len(message.context),
+    }
+    title = sessionTitle(message.context)
+    if title is not None:
+        entity['title'] = title
+    return entity
+
+# Query arguments of a page of sessions of owner. One more than a page is
+# asked for to tell whether there is a next page. Continuation tokens are the
+# last RowKey of the previous page.
+def sessionListQuery(owner: str, continuationToken: str, pageSize: int) -> dict:
+    after = ''
+    if continuationToken:
+        after = base64.urlsafe_b64decode(continuationToken.encode()).decode()
+        if base64.urlsafe_b64encode(after.encode()).decode() != continuationToken:
+            raise ValueError('Invalid continuation token')
+    return {
+        "query_filter": "PartitionKey eq @owner and RowKey gt @after",
+        "parameters": {"owner": owner, "after": after},
+        "select": SessionListFields + ['RowKey'],
+        "results_per_page": pageSize + 1,
+    }
+
+def sessionListPage(entities: list, pageSize: int) -> tuple[list[dict], str | None]:
+    page = entities[:pageSize]
+    items = [{field: entity.get(field) for field in SessionListFields} for entity in page]
+    if len(entities) <= pageSize:
+        return items, None
+    return items, base64.urlsafe_b64encode(page[-1]['RowKey'].encode()).decode()
+
+# Transaction operation that writes the session row of a blob session, conditional
+# on the etag it was loaded with.
+def sessionBlobOperation(message: Message, entity: dict) -> tuple:
+    if message._etag:
+        return ('update', entity, {'mode': UpdateMode.REPLACE,
+            'etag': message._etag, 'match_condition': MatchConditions.IfNotModified})
+    return ('upsert', entity, {'mode': UpdateMode.REPLACE})
+
+# Transaction operations that persist the turns added since the session was
+# loaded. The session row is written after the new turn rows so readers never
+# see a half-written turn. If the context was rewritten (compaction) all of it
+# is written as new turns and the previous rows are deleted afterwards.
+def sessionTurnOperations(message: Message) -> list:
+    turnStart = message._turnStart
+    nextTurn = message._nextTurn
+    storedTurns = message._storedTurns
+    deadTurns = range(0)
+    if storedTurns != nextTurn - turnStart:
+        deadTurns = range(turnStart, nextTurn)
+        turnStart = nextTurn
+        storedTurns = 0
+
+    operations: list = []
+    tokenCounts = message.contextTokenCounts()
+    for i, item in enumerate(message.context[storedTurns:]):
+        operations.append(('upsert', {
+            "PartitionKey": message.pk,
+            "RowKey": turnRowKey(message.sessionId, nextTurn + i),
+            "sessionId": message.sessionId,
+            "turn": nextTurn + i,
+            "role": item.get('role', ''),
+            "content": item.get('content', ''),
+            "tokens": tokenCounts[storedTurns + i],
+        }))
+    nextTurn += len(message.context) - storedTurns
+
+    header = {
+        "PartitionKey": message.pk,
+        "RowKey": message.sessionId,
+        "sessionId": message.sessionId,
+        "date": message.pk,
+        "storageMode": SessionStorageTurns,
+        "turnStart": turnStart,
+        "nextTurn": nextTurn,
+        **sessionOwnerProperties(message),
+    }
+    if message._etag:
+        operations.append(('update', header, {'mode': UpdateMode.REPLACE,
+            'etag': message._etag, 'match_condition': MatchConditions.IfNotModified}))
+    else:
+        operations.append(('upsert', header, {'mode': UpdateMode.REPLACE}))
+
+    for turn in deadTurns:
+        operations.append(('delete', {"PartitionKey": message.pk, "RowKey": turnRowKey(message.sessionId, turn)}))
+    return operations
+
+# Split session operations into transactions, each paired with the position
+# of the session row in it, or None if the session row is in another one.
+def sessionTransactions(operations: list) -> list[tuple[list, int | None]]:
+    headerIndex = len(operations) - 1 - sum(1 for op in operations if op[0] == 'delete')
+    transactions = []
+    start = 0
+    for chunk in splitTransactions(operations):
+        position = headerIndex - start if start <= headerIndex < start + len(chunk) else None
+        transactions.append((chunk, position))
+        start += len(chunk)
+    return transactions
+
+def markSessionStored(message: Message) -> None:
+    if message._storedTurns != message._nextTurn - message._turnStart:
+        message._turnStart = message._nextTurn
+    message._nextTurn = message._turnStart + len(message.context)
+    message._storedTurns = len(message.context)
+
+# Put the turns this message added on top of the session as it is stored now.
+def rebaseMessage(message: Message, sessionData: dict) -> None:
+    newTurns = message.context[message._storedTurns:]
+    newTokenCounts = message.contextTokenCounts()[message._storedTurns:]
+    message.context = sessionData.get('context', []) + newTurns
+    # The session may have moved to its hash bucket meanwhile
+    message.pk = sessionData.get('pk') or message.pk
+    message.restoreStoreState(sessionData)
+    if len(message._tokenCounts) == len(sessionData.get('context', [])):
+        message._tokenCounts.extend(newTokenCounts)
+        message._tokenTotal += sum(newTokenCounts)
+
+def isConditionNotSatisfied(err: HttpResponseError) -> bool:
+    return isinstance(err, ResourceModifiedError) or \
+        getattr(err, 'error_code', None) == TableErrorCode.UPDATE_CONDITION_NOT_SATISFIED
+
+def isResourceNotFound(err: HttpResponseError) -> bool:
+    return isinstance(err, ResourceNotFoundError) or \
+        getattr(err, 'error_code', None) == TableErrorCode.RESOURCE_NOT_FOUND
 
-            return input_hashed_password == existingUser.get('HashedPassword', '').encode()
+# A save lost to another write: the session row changed, or it is gone from
+# the partition the message was loaded from because it was moved.
+def isSaveConflict(message: Message, err: HttpResponseError) -> bool:
+    return isConditionNotSatisfied(err) or (message._etag is not None and isResourceNotFound(err))
 
 def loadContextAsList(rawContext) -> list:
     if rawContext is None or len(rawContext) == 0:
         return []
     if type(rawContext) is list:
         return rawContext
+    if isEncodedContext(rawContext):
+        return decodeContext(rawContext)
     if type(rawContext) is not str and \
         type(rawContext) is not bytes and \
         type(rawContext) is not bytearray:
@@ -3,27 +3,98 @@
 
 import datetime
 import json
+import time
 from typing import Mapping
 import uuid
 import os
-import openai
+import zlib
 import logging
+from shared_lib import clients, tracing
+from shared_lib.cache.completion import CachedCompletion, completionCache
+from shared_lib.summary import foldBatches, getSummaryTokenBudget, splitContext, summaryCallTokens, summaryEntry, summaryPrompt
+from shared_lib.tokens import countMessageTokens, getCompactionThreshold
+from shared_lib.upstream import upstreamPool
+
+# "queue" summarizes long chats in the compactionWorker function after the
+# reply is sent, "inline" summarizes them before the reply is returned.
+CompactionQueue = 'queue'
+CompactionInline = 'inline'
+CompactionMode = os.getenv('COMPACTION_MODE', CompactionQueue)
+
+# "full" replies carry the whole session context in data, "delta" replies only
+# the new answer, see Response.toDelta. Requests may ask for either with
+# "responseMode", this is the default.
+ResponseModeFull = 'full'
+ResponseModeDelta = 'delta'
+ResponseMode = os.getenv('RESPONSE_MODE', ResponseModeFull)
+
+# Partitions of new sessions. "date" puts the sessions of a day into one
+# partition, e.g. "20230801", which takes all of that day's writes. "hash"
+# spreads them over SESSION_PARTITION_BUCKETS partitions by a crc32 of their
+# id, like users. Sessions are read wherever they are, and tools.migrate_sessions
+# moves date partitioned sessions to their bucket. Don't change the number of
+# buckets once sessions were migrated: moved sessions keep their ids, their
+# bucket is found from the id.
+SessionPartitionDate = 'date'
+SessionPartitionHash = 'hash'
+SessionPartitionScheme = os.getenv('SESSION_PARTITION_SCHEME', SessionPartitionHash)
+SessionPartitionBuckets = int(os.getenv('SESSION_PARTITION_BUCKETS', '100'))
 
 class Message:
     pk:str
     sessionId:str
     context:list[dict[str, str]]
     promo:str
+
+    # Session ids carry their partition key as a prefix, e.g. "20230801_<uuid4>",
+    # so a lookup can go straight to a point read. Legacy ids are plain uuid4
+    # strings, which never contain the separator.
+    SessionIdSeparator = '_'
+
+    @staticmethod
+    def generateSessionId(pk: str) -> str:
+        return f'{pk}{Message.SessionIdSeparator}{uuid.uuid4()}'
+
+    # Partition key and id of a new session.
+    @staticmethod
+    def generateSession() -> tuple[str, str]:
+        if SessionPartitionScheme == SessionPartitionDate:
+            pk = datetime.date.today().strftime("%Y%m%d")
+            return pk, Message.generateSessionId(pk)
+        key = str(uuid.uuid4())
+        pk = Message.hashPartitionKey(key)
+        return pk, f'{pk}{Message.SessionIdSeparator}{key}'
+
+    # Bucket of a session in the hash scheme. Only the uuid part of the id is
+    # hashed, so sessions moved out of date partitions keep their ids.
+    @staticmethod
+    def hashPartitionKey(sessionId: str) -> str:
+        key = sessionId.rpartition(Message.SessionIdSeparator)[2]
+        return str(zlib.crc32(key.encode()) % SessionPartitionBuckets)
+
+    # Whether pk is the partition of a day, e.g. "20230801", as opposed to a bucket.
+    @staticmethod
+    def isDatePartitionKey(pk: str) -> bool:
+        return len(pk) == 8 and pk.isdigit()
+
+    @staticmethod
+    def parsePartitionKey(sessionId: str) -> str | None:
+        pk, sep, _ = sessionId.partition(Message.SessionIdSeparator)
+        if not sep or len(pk) == 0:
+            return None
+        return pk
     
     def __init__(self, pk:str="", sessionId:str="", context:list[dict[str, str]]=[], promo:str="") -> None:
-        if pk is None or len(pk) == 0:
-            self.pk = datetime.date.today().strftime("%Y%m%d")
-        else:
-            self.pk = pk
         if sessionId is None or len(sessionId) == 0:
-            self.sessionId = str(uuid.uuid4())
-        else:
-            self.sessionId = sessionId
+            generatedPk, sessionId = Message.generateSession()
+            if pk is None or len(pk) == 0:
+                pk = generatedPk
+            else:
+                sessionId = Message.generateSessionId(pk)
+        if pk is None or len(pk) == 0:
+            pk = Message.parsePartitionKey(sessionId) or datetime.date.today().strftime("%Y%m%d")
+        self.pk = pk
+        self.sessionId = sessionId
         if context is None or type(context) is not list:
             self.context = []
         else:
@@ -31,56 +102,162 @@ class Message:
         if promo is None:
             promo = ""
         self.promo = promo
+        # Storage bookkeeping for per-turn session rows, see AsyncPersistenceLayer.saveSession.
+        # _storedTurns is the length of the context prefix that is already persisted.
+        self._turnStart = 0
+        self._nextTurn = 0
+        self._storedTurns = 0
+        # ETag of the session row this message was loaded from, saves are conditional on it.
+        self._etag = None
+        # Version of the cached session this message was loaded from, see SessionCache.
+        self._cacheVersion = 0
+        # Token count of every context entry, counted once when the entry is added.
+        self._tokenCounts: list[int] = []
+        self._tokenTotal = 0
+        # Email of the user the session belongs to and when it was first saved
+        # for them, see sessionOwnerEntity. Sessions of older versions have neither.
+        # listed is when its entry in the owner index was last written.
+        self.owner = ''
+        self.created = ''
+        self.listed = ''
         
-    def toJson(self) -> str:
-        return json.dumps(self, default=lambda o: o.__dict__, 
+    def toJson(self, compact: bool = False) -> str:
+        if compact:
+            return compactJson(self.toDict())
+        return json.dumps(self, default=publicAttributes, 
             sort_keys=True, indent=2)
+
+    def toDict(self) -> dict:
+        return {"pk": self.pk, "sessionId": self.sessionId, "context": self.context, "promo": self.promo}
         
     def fromJson(self, jsonDict: dict) -> None:
         self.pk = jsonDict.get('pk', '')
         self.sessionId = jsonDict.get('sessionId', '')
         self.context = jsonDict.get('context', [])
         self.promo = jsonDict.get('promo', 'Hi')
+        self._tokenCounts = []
+        self._tokenTotal = 0
         
     def pushContext(self, role:str='system', content:str='') -> None:
         if content is None or len(content) == 0:
             return
         self.context.append({"role": role, "content": content})
+        self._countNewTokens()
+
+    # Drop the whole context, the next save rewrites the session instead of appending.
+    def resetContext(self) -> None:
+        self.context = []
+        self._storedTurns = 0
+        self._tokenCounts = []
+        self._tokenTotal = 0
+
+    # Replace the entries from pinned to keepFrom with the running summary,
+    # the next save rewrites the session.
+    def replaceWithSummary(self, summary: str, keepFrom: int, pinned: int = 0) -> None:
+        entry = summaryEntry(summary)
+        context = self.context[:pinned] + [entry] + self.context[keepFrom:]
+        tokenCounts = self.contextTokenCounts()
+        tokenCounts = tokenCounts[:pinned] + [countMessageTokens(entry)] + tokenCounts[keepFrom:]
+        self.resetContext()
+        self.context = context
+        self._tokenCounts = tokenCounts
+        self._tokenTotal = sum(self._tokenCounts)
+
+    def restoreStoreState(self, sessionData: dict) -> None:
+        self._turnStart = sessionData.get('turnStart', 0)
+        self._nextTurn = sessionData.get('nextTurn', 0)
+        self._storedTurns = sessionData.get('storedTurns', 0)
+        self._etag = sessionData.get('etag')
+        self._cacheVersion = sessionData.get('cacheVersion', 0)
+        self.owner = sessionData.get('owner') or self.owner
+        self.created = sessionData.get('created') or self.created
+        self.listed = sessionData.get('listed') or self.listed
+        # Stored sessions come with the counts of their turns, only turns added
+        # by this request are counted.
+        tokenCounts = sessionData.get('tokenCounts') or []
+        if len(tokenCounts) != self._storedTurns:
+            tokenCounts = []
+        self._tokenCounts = list(tokenCounts)
+        self._tokenTotal = sum(tokenCounts)
+
+    # Entries can be appended to context directly, count the ones not counted yet.
+    def _countNewTokens(self) -> None:
+        for item in self.context[len(self._tokenCounts):]:
+            count = countMessageTokens(item)
+            self._tokenCounts.append(count)
+            self._tokenTotal += count
+
+    @property
+    def tokenTotal(self) -> int:
+        self._countNewTokens()
+        return self._tokenTotal
+
+    def contextTokenCounts(self) -> list[int]:
+        self._countNewTokens()
+        return self._tokenCounts
+
+    def needsCompaction(self) -> bool:
+        threshold = getCompactionThreshold()
+        logging.debug('Chat of session %s has %s tokens, compaction threshold is %s', self.sessionId, self.tokenTotal, threshold)
+        return self.tokenTotal > threshold
         
 class Response:
     code: int = 0
     message: str = ""
     data: object
     
-    def toJson(self) -> str:
-        return json.dumps(self, default=lambda o: o.__dict__, 
+    def toJson(self, compact: bool = False) -> str:
+        if compact:
+            return compactJson(self.toDict())
+        return json.dumps(self, default=publicAttributes, 
             sort_keys=True, indent=2)
+
+    def toDict(self) -> dict:
+        retval = publicAttributes(self)
+        if isinstance(retval.get('data'), Message):
+            retval['data'] = retval['data'].toDict()
+        return retval
+
+    # Same response without the session context: message is the new answer,
+    # data only keeps the keys the client needs for its next turn.
+    def toDelta(self) -> 'Response':
+        retval = Response()
+        retval.__dict__.update(self.__dict__)
+        message = getattr(self, 'data', None)
+        if isinstance(message, Message):
+            retval.data = {"pk": message.pk, "sessionId": message.sessionId}
+        return retval
     
+# Serialize objects by their attributes, leaving out private bookkeeping.
+def publicAttributes(o) -> dict:
+    return {key: value for key, value in o.__dict__.items() if not key.startswith('_')}
+
+# JSON without indentation and escapes, which the C encoder of the json module
+# writes; with indent it falls back to the pure Python one.
+def compactJson(data: object) -> str:
+    return json.dumps(data, default=publicAttributes, ensure_ascii=False, separators=(',', ':'))
 
 class OpenaiHandler:
     def __init__(self, message: Message) -> None:
         # Setting up the deployment name
         self.chatgpt_model_name = os.getenv("CHATGPT_MODEL")
-        # This is set to `azure`
-        # openai.api_type = "azure"
-        openai.api_type = os.getenv("OPENAI_API_TYPE")
-        # The API key for your Azure OpenAI resource.
-        openai.api_key = os.getenv("OPENAI_API_KEY")
-        # The base URL for your Azure OpenAI resource. e.g. "https://<your resource name>.openai.azure.com"
-        openai.api_base = os.getenv('OPENAI_API_BASE')
-        # Currently Chat Completion API have the following versions available: 2023-03-15-preview
-        openai.api_version = os.getenv('OPENAI_API_VERSION')
         
         self.message = message
         self.response = ""
+        # Tokens of every upstream call of this handler, as billed by the API.
+        # Calls that don't report usage are counted locally.
+        self.usedTokens = 0
+        # Arguments of chat completions besides the messages, e.g. temperature.
+        # They are part of the completion cache key.
+        self.completionParams: dict = {}
         pass
     
-    def runChatCompletion(self) -> Response:
+    async def arunChatCompletion(self) -> Response:
         retval = Response()
         retval.data = self.message
         try:
-            response = self.completion()
-            self.compactMsgContextWithSummaryIfNeed()
+            response = await self.acompletion()
+            await self.acompactMsgContextWithSummaryIfNeed()
         except Exception as ex:
             retval.message = str(ex)
             retval.code = -1
@@ -88,70 +265,104 @@ class OpenaiHandler:
             retval.code = 0
             retval.message = response
         return retval
-    
-    def compactMsgContextWithSummaryIfNeed(self):
-        totalTokenLen = sum([len(token.get('content', '')) for token in self.message.context])
-        logging.info(f"Token length of Chat of session {self.message.sessionId} is {totalTokenLen}")
-        
-        if len(self.message.context) > 10 or totalTokenLen > 10000:
-            logging.info(f"Chat of session {self.message.sessionId} is too long, compacting")
-            self.compactMsgContextWithSummary()
-    
-    def compactMsgContextWithSummary(self):
-        self.message.promo = "Summary this chat."
-        response = self.completion()
-        self.message.context = []
-        self.message.pushContext(content=response)
-    
-    def completion(self) -> str:
+
+    async def acompactMsgContextWithSummaryIfNeed(self):
+        # In queue mode the compaction worker summarizes long chats after they are saved
+        if CompactionMode != CompactionInline:
+            return
+        with tracing.stage('compaction'):
+            if self.message.needsCompaction():
+                logging.info(f"Chat of session {self.message.sessionId} is too long, compacting")
+                await self.acompactMsgContextWithSummary()
+
+    # Fold the turns before the last few into the running summary, see shared_lib.summary.
+    async def acompactMsgContextWithSummary(self):
+        summary, pinned, start, keepFrom = splitContext(self.message.context, self.message.contextTokenCounts())
+        if keepFrom <= start:
+            logging.info(f"Chat of session {self.message.sessionId} has no turns to fold into its summary")
+            return
+        tokenCounts = self.message.contextTokenCounts()
+        for batch in foldBatches(self.message.context[start:keepFrom], tokenCounts[start:keepFrom]):
+            summary = await self.asummarize(summary, batch)
+        self.message.replaceWithSummary(summary, keepFrom, pinned)
+
+    # The summary so far with entries folded in, kept within the summary budget.
+    async def asummarize(self, summary: str, entries: list[dict]) -> str:
+        prompt = summaryPrompt(summary, entries)
+        clients.useOpenaiSession()
+        try:
+            start = time.perf_counter()
+            response = await upstreamPool.call(lambda endpoint: clients.getOpenai().ChatCompletion.acreate(
+                  messages=prompt,
+                  max_tokens=getSummaryTokenBudget(),
+                  **endpoint.requestArgs()
+                ))
+            tracing.record('summary', (time.perf_counter() - start) * 1000)
+            return self._useSummary(prompt, response)
+        except Exception as e:
+            logOpenaiError(e)
+            raise e
+
+    async def acompletion(self) -> str:
         self.message.pushContext(role='user', content=self.message.promo)
-        
+        cacheKey = completionCache.key(self.chatgpt_model_name or '', self.message.context, self.completionParams)
+        cached = await completionCache.get(cacheKey)
+        if cached is not None:
+            return self._useCachedCompletion(cached)
+
+        clients.useOpenaiSession()
         try:
-            response = openai.ChatCompletion.create(
-                  engine=self.chatgpt_model_name,
-                  messages=self.message.context
-                )
+            start = time.perf_counter()
+            response = await upstreamPool.call(lambda endpoint: clients.getOpenai().ChatCompletion.acreate(
+                  messages=self.message.context,
+                  **self.completionParams,
+                  **endpoint.requestArgs()
+                ))
             if not response:
                 return ''
             self.response = response['choices'][0]['message']['content'] # type: ignore
             self.message.pushContext(content=self.response)
-            logging.info(self.response)
+            tokens = self._addUsage(response.get('usage')) # type: ignore
+            latencyMs = (time.perf_counter() - start) * 1000
+            tracing.record('upstream', latencyMs)
+            await completionCache.put(cacheKey, CachedCompletion(self.response, tokens, latencyMs))
+            logging.debug('Answer of session %s: %s', self.message.sessionId, self.response)
             return self.response
-        except openai.error.APIError as e: # type: ignore
-            # Handle API error here, e.g. retry or log
-            logging.error(f"OpenAI API returned an API Error: {e}")
-            raise e
-        except openai.error.AuthenticationError as e: # type: ignore
-            # Handle Authentication error here, e.g. invalid API key
-            logging.error(f"OpenAI API returned an Authentication Error: {e}")
-            raise e
-        except openai.error.APIConnectionError as e: # type: ignore
-            # Handle connection error here
-            logging.error(f"Failed to connect to OpenAI API: {e}")
-            raise e
-        except openai.error.InvalidRequestError as e: # type: ignore
-            # Handle connection error here
-            logging.error(f"Invalid Request Error: {e}")
-            raise e
-        except openai.error.RateLimitError as e: # type: ignore
-            # Handle rate limit error
-            logging.error(f"OpenAI API request exceeded rate limit: {e}")
-            raise e
-        except openai.error.ServiceUnavailableError as e: # type: ignore
-            # Handle Service Unavailable error
-            logging.error(f"Service Unavailable: {e}")
-            raise e
-        except openai.error.Timeout as e: # type: ignore
-            # Handle request timeout
-            logging.error(f"Request timed out: {e}")
-            raise e
         except Exception as e:
-            # Handles all other exceptions
-            logging.error("An exception has occured.")
+            logOpenaiError(e)
             raise e
-    
+
+    # Count the tokens of the last call, the context then holds its prompt and answer.
+    def _addUsage(self, usage: dict | None) -> int:
+        if usage and 'total_tokens' in usage:
+            tokens = int(usage['total_tokens'])
+        else:
+            tokens = self.message.tokenTotal
+        self.usedTokens += tokens
+        return tokens
+
+    # An empty summary would drop the folded turns, the context is then left as it is.
+    def _useSummary(self, prompt: list[dict], response) -> str:
+        if not response or not response['choices']:
+            raise ValueError('Summary call returned no choices')
+        summary = (response['choices'][0]['message'].get('content') or '').strip()
+        if not summary:
+            raise ValueError('Summary call returned an empty summary')
+        usage = response.get('usage')
+        if usage and 'total_tokens' in usage:
+            self.usedTokens += int(usage['total_tokens'])
+        else:
+            self.usedTokens += summaryCallTokens(prompt, summary)
+        return summary
+
+    # A cached answer costs no tokens.
+    def _useCachedCompletion(self, cached: CachedCompletion) -> str:
+        self.response = cached.content
+        self.message.pushContext(content=self.response)
+        return self.response
+
     def onlyCompletion(self) -> str:
-        response = openai.Completion.create(
+        response = clients.getOpenai().Completion.create(
               engine=self.chatgpt_model_name,
               model=self.chatgpt_model_name,
               prompt=[f'"{item["role"]}" said: "{item["content"]}\n\r"' for item in self.message.context],
@@ -166,10 +377,39 @@ class OpenaiHandler:
         self.response = response['choices'][0]['text'] # type: ignore
         return self.response
     
+# Log an error of the OpenAI API by its kind.
+def logOpenaiError(e: Exception) -> None:
+    import openai
+    if isinstance(e, openai.error.APIError): # type: ignore
+        # Handle API error here, e.g. retry or log
+        logging.error(f"OpenAI API returned an API Error: {e}")
+    elif isinstance(e, openai.error.AuthenticationError): # type: ignore
+        # Handle Authentication error here, e.g. invalid API key
+        logging.error(f"OpenAI API returned an Authentication Error: {e}")
+    elif isinstance(e, openai.error.APIConnectionError): # type: ignore
+        # Handle connection error here
+        logging.error(f"Failed to connect to OpenAI API: {e}")
+    elif isinstance(e, openai.error.InvalidRequestError): # type: ignore
+        # Handle connection error here
+        logging.error(f"Invalid Request Error: {e}")
+    elif isinstance(e, openai.error.RateLimitError): # type: ignore
+        # Handle rate limit error
+        logging.error(f"OpenAI API request exceeded rate limit: {e}")
+    elif isinstance(e, openai.error.ServiceUnavailableError): # type: ignore
+        # Handle Service Unavailable error
+        logging.error(f"Service Unavailable: {e}")
+    elif isinstance(e, openai.error.Timeout): # type: ignore
+        # Handle request timeout
+        logging.error(f"Request timed out: {e}")
+    else:
+        # Handles all other exceptions
+        logging.error("An exception has occured.")
+
 def CreateCORSResponseHeaders() -> Mapping[str, str]:
     headers = {
         'Access-Control-Allow-Origin': '*',
         'Access-Control-Allow-Methods': 'GET,POST,PUT,DELETE,PATCH,OPTIONS',
-        'Access-Control-Allow-Headers': 'Origin, X-Requested-With, Content-Type, Accept, Authorization, x-functions-key'
+        'Access-Control-Allow-Headers': 'Origin, X-Requested-With, Content-Type, Accept, Authorization, x-functions-key',
+        'Access-Control-Expose-Headers': 'Retry-After, X-RateLimit-Remaining-Minute, X-RateLimit-Remaining-Day'
     }
     return headers
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Process-wide counters, e.g. cache hits and the latency and tokens they saved.
+# Every worker counts on its own: the counters are logged every
+# METRICS_LOG_SECONDS and the metrics function returns those of the worker
+# that serves it.
+
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+MetricsLogSeconds = float(os.getenv('METRICS_LOG_SECONDS', '300'))
+# Latest durations kept per timing for its percentiles.
+TimingSamples = 1024
+
+_counters: dict[str, float] = {}
+_timings: dict[str, deque] = {}
+_lock = threading.Lock()
+_lastLog = time.monotonic()
+
+def incr(name: str, value: float = 1) -> None:
+    global _lastLog
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+        now = time.monotonic()
+        if MetricsLogSeconds <= 0 or now - _lastLog < MetricsLogSeconds:
+            return
+        _lastLog = now
+        counters = dict(_counters)
+    logging.info(f'Metrics: {json.dumps(counters, sort_keys=True)}')
+
+# Record a duration, counted in name.count and name.ms.
+def observe(name: str, ms: float) -> None:
+    with _lock:
+        samples = _timings.get(name)
+        if samples is None:
+            samples = _timings[name] = deque(maxlen=TimingSamples)
+        samples.append(ms)
+    incr(f'{name}.count')
+    incr(f'{name}.ms', ms)
+
+def snapshot() -> dict[str, float]:
+    with _lock:
+        return dict(_counters)
+
+# Percentiles of the latest durations of every timing.
+def timings() -> dict[str, dict[str, float]]:
+    with _lock:
+        samples = {name: sorted(values) for name, values in _timings.items()}
+    return {name: {
+        "samples": len(ordered),
+        "p50Ms": _percentile(ordered, 50),
+        "p95Ms": _percentile(ordered, 95),
+        "p99Ms": _percentile(ordered, 99),
+    } for name, ordered in samples.items()}
+
+def _percentile(ordered: list[float], p: float) -> float:
+    return round(ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))], 2)
+
+def reset() -> None:
+    with _lock:
+        _counters.clear()
+        _timings.clear()
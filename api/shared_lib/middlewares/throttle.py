@@ -1,25 +1,53 @@
+import asyncio
 import base64
+from contextvars import ContextVar
 from functools import wraps
 import json
 import logging
 import os
 from shared_lib.handler import CreateCORSResponseHeaders, Response
+from shared_lib.types.errors import AuthError, QuotaExceededError
 from shared_lib.types.models import UserInfo
-from shared_lib.db import PersistenceLayer
-from shared_lib.cache.redis import QuoteState
+from shared_lib.db import AsyncPersistenceLayer
+from shared_lib.cache.local import SingleFlight
+from shared_lib.cache.redis import QuoteState, TokenQuota
+from shared_lib.tracing import stage, traced
+from shared_lib.user import UserValidate
 
 from shared_lib.cache import RedisClientInst
 import azure.functions as azfunc
-from azure.data.tables import TableServiceClient
 
-db = PersistenceLayer()
+# "requests" charges one unit of the daily QuoteInDay of the user per request,
+# "tokens" charges the tokens of the upstream calls against per-minute and
+# per-day token budgets, see TokenQuotaScript.
+QuotaRequests = 'requests'
+QuotaTokens = 'tokens'
+QuotaMode = os.getenv('QUOTA_MODE', QuotaRequests)
+# Tokens reserved at the check of a request in tokens mode, settled with its
+# actual usage when it returns.
+QuotaTokenReservation = int(os.getenv('QUOTA_TOKEN_RESERVATION', '2000'))
 
+db = AsyncPersistenceLayer()
 
+# Quota check of the request being handled, started by RedisThrottle.
+_quotaCheck: ContextVar[asyncio.Future | None] = ContextVar('quotaCheck', default=None)
+# Tokens used by the request being handled, see recordTokenUsage.
+_tokenUsage: ContextVar[list[int] | None] = ContextVar('tokenUsage', default=None)
+# Email of the user of the request being handled, see currentUser.
+_currentUser: ContextVar[str] = ContextVar('currentUser', default='')
+
+
+# Wraps an async function trigger. The quota check starts before the function
+# runs and goes on concurrently with it, the function calls waitForQuota()
+# before it spends quota, e.g. right before the upstream call, so independent
+# work like loading the session overlaps the Redis round trip. Every call is
+# traced, see shared_lib.tracing.
 def RedisThrottle(func):
-    @wraps(func)
-    def main(*args, **kwargs):
-        logging.info('Throttle middleware before function execution')
-        logging.info('args: ' + str(args) + 'kwargs: ' + str(kwargs))
+    if not asyncio.iscoroutinefunction(func):
+        raise TypeError(f'RedisThrottle wraps async functions, {func.__name__} is not')
+
+    async def throttled(*args, **kwargs):
+        logging.debug('Throttle middleware before function execution, args: %s kwargs: %s', args, kwargs)
         req = None
         # find func.Request
         for arg in args:
@@ -36,29 +64,118 @@ def RedisThrottle(func):
             raise ValueError("Couldn't find func.HttpRequest in args or kwargs")
 
         # find user email
-        upn = getUserNameFromRequest(req)
-        logging.info(f"Message from User email: {upn}")
-        passed = checkQuote(upn)
-        if not passed:
-            errResp = Response()
-            errResp.code = -1
-            errResp.message = f"API quote for user {upn} is exceeded, please contact admin lewis0204@outlook.com or wait 24 hours."
-            errResp.data = None
-            
-            return azfunc.HttpResponse(
-                body=errResp.toJson(),
-                status_code=200,
-                headers=CreateCORSResponseHeaders(),
-            )
-
         try:
-            result = func(*args, **kwargs)
+            with stage('auth'):
+                upn = await authenticateRequest(req)
+        except AuthError as ex:
+            return unauthorizedResponse(ex)
+        logging.debug('Message from User email: %s', upn)
+        quotaCheck = asyncio.ensure_future(runQuotaCheck(upn))
+        usage = [0]
+        token = _quotaCheck.set(quotaCheck)
+        usageToken = _tokenUsage.set(usage)
+        userToken = _currentUser.set(upn)
+        result = None
+        try:
+            result = await func(*args, **kwargs)
+            # The function may return without waiting, e.g. for the version probe
+            await waitForQuota()
+        except QuotaExceededError as ex:
+            return quotaExceededResponse(upn, ex.retryAfter)
         except Exception as ex:
             logging.error(f"Exception occurred in function {func.__name__}: {ex}")
             raise ex
-        logging.info("Throttle middleware after function execution")
+        finally:
+            _quotaCheck.reset(token)
+            _tokenUsage.reset(usageToken)
+            _currentUser.reset(userToken)
+            if QuotaMode == QuotaTokens:
+                # Also after a failure, so its reservation is given back
+                with stage('quotaCharge'):
+                    await settleTokenUsage(upn, quotaCheck, usage[0], result)
+            elif not quotaCheck.done():
+                quotaCheck.cancel()
+        logging.debug('Throttle middleware after function execution')
         return result
-    return main
+    return wraps(func)(traced(throttled, func.__module__))
+
+# Wait for the quota check of the current request, raise QuotaExceededError if
+# the user has no quota left.
+async def waitForQuota() -> None:
+    quotaCheck = _quotaCheck.get()
+    if quotaCheck is None:
+        raise RuntimeError("waitForQuota called outside of RedisThrottle")
+    quota = await quotaCheck
+    if not quota:
+        raise QuotaExceededError(quota.retryAfter if isinstance(quota, TokenQuota) else None)
+
+# Email of the authenticated user of the current request, '' outside of RedisThrottle.
+def currentUser() -> str:
+    return _currentUser.get()
+
+# Add tokens the current request used upstream, charged when it returns.
+def recordTokenUsage(tokens: int) -> None:
+    usage = _tokenUsage.get()
+    if usage is not None:
+        usage[0] += tokens
+
+# Settle the reservation of the request with the tokens it used: the
+# difference is charged, or refunded if it used less.
+async def settleTokenUsage(upn: str, quotaCheck: asyncio.Future, tokens: int, result: azfunc.HttpResponse | None) -> None:
+    try:
+        reservation = await quotaCheck
+    except Exception as ex:
+        # Nothing was reserved, the request failed without an answer
+        logging.error(f"Token quota check of user {upn} failed: {ex}")
+        return
+    if not reservation.reserved and tokens <= 0:
+        return
+    try:
+        quota = await RedisClientInst.SettleUserTokens(userId=upn, tokens=tokens, reservation=reservation)
+    except Exception as ex:
+        # The answer is already there, a failed charge must not lose it
+        logging.error(f"Charge {tokens} tokens to user {upn} failed: {ex}")
+        return
+    if isinstance(result, azfunc.HttpResponse):
+        result.headers['X-RateLimit-Remaining-Minute'] = str(quota.remainingMinute)
+        result.headers['X-RateLimit-Remaining-Day'] = str(quota.remainingDay)
+
+def quotaExceededResponse(upn: str, retryAfter: int | None = None) -> azfunc.HttpResponse:
+    errResp = Response()
+    errResp.code = -1
+    errResp.data = None
+    headers = CreateCORSResponseHeaders()
+
+    if retryAfter is None:
+        errResp.message = f"API quote for user {upn} is exceeded, please contact admin lewis0204@outlook.com or wait 24 hours."
+        statusCode = 200
+    else:
+        errResp.message = f"Token quota for user {upn} is exceeded, retry after {retryAfter} seconds."
+        errResp.data = {"retryAfter": retryAfter}
+        headers['Retry-After'] = str(retryAfter)
+        statusCode = 429
+
+    return azfunc.HttpResponse(
+        body=errResp.toJson(),
+        status_code=statusCode,
+        headers=headers,
+    )
+
+def unauthorizedResponse(ex: AuthError) -> azfunc.HttpResponse:
+    return azfunc.HttpResponse(
+        f"Auth failed: {ex}",
+        status_code=401,
+        headers=CreateCORSResponseHeaders(),
+    )
+
+# Requests signed in through the platform carry X-MS-CLIENT-PRINCIPAL, others
+# must send a token issued by userLogin or userCreate as bearer token.
+# Return the user email, raise AuthError if the request is not authenticated.
+async def authenticateRequest(req: azfunc.HttpRequest) -> str:
+    if req.headers.get("X-MS-CLIENT-PRINCIPAL"):
+        return getUserNameFromRequest(req)
+    user = await UserValidate(req.headers.get('Authorization', '').split(' ')[-1])
+    return user.Email
 
 # User principle in header X-MS-CLIENT-PRINCIPAL format like:
 # {
@@ -74,8 +191,6 @@ def RedisThrottle(func):
 # }
 # get typ is 'preferred_username' in 'claims'
 def getUserNameFromRequest(req: azfunc.HttpRequest) -> str:
-    token = req.headers['Authorization'].split(' ')[-1]
-    logging.info('Receive auth token: ' + token)
     userPrincipleBytes = base64.b64decode(req.headers.get("X-MS-CLIENT-PRINCIPAL"))
     userClaims = json.loads(userPrincipleBytes.decode('utf8'), strict=False)
     
@@ -83,21 +198,68 @@ def getUserNameFromRequest(req: azfunc.HttpRequest) -> str:
     for claimsItem in userClaims['claims']:
         if claimsItem['typ'] == 'preferred_username':
             return claimsItem['val']
-    logging.warning("No user email found in token: " + userClaims)
+    logging.warning(f"No user email found in token, claim types: {[claimsItem.get('typ') for claimsItem in userClaims['claims']]}")
     raise ValueError("Couldn't find user email in token")
 
 
-def checkQuote(userId: str) -> bool:
-    state = RedisClientInst.CheckUserQuote(userId=userId)
+# Quota check of the mode set in QUOTA_MODE.
+async def runQuotaCheck(userId: str) -> bool | TokenQuota:
+    with stage('quota'):
+        if QuotaMode == QuotaTokens:
+            return await checkTokenQuota(userId)
+        return await checkQuote(userId)
+
+# Reserve the tokens a request is expected to use, so concurrent requests of a
+# user can't all pass the check of the same remaining budget.
+async def checkTokenQuota(userId: str) -> TokenQuota:
+    return await RedisClientInst.ReserveUserTokens(userId=userId, tokens=QuotaTokenReservation)
+
+# Attempts to wait for another worker that loads a missing quota
+QuotaInitAttempts = 5
+QuotaInitWaitSeconds = 0.2
+
+# Loads of missing quotas in this worker, one per user.
+quotaInitFlight = SingleFlight()
+
+async def checkQuote(userId: str) -> bool:
+    state = await RedisClientInst.CheckUserQuote(userId=userId)
+    if state == QuoteState.NOTEXIST:
+        await quotaInitFlight.do(userId, lambda: initUserQuote(userId))
+        state = await RedisClientInst.CheckUserQuote(userId=userId)
+        if state == QuoteState.NOTEXIST:
+            logging.warning(f'Quota of user {userId} is still missing after loading it')
+            return True
     if state == QuoteState.EXCEEDED:
         return False
-    if state == QuoteState.NOTEXIST:
-        userInfo = db.retrieveUser(userId=userId)
-        if not userInfo:
-            userInfo = UserInfo(email=userId)
-            db.saveUser(user=userInfo)
-        RedisClientInst.SetUserQuote(userInfo.Email, userInfo.QuoteInDay)
-        return True
     if state == QuoteState.OK:
         return True
     return False
+
+# Take units of the daily quota at once, returns how many the user had left of them.
+async def claimQuote(userId: str, units: int) -> int:
+    if units <= 0:
+        return 0
+    claimed = await RedisClientInst.ClaimUserQuote(userId=userId, units=units)
+    if claimed == QuoteState.NOTEXIST:
+        await quotaInitFlight.do(userId, lambda: initUserQuote(userId))
+        claimed = await RedisClientInst.ClaimUserQuote(userId=userId, units=units)
+        if claimed == QuoteState.NOTEXIST:
+            logging.warning(f'Quota of user {userId} is still missing after loading it')
+            return units
+    return int(claimed) # type: ignore
+
+# Load the daily quota of a user into Redis. Across workers, the one that takes
+# the init lock reads the user table, the others wait for the quota to appear
+# and only load it themselves if it doesn't.
+async def initUserQuote(userId: str) -> None:
+    if not await RedisClientInst.LockUserQuoteInit(userId=userId):
+        for _ in range(QuotaInitAttempts):
+            await asyncio.sleep(QuotaInitWaitSeconds)
+            if await RedisClientInst.UserQuoteExists(userId=userId):
+                return
+    userInfo = await db.retrieveUser(userId=userId)
+    if not userInfo:
+        # Saved without a password hash, no password logs this user in
+        userInfo = UserInfo(email=userId)
+        await db.saveUser(user=userInfo)
+    await RedisClientInst.SetUserQuote(userInfo.Email, userInfo.QuoteInDay, nx=True)
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+# bcrypt cost factor of new hashes. Hashes of a lower cost are upgraded on the
+# next successful login.
+BcryptRounds = int(os.getenv('BCRYPT_ROUNDS', '12'))
+# Threads that run bcrypt, the event loop never hashes itself.
+BcryptWorkers = int(os.getenv('BCRYPT_WORKERS', '4'))
+
+_pool: ThreadPoolExecutor | None = None
+_dummyHash: bytes | None = None
+
+def _getPool() -> ThreadPoolExecutor:
+    global _pool
+    if _pool is None:
+        _pool = ThreadPoolExecutor(max_workers=BcryptWorkers, thread_name_prefix='bcrypt')
+    return _pool
+
+def _asBytes(value: str | bytes) -> bytes:
+    if isinstance(value, str):
+        return value.encode()
+    return value
+
+# bcrypt is imported by the first hash or check, in a worker thread, so the
+# cold start of functions that never check a password skips it.
+def hashPassword(password: str) -> bytes:
+    import bcrypt
+    return bcrypt.hashpw(password.encode(), bcrypt.gensalt(rounds=BcryptRounds))
+
+# Salt part of a bcrypt hash, "$2b$<rounds>$" followed by 22 characters.
+def saltOf(hashedPassword: bytes) -> bytes:
+    return hashedPassword[:29]
+
+def verifyPassword(password: str, hashedPassword: str | bytes) -> bool:
+    if not hashedPassword:
+        return False
+    import bcrypt
+    return bcrypt.checkpw(password.encode(), _asBytes(hashedPassword))
+
+# Hash of a random password at the current cost, checked for logins of unknown
+# emails so they take as long as a wrong password of a registered one.
+def _getDummyHash() -> bytes:
+    global _dummyHash
+    if _dummyHash is None:
+        _dummyHash = hashPassword(os.urandom(16).hex())
+    return _dummyHash
+
+def verifyDummyPassword(password: str) -> bool:
+    verifyPassword(password, _getDummyHash())
+    return False
+
+def needsRehash(hashedPassword: str | bytes) -> bool:
+    try:
+        rounds = int(_asBytes(hashedPassword).split(b'$')[2])
+    except (IndexError, ValueError):
+        return True
+    return rounds < BcryptRounds
+
+async def hashPasswordAsync(password: str) -> bytes:
+    return await asyncio.get_running_loop().run_in_executor(_getPool(), hashPassword, password)
+
+async def verifyPasswordAsync(password: str, hashedPassword: str | bytes) -> bool:
+    return await asyncio.get_running_loop().run_in_executor(_getPool(), verifyPassword, password, hashedPassword)
+
+async def verifyDummyPasswordAsync(password: str) -> bool:
+    return await asyncio.get_running_loop().run_in_executor(_getPool(), verifyDummyPassword, password)
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+from shared_lib.tokens import countMessageTokens, getCompactionThreshold, getTokenBudget
+
+# Compaction keeps the last turns of a chat verbatim and folds the older ones
+# into a running summary, the first context entry. Prompts then stay within
+# the summary, the kept turns and the new turn however long a chat gets.
+# At most this many turns are kept, fewer if they take more than half the
+# compaction threshold.
+CompactionKeepTurns = int(os.getenv('COMPACTION_KEEP_TURNS', '4'))
+# Share of the token budget the running summary may take.
+SummaryTokenRatio = float(os.getenv('COMPACTION_SUMMARY_TOKEN_RATIO', '0.1'))
+
+SummaryPrefix = 'Summary of the conversation so far:\n'
+SummaryInstruction = ('You maintain the running summary of a chat between a user and an assistant. '
+    'Merge the new messages into the summary. Keep names, numbers, decisions, open questions and '
+    'anything the user asked to remember; drop small talk. Answer with the summary only, '
+    'in the language of the chat, in at most {words} words.')
+
+def getSummaryTokenBudget(model: str | None = None) -> int:
+    return max(1, int(getTokenBudget(model) * SummaryTokenRatio))
+
+# Split a context for compaction. Returns the running summary ('' if there is
+# none), the number of leading system entries kept in place, the index of the
+# first entry after the summary, and the index of the first entry that is kept
+# verbatim; the entries between are folded into the summary. Turns start at
+# user entries.
+# Leading system entries are prompts the client sent with the session; only an
+# entry after them that starts with SummaryPrefix is the running summary.
+# Sessions compacted by older versions start with their summary as a system
+# entry without the prefix, it is kept in place like a prompt.
+def splitContext(context: list[dict], tokenCounts: list[int], model: str | None = None) -> tuple[str, int, int, int]:
+    summary = ''
+    pinned = 0
+    while pinned < len(context) and context[pinned].get('role') == 'system' and \
+            not isSummaryEntry(context[pinned]):
+        pinned += 1
+    start = pinned
+    if start < len(context) and isSummaryEntry(context[start]):
+        summary = context[start].get('content', '').removeprefix(SummaryPrefix)
+        start += 1
+    recentBudget = getCompactionThreshold(model) // 2
+    keepFrom = len(context)
+    keptTurns = 0
+    keptTokens = 0
+    for i in range(len(context) - 1, start - 1, -1):
+        keptTokens += tokenCounts[i]
+        if context[i].get('role') != 'user':
+            continue
+        # The last turn is always kept, the answer the user just got stays as it was
+        if keptTurns > 0 and (keptTurns >= CompactionKeepTurns or keptTokens > recentBudget):
+            break
+        keepFrom = i
+        keptTurns += 1
+    return summary, pinned, start, keepFrom
+
+# Group the entries to fold so that each summary prompt, with the summary so
+# far and the room for the new one, fits the token budget of the model.
+def foldBatches(entries: list[dict], tokenCounts: list[int], model: str | None = None) -> list[list[dict]]:
+    summaryBudget = getSummaryTokenBudget(model)
+    # Instruction, the summary so far and the new summary
+    limit = max(summaryBudget, getTokenBudget(model) - 3 * summaryBudget)
+    batches: list[list[dict]] = [[]]
+    batchTokens = 0
+    for entry, count in zip(entries, tokenCounts):
+        if batches[-1] and batchTokens + count > limit:
+            batches.append([])
+            batchTokens = 0
+        batches[-1].append(entry)
+        batchTokens += count
+    return [batch for batch in batches if batch]
+
+# Messages that ask the model to fold entries into the summary so far.
+def summaryPrompt(summary: str, entries: list[dict], model: str | None = None) -> list[dict]:
+    # Roughly three words per four tokens
+    words = getSummaryTokenBudget(model) * 3 // 4
+    lines = [f"{entry.get('role', 'user')}: {entry.get('content', '')}" for entry in entries]
+    content = ''
+    if summary:
+        content = f'Summary so far:\n{summary}\n\n'
+    content += 'New messages:\n' + '\n\n'.join(lines)
+    return [
+        {"role": "system", "content": SummaryInstruction.format(words=words)},
+        {"role": "user", "content": content},
+    ]
+
+def summaryEntry(summary: str) -> dict:
+    return {"role": "system", "content": SummaryPrefix + summary}
+
+def isSummaryEntry(entry: dict) -> bool:
+    return entry.get('role') == 'system' and str(entry.get('content', '')).startswith(SummaryPrefix)
+
+# Token estimate of a summary call whose usage was not reported.
+def summaryCallTokens(prompt: list[dict], summary: str) -> int:
+    return sum(countMessageTokens(item) for item in prompt) + countMessageTokens({"content": summary})
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+import os
+import threading
+import time
+from shared_lib import codec
+
+# Context window of a model deployment, in tokens. Keys match deployment names
+# by prefix, the longest match wins. Override or extend with MODEL_TOKEN_BUDGETS,
+# e.g. '{"my-gpt4-deployment": 8192}'.
+ModelTokenBudgets = {
+    'gpt-35-turbo': 4096,
+    'gpt-35-turbo-16k': 16384,
+    'gpt-3.5-turbo': 4096,
+    'gpt-3.5-turbo-16k': 16384,
+    'gpt-4': 8192,
+    'gpt-4-32k': 32768,
+}
+ModelTokenBudgets.update(json.loads(os.getenv('MODEL_TOKEN_BUDGETS', '{}')))
+DefaultTokenBudget = int(os.getenv('DEFAULT_TOKEN_BUDGET', '4096'))
+# Chats are compacted once their context takes this share of the budget, the
+# rest is left for the next prompt and the answer.
+CompactionTokenRatio = float(os.getenv('COMPACTION_TOKEN_RATIO', '0.75'))
+
+# Every chat message costs a few tokens of framing besides its content.
+TokensPerMessage = 4
+# Rough size of a token when no tokenizer is available.
+CharsPerToken = 4
+
+# BPE file of the tokenizer, shipped with the app by tools.fetch_tokenizer.
+# tiktoken names cached files by the sha1 of their URL. Without the file
+# tiktoken downloads it on first use.
+TokenizerCacheDir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'tiktoken_cache')
+TokenizerCacheFile = '9b5ad71b2ce5302211f9c61530b329a4922fc6a4'
+# A failed load is tried again after this many seconds, token counts are
+# estimated meanwhile.
+TokenizerRetrySeconds = float(os.getenv('TOKENIZER_RETRY_SECONDS', '60'))
+
+_encoding = None
+_encodingFailedAt: float | None = None
+_encodingLock = threading.Lock()
+
+def _getEncoding():
+    global _encoding, _encodingFailedAt
+    if _encoding is not None or not _encodingDue():
+        return _encoding
+    # Callers wait for a load in progress, e.g. the one started by preloadEncoding
+    with _encodingLock:
+        if _encoding is None and _encodingDue():
+            try:
+                if os.path.exists(os.path.join(TokenizerCacheDir, TokenizerCacheFile)):
+                    os.environ.setdefault('TIKTOKEN_CACHE_DIR', TokenizerCacheDir)
+                import tiktoken
+                # All chat models use the same encoding, deployment names are not model names.
+                _encoding = tiktoken.get_encoding('cl100k_base')
+                _encodingFailedAt = None
+            except Exception as ex:
+                _encodingFailedAt = time.monotonic()
+                logging.warning(f'Tokenizer unavailable, estimating token counts for {TokenizerRetrySeconds}s: {ex}')
+    return _encoding
+
+def _encodingDue() -> bool:
+    return _encodingFailedAt is None or time.monotonic() - _encodingFailedAt >= TokenizerRetrySeconds
+
+# Load the tokenizer in the background when a function that counts tokens is
+# loaded, so its first chat turn doesn't wait for it.
+def preloadEncoding() -> None:
+    threading.Thread(target=_getEncoding, name='tokenizer', daemon=True).start()
+
+def countTokens(text: str) -> int:
+    if not text:
+        return 0
+    encoding = _getEncoding()
+    if encoding is None:
+        return (len(text) + CharsPerToken - 1) // CharsPerToken
+    return len(encoding.encode(text, disallowed_special=()))
+
+def countMessageTokens(item: dict) -> int:
+    return TokensPerMessage + countTokens(item.get('role', '')) + countTokens(item.get('content', ''))
+
+def getTokenBudget(model: str | None = None) -> int:
+    if model is None:
+        model = os.getenv('CHATGPT_MODEL', '')
+    matches = [name for name in ModelTokenBudgets if model.startswith(name)]
+    if len(matches) == 0:
+        return DefaultTokenBudget
+    return ModelTokenBudgets[max(matches, key=len)]
+
+# Chats are compacted while their session row still holds them twice over,
+# which leaves room for escapes and for the turns saved until the compaction
+# job runs, see codec.contextCapacityChars.
+def getCompactionThreshold(model: str | None = None) -> int:
+    threshold = int(getTokenBudget(model) * CompactionTokenRatio)
+    capacity = codec.contextCapacityChars()
+    if capacity is None:
+        return threshold
+    return min(threshold, capacity // CharsPerToken // 2)
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Stage timings of requests. Every stage is observed in shared_lib.metrics,
+# e.g. stage.upstream, whose percentiles the metrics function returns. A
+# TRACE_SAMPLE_RATE share of the requests also logs one line with the stages
+# of that request.
+
+import json
+import logging
+import os
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar, Token
+from functools import wraps
+from shared_lib import metrics
+
+TraceSampleRate = float(os.getenv('TRACE_SAMPLE_RATE', '0.01'))
+
+# Stage durations of the request being handled, see startTrace.
+_trace: ContextVar[dict | None] = ContextVar('trace', default=None)
+
+# Time the enclosed code as stage name of the current request.
+@contextmanager
+def stage(name: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, (time.perf_counter() - start) * 1000)
+
+# Add a stage timed by the caller, e.g. one that is only recorded if it succeeds.
+def record(name: str, ms: float) -> None:
+    metrics.observe(f'stage.{name}', ms)
+    trace = _trace.get()
+    if trace is not None:
+        trace['stages'][name] = round(trace['stages'].get(name, 0) + ms, 2)
+
+# Start the trace of a request. Tasks it starts share the trace.
+def startTrace(function: str) -> Token:
+    return _trace.set({"function": function, "start": time.perf_counter(), "stages": {}})
+
+# End the trace of a request, log it if it is sampled.
+def endTrace(token: Token, **fields) -> None:
+    trace = _trace.get()
+    _trace.reset(token)
+    if trace is None:
+        return
+    totalMs = (time.perf_counter() - trace['start']) * 1000
+    metrics.observe(f"request.{trace['function']}", totalMs)
+    if TraceSampleRate > 0 and random.random() < TraceSampleRate:
+        logging.info('Trace: ' + json.dumps({
+            "function": trace['function'],
+            "totalMs": round(totalMs, 2),
+            "stages": trace['stages'],
+            **fields,
+        }, sort_keys=True))
+
+# Trace every call of an async function trigger, named after the module of
+# the trigger, with the status code of its response.
+def traced(func, function: str | None = None):
+    @wraps(func)
+    async def main(*args, **kwargs):
+        trace = startTrace(function or func.__module__)
+        result = None
+        try:
+            result = await func(*args, **kwargs)
+            return result
+        finally:
+            endTrace(trace, status=getattr(result, 'status_code', None))
+    return main
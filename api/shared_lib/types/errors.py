@@ -4,3 +4,14 @@
 class AuthError(Exception):
     """Raised when authentication failed."""
     pass
+
+class ContextTooLargeError(ValueError):
+    """Raised when a session context is too large for its session row."""
+    pass
+
+class QuotaExceededError(Exception):
+    """Raised when the user has no API quota left."""
+    def __init__(self, retryAfter: int | None = None) -> None:
+        super().__init__()
+        # Seconds until quota is available again, if known
+        self.retryAfter = retryAfter
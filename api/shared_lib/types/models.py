@@ -7,7 +7,7 @@ import json
 import logging
 import zlib
 
-import bcrypt
+from shared_lib import passwords
 
 class MetaEnum(EnumMeta):
     def __contains__(cls, item):
@@ -40,32 +40,43 @@ class UserInfo:
         self.Password = password
         self.QuoteInDay = quoteInDay
 
-    def toJson(self) -> str:
+    # compact writes toDict on one line, without the password.
+    def toJson(self, compact: bool = False) -> str:
+        if compact:
+            return json.dumps(self.toDict(), ensure_ascii=False, separators=(',', ':'))
         return json.dumps(self, default=lambda o: o.__dict__, 
             sort_keys=True, indent=2)
 
+    # Public fields of the user, as stored by toTableEntity except the password.
+    def toDict(self) -> dict:
+        return {key: value for key, value in self.__dict__.items() if key != "Password" and not key.startswith("_")}
+
     def fromJson(self, jsonDict: dict) -> None:
         for key in jsonDict:
             if key not in self.__dict__ and not key.startswith("_"):
                 self.__dict__[key] = jsonDict[key]
 
-    def toTableEntity(self) -> dict:
+    # hashedPassword is the bcrypt hash of Password if the caller already has
+    # one, e.g. from the hashing thread pool. Otherwise Password is hashed here.
+    # A user without password, e.g. created by the throttle, gets an empty hash
+    # that no password matches.
+    def toTableEntity(self, hashedPassword: bytes | None = None) -> dict:
         # Hash the email to generate the PartitionKey
         partition_key = UserInfo.generatePartitionKey(self.Email)
 
         # Set the RowKey to the email
         row_key = self.Email
 
-        # Generate a random salt
-        salt = bcrypt.gensalt()
-
-        # Hash the password with the salt
-        hashed_password = bcrypt.hashpw(self.Password.encode(), salt)
+        # Hash the password with a random salt
+        if hashedPassword is not None:
+            hashed_password = hashedPassword
+        else:
+            hashed_password = passwords.hashPassword(self.Password) if self.Password else b''
 
         entity = {
             "PartitionKey": partition_key,
             "RowKey": row_key,
-            "Salt": salt,
+            "Salt": passwords.saltOf(hashed_password),
             "HashedPassword": hashed_password,
             "CreatedAt": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         }
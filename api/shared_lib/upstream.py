@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Pool of OpenAI endpoints the chat completions are spread over. A request goes
+# to the endpoint with the better score of two picked by weight, where the
+# score grows with its recent latency, error rate and calls in flight. An
+# endpoint that keeps failing is left out until its circuit breaker lets a
+# probe through again, and a failed call is retried with jittered backoff on
+# another endpoint.
+
+import asyncio
+import json
+import logging
+import os
+import random
+import time
+from typing import Awaitable, Callable, TypeVar
+from shared_lib import metrics
+
+# Endpoints as a JSON list, e.g.
+# [{"name": "east", "apiBase": "https://east.openai.azure.com", "apiKey": "...", "deployment": "gpt-35", "weight": 2}]
+# apiType, apiVersion and deployment default to OPENAI_API_TYPE,
+# OPENAI_API_VERSION and CHATGPT_MODEL. Unset, the pool holds the single
+# endpoint of OPENAI_API_BASE.
+UpstreamEndpoints = os.getenv('OPENAI_ENDPOINTS', '')
+# Attempts per request, each on another endpoint while there is one left.
+UpstreamMaxAttempts = int(os.getenv('UPSTREAM_MAX_ATTEMPTS', '3'))
+# Backoff before attempt n is random between 0 and min(max, base * 2^n).
+UpstreamBackoffSeconds = float(os.getenv('UPSTREAM_BACKOFF_SECONDS', '0.2'))
+UpstreamMaxBackoffSeconds = float(os.getenv('UPSTREAM_MAX_BACKOFF_SECONDS', '2'))
+# Consecutive failures that open the breaker of an endpoint, and for how long.
+UpstreamBreakerFailures = int(os.getenv('UPSTREAM_BREAKER_FAILURES', '5'))
+UpstreamBreakerSeconds = float(os.getenv('UPSTREAM_BREAKER_SECONDS', '30'))
+# Timeout of one upstream call, 0 for none.
+UpstreamTimeoutSeconds = float(os.getenv('UPSTREAM_TIMEOUT_SECONDS', '120'))
+# Weight of the latest call in the latency and error rate averages.
+StatsDecay = 0.2
+# An endpoint failing every call scores this many times its latency.
+ErrorPenalty = 10
+
+T = TypeVar('T')
+
+def isRetryable(err: Exception) -> bool:
+    # The failed upstream call has loaded openai already
+    import openai
+    # Failures of the endpoint rather than of the request, worth another endpoint.
+    if isinstance(err, (
+            openai.error.RateLimitError, # type: ignore
+            openai.error.ServiceUnavailableError, # type: ignore
+            openai.error.Timeout, # type: ignore
+            openai.error.APIConnectionError, # type: ignore
+            openai.error.TryAgain)): # type: ignore
+        return True
+    # Server errors of the endpoint, not rejections of the request
+    return isinstance(err, openai.error.APIError) and (err.http_status or 500) >= 500 # type: ignore
+
+# Seconds the endpoint asked us to wait, e.g. with a 429.
+def retryAfterOf(err: Exception) -> float | None:
+    headers = getattr(err, 'headers', None) or {}
+    try:
+        return float(headers.get('retry-after') or headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        return None
+
+class UpstreamEndpoint:
+    def __init__(self, name: str, apiBase: str | None = None, apiKey: str | None = None, deployment: str | None = None,
+            apiType: str | None = None, apiVersion: str | None = None, weight: float = 1) -> None:
+        self.name = name
+        self.apiBase = apiBase
+        self.apiKey = apiKey
+        self.deployment = deployment or os.getenv('CHATGPT_MODEL')
+        self.apiType = apiType or os.getenv('OPENAI_API_TYPE')
+        self.apiVersion = apiVersion or os.getenv('OPENAI_API_VERSION')
+        self.weight = weight
+        # Averages of recent calls, latency in seconds. 0 until the first call
+        # returns, so new endpoints are tried early.
+        self.latency = 0.0
+        self.errorRate = 0.0
+        self.inflight = 0
+        # Circuit breaker: open while openUntil is ahead, then one probe at a time
+        self.failures = 0
+        self.openUntil = 0.0
+        self.probing = False
+
+    # Keyword arguments of openai.ChatCompletion.create for this endpoint.
+    def requestArgs(self) -> dict:
+        args = {
+            "engine": self.deployment,
+            "api_key": self.apiKey,
+            "api_base": self.apiBase,
+            "api_type": self.apiType,
+            "api_version": self.apiVersion,
+        }
+        if UpstreamTimeoutSeconds > 0:
+            args['request_timeout'] = UpstreamTimeoutSeconds
+        return args
+
+    def score(self) -> float:
+        return (self.latency + 0.001) * (self.inflight + 1) * (1 + ErrorPenalty * self.errorRate)
+
+    def isAvailable(self, now: float) -> bool:
+        return now >= self.openUntil and not self.probing
+
+    def onStart(self, now: float) -> None:
+        self.inflight += 1
+        # The first call after the breaker opened is its probe
+        if self.failures >= UpstreamBreakerFailures and now >= self.openUntil:
+            self.probing = True
+
+    # Every started call ends here, whether it succeeded, failed or was cancelled.
+    def onEnd(self) -> None:
+        self.inflight -= 1
+        self.probing = False
+
+    def onSuccess(self, latency: float) -> None:
+        self.latency = latency if self.latency == 0 else (1 - StatsDecay) * self.latency + StatsDecay * latency
+        self.errorRate *= 1 - StatsDecay
+        if self.failures >= UpstreamBreakerFailures:
+            logging.info(f'Upstream {self.name} recovered, closing its breaker')
+        self.failures = 0
+
+    def onFailure(self, now: float, retryAfter: float | None = None) -> None:
+        self.errorRate = (1 - StatsDecay) * self.errorRate + StatsDecay
+        self.failures += 1
+        if self.failures >= UpstreamBreakerFailures:
+            self.openUntil = now + UpstreamBreakerSeconds
+            logging.warning(f'Upstream {self.name} failed {self.failures} times in a row, opening its breaker for {UpstreamBreakerSeconds}s')
+            metrics.incr(f'upstream.{self.name}.breakerOpen')
+        if retryAfter:
+            self.openUntil = max(self.openUntil, now + retryAfter)
+
+class UpstreamPool:
+    def __init__(self, endpoints: list[UpstreamEndpoint]) -> None:
+        if not endpoints:
+            raise ValueError('Upstream pool needs at least one endpoint')
+        self.endpoints = endpoints
+
+    # Power of two choices: two endpoints picked by weight, the better scored wins.
+    # Endpoints in exclude, or with an open breaker, are only picked if no other is left.
+    def choose(self, exclude: set[str] | None = None) -> UpstreamEndpoint:
+        now = time.monotonic()
+        exclude = exclude or set()
+        candidates = [endpoint for endpoint in self.endpoints if endpoint.isAvailable(now) and endpoint.name not in exclude]
+        if not candidates:
+            candidates = [endpoint for endpoint in self.endpoints if endpoint.name not in exclude] or self.endpoints
+            # All breakers open: the one that reopens first
+            return min(candidates, key=lambda endpoint: endpoint.openUntil)
+        if len(candidates) == 1:
+            return candidates[0]
+        weights = [endpoint.weight for endpoint in candidates]
+        first, second = random.choices(candidates, weights=weights, k=2)
+        return first if first.score() <= second.score() else second
+
+    # Run call on an endpoint, retrying endpoint failures on others. call gets
+    # the endpoint and must raise the errors of openai.
+    async def call(self, call: Callable[[UpstreamEndpoint], Awaitable[T]]) -> T:
+        tried: set[str] = set()
+        for attempt in range(max(1, UpstreamMaxAttempts)):
+            endpoint = self.choose(tried)
+            tried.add(endpoint.name)
+            start = time.monotonic()
+            endpoint.onStart(start)
+            try:
+                result = await call(endpoint)
+            except Exception as err:
+                if not self._onError(endpoint, err, attempt):
+                    raise
+            else:
+                endpoint.onSuccess(time.monotonic() - start)
+                return result
+            finally:
+                # Also releases the endpoint, and a probe, of a cancelled call
+                endpoint.onEnd()
+            await asyncio.sleep(backoffSeconds(attempt))
+        raise RuntimeError('unreachable')
+
+    # Record a failed call, returns whether to retry it.
+    def _onError(self, endpoint: UpstreamEndpoint, err: Exception, attempt: int) -> bool:
+        # A request that failed on its own, e.g. an invalid one, says nothing about the endpoint.
+        if not isRetryable(err):
+            return False
+        endpoint.onFailure(time.monotonic(), retryAfterOf(err))
+        metrics.incr(f'upstream.{endpoint.name}.failures')
+        if attempt + 1 >= max(1, UpstreamMaxAttempts):
+            return False
+        logging.warning(f'Upstream {endpoint.name} failed, retrying on another endpoint: {err}')
+        metrics.incr('upstream.retries')
+        return True
+
+    def stats(self) -> list[dict]:
+        return [{
+            "name": endpoint.name,
+            "latencyMs": round(endpoint.latency * 1000, 1),
+            "errorRate": round(endpoint.errorRate, 3),
+            "inflight": endpoint.inflight,
+            "breakerOpen": endpoint.openUntil > time.monotonic(),
+        } for endpoint in self.endpoints]
+
+def backoffSeconds(attempt: int) -> float:
+    return random.uniform(0, min(UpstreamMaxBackoffSeconds, UpstreamBackoffSeconds * 2 ** attempt))
+
+def loadEndpoints(config: str = UpstreamEndpoints) -> list[UpstreamEndpoint]:
+    if not config:
+        return [UpstreamEndpoint('default', os.getenv('OPENAI_API_BASE'), os.getenv('OPENAI_API_KEY'))]
+    return [UpstreamEndpoint(
+        name=item.get('name') or f'endpoint{i}',
+        apiBase=item.get('apiBase'),
+        apiKey=item.get('apiKey'),
+        deployment=item.get('deployment'),
+        apiType=item.get('apiType'),
+        apiVersion=item.get('apiVersion'),
+        weight=float(item.get('weight', 1)),
+    ) for i, item in enumerate(json.loads(config))]
+
+upstreamPool = UpstreamPool(loadEndpoints())
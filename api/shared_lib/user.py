@@ -3,36 +3,73 @@
 
 import json
 import logging
-import uuid
-from shared_lib.db import PersistenceLayer
+import os
+import secrets
+from datetime import timedelta
+from shared_lib.cache import RedisClientInst
+from shared_lib.cache.local import LocalCache
+from shared_lib.db import AsyncPersistenceLayer
 from shared_lib.types.errors import AuthError
 
 from shared_lib.types.models import UserInfo
 
+# Lifetime of a user token in Redis
+TokenTtl = timedelta(seconds=int(os.getenv('USER_TOKEN_TTL_SECONDS', str(7 * 24 * 3600))))
+# Validated tokens are kept in process for this long, which bounds how late
+# other workers see a revocation.
+TokenCacheTtlSeconds = float(os.getenv('USER_TOKEN_CACHE_TTL_SECONDS', '30'))
+TokenCacheSize = int(os.getenv('USER_TOKEN_CACHE_SIZE', '10000'))
+
+db = AsyncPersistenceLayer()
+tokenCache = LocalCache(TokenCacheSize, TokenCacheTtlSeconds)
+
 # Return user token if auth success.
 # Otherwise, raise AuthError.
-def UserLogin(Email: str, Password: str) -> str:
-    db = PersistenceLayer()
+async def UserLogin(Email: str, Password: str) -> str:
+    if not Password:
+        raise AuthError("Email or password is incorrect.")
     user = UserInfo(Email, Password)
 
-    isCorrect = db.checkUserPassword(user)
+    isCorrect = await db.checkUserPassword(user)
     if not isCorrect:
         raise AuthError("Email or password is incorrect.")
 
-    # TODO: save usertoken
-    return str(uuid.uuid4())
+    return await issueUserToken(user.Email)
 
-# Create user
-def UserCreate(Email: str, Password: str) -> str:
-    db = PersistenceLayer()
+# Create user, a password is required.
+async def UserCreate(Email: str, Password: str) -> str:
+    if not Password:
+        raise AuthError("Password is missing.")
     user = UserInfo(Email, Password)
 
-    db.saveUser(user)
+    await db.saveUser(user)
+
+    return await issueUserToken(user.Email)
+
+# Validate usertoken, return the user it was issued to.
+# Otherwise, raise AuthError.
+async def UserValidate(UserToken: str) -> UserInfo:
+    if not UserToken:
+        raise AuthError("Token is missing.")
+    email = tokenCache.get(UserToken)
+    if email is None:
+        email = await RedisClientInst.GetTokenUser(UserToken)
+        if email is None:
+            raise AuthError("Token is invalid or expired.")
+        tokenCache.put(UserToken, email)
+    return UserInfo(email)
 
-    # TODO: save usertoken
-    return str(uuid.uuid4())
+# Revoke usertoken, or every token of its user if allDevices is set.
+async def UserLogout(UserToken: str, allDevices: bool = False) -> None:
+    user = await UserValidate(UserToken)
+    tokenCache.pop(UserToken)
+    if allDevices:
+        await RedisClientInst.DeleteUserTokens(user.Email)
+    else:
+        await RedisClientInst.DeleteUserToken(UserToken)
 
-# Validate usertoken
-# TODO
-def UserValidate(UserToken: str) -> UserInfo: # type: ignore
-    pass
+async def issueUserToken(email: str) -> str:
+    token = secrets.token_urlsafe(32)
+    await RedisClientInst.SetUserToken(token, email, TokenTtl)
+    tokenCache.put(token, email)
+    return token
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import asyncio
+import pytest
+from azure.data.tables import RequestTooLargeError, TableTransactionError
+from benchmarks import fakes
+from benchmarks.fakes import AsyncInMemoryTableService
+from shared_lib import batching
+from shared_lib.batching import TableWriteBatcher, failedOperationIndex, splitTransactions
+
+
+def create(rowKey: str, data: bytes = b'') -> tuple:
+    return ('create', {"PartitionKey": 'p', "RowKey": rowKey, "data": data})
+
+
+# Submit every write at once to a batcher with a short delay, returns the
+# results or errors of the writes and the service.
+def submitAll(writes: list[list], service: AsyncInMemoryTableService | None = None) -> tuple[list, AsyncInMemoryTableService]:
+    service = service or AsyncInMemoryTableService()
+
+    async def run() -> list:
+        batcher = TableWriteBatcher(service.get_table_client, delaySeconds=0.01) # type: ignore
+        return await asyncio.gather(*[batcher.submit('t', write) for write in writes], return_exceptions=True)
+    return asyncio.run(run()), service
+
+
+def test_writes_of_a_partition_share_a_transaction():
+    results, service = submitAll([[create(f'r{i}')] for i in range(10)])
+    assert service.calls == 1
+    assert all(len(result) == 1 and 'etag' in result[0] for result in results)
+
+
+def test_batches_are_flushed_before_the_byte_limit(monkeypatch):
+    monkeypatch.setattr(batching, 'MaxBatchBytes', 11000)
+    results, service = submitAll([[create(f'r{i}', b'x' * 3000)] for i in range(6)])
+    # Rows of 4000 bytes in base64 and their overhead, two fit in a transaction
+    assert service.calls == 3
+    assert not any(isinstance(result, Exception) for result in results)
+    assert [len(transaction) for transaction in splitTransactions([create(f'r{i}', b'x' * 3000) for i in range(6)])] == [2, 2, 2]
+
+
+def test_a_failed_entity_only_fails_its_own_write():
+    service = AsyncInMemoryTableService()
+    submitAll([[create('taken')]], service)
+    results, _ = submitAll([[create('r1')], [create('taken')], [create('r2')]], service)
+    assert isinstance(results[1], TableTransactionError)
+    assert failedOperationIndex(results[1]) == 1
+    assert not isinstance(results[0], Exception) and not isinstance(results[2], Exception)
+
+
+def test_too_large_transactions_are_split(monkeypatch):
+    # The service counts more bytes than the estimate of the batcher
+    monkeypatch.setattr(fakes, 'MaxTransactionBytes', 5000)
+    results, service = submitAll([[create(f'r{i}', b'x' * 1500)] for i in range(4)] + [[create('huge', b'x' * 6000)]])
+    assert not any(isinstance(result, Exception) for result in results[:4])
+    assert isinstance(results[4], RequestTooLargeError)
+    stored = [entity['RowKey'] for entity in service.service.get_table_client('t').list_entities()]
+    assert sorted(stored) == ['r0', 'r1', 'r2', 'r3']
+
+
+def test_errors_of_the_whole_transaction_fail_every_write(monkeypatch):
+    def unavailable(self, operations: list, **kwargs) -> list:
+        raise TableTransactionError(message='The server is busy.')
+    monkeypatch.setattr(fakes.InMemoryTableClient, 'submit_transaction', unavailable)
+    results, service = submitAll([[create(f'r{i}')] for i in range(3)])
+    assert service.calls == 1
+    assert all(isinstance(result, TableTransactionError) for result in results)
+    assert failedOperationIndex(results[0]) is None
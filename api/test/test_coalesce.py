@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import asyncio
+import pytest
+from shared_lib import coalesce
+from shared_lib.cache.redis import CacheManager
+from shared_lib.coalesce import CoalesceLocal, CoalesceOff, CoalesceRedis, CoalescedReply, RequestCoalescer
+
+fakeredis = pytest.importorskip('fakeredis')
+
+Body = {"message": "Hello?", "sessionId": "s1"}
+
+
+@pytest.fixture(autouse=True)
+def redisClient(monkeypatch):
+    monkeypatch.setattr(coalesce, 'RedisClientInst', CacheManager(fakeredis.aioredis.FakeRedis(decode_responses=True)))
+    monkeypatch.setattr(coalesce, 'CoalescePollSeconds', 0.01)
+
+
+# A chat turn that counts its runs and answers after a short wait.
+def chatTurn(runs: list, statusCode: int = 200):
+    async def fn() -> CoalescedReply:
+        runs.append(1)
+        await asyncio.sleep(0.05)
+        return CoalescedReply(f'answer {len(runs)}', statusCode)
+    return fn
+
+
+def test_keys_follow_the_session_version():
+    coalescer = RequestCoalescer(CoalesceLocal)
+    key = coalescer.key('alice', 's1', 'v1', Body)
+    assert key == coalescer.key('alice', 's1', 'v1', dict(reversed(Body.items())))
+    assert key != coalescer.key('alice', 's1', 'v2', Body)
+    assert key != coalescer.key('bob', 's1', 'v1', Body)
+    assert coalescer.key('alice', None, None, Body) is None
+    assert RequestCoalescer(CoalesceOff).key('alice', 's1', 'v1', Body) is None
+
+
+def test_duplicates_in_a_worker_share_one_run():
+    async def run() -> None:
+        coalescer, runs = RequestCoalescer(CoalesceLocal), []
+        key = coalescer.key('alice', 's1', 'v1', Body)
+        replies = await asyncio.gather(*[coalescer.do(key, chatTurn(runs)) for _ in range(5)])
+        assert len(runs) == 1
+        assert {reply.body for reply in replies} == {'answer 1'}
+    asyncio.run(run())
+
+
+def test_duplicates_across_workers_wait_for_the_reply():
+    async def run() -> None:
+        workers, runs = [RequestCoalescer(CoalesceRedis) for _ in range(3)], []
+        key = workers[0].key('alice', 's1', 'v1', Body)
+        replies = await asyncio.gather(*[worker.do(key, chatTurn(runs)) for worker in workers])
+        assert len(runs) == 1
+        assert {reply.body for reply in replies} == {'answer 1'}
+    asyncio.run(run())
+
+
+def test_a_failed_request_is_run_again_by_its_duplicate():
+    async def run() -> None:
+        workers, runs = [RequestCoalescer(CoalesceRedis) for _ in range(2)], []
+        key = workers[0].key('alice', 's1', 'v1', Body)
+        first = await workers[0].do(key, chatTurn(runs, statusCode=502))
+        second = await workers[1].do(key, chatTurn(runs))
+        assert (first.statusCode, second.statusCode) == (502, 200)
+        assert len(runs) == 2
+
+        async def fails() -> CoalescedReply:
+            raise RuntimeError('upstream down')
+        key = workers[0].key('alice', 's1', 'v2', Body)
+        with pytest.raises(RuntimeError):
+            await workers[0].do(key, fails)
+        assert (await workers[1].do(key, chatTurn(runs))).body == 'answer 3'
+    asyncio.run(run())
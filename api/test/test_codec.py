@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import pytest
+from shared_lib import codec
+from shared_lib.codec import ContextEncodingBinary, ContextEncodingJson, contextProperties, decodeContext, \
+    encodeContext, isEncodedContext, joinContextProperties
+from shared_lib.db import loadContextAsList
+from shared_lib.types.errors import ContextTooLargeError
+
+Context = [
+    {"role": "system", "content": "You are a helpful assistant."},
+    {"role": "user", "content": "Wie spät ist es in 東京?"},
+    {"role": "assistant", "content": "Es ist 21 Uhr."},
+]
+
+
+# Context of at least size bytes encoded: hex of random bytes compresses to
+# about the bytes it was made of.
+def randomContext(size: int) -> list:
+    return [{"role": "user", "content": os.urandom(size).hex()}]
+
+
+def test_binary_round_trip_of_compressed_and_plain_payloads():
+    long = Context * 50
+    raw = encodeContext(long)
+    assert isEncodedContext(raw)
+    assert raw[len(codec.ContextMagic) + 1] == codec.CodecZlib
+    assert decodeContext(raw) == long
+
+    short = [{"role": "user", "content": "hi"}]
+    raw = encodeContext(short)
+    assert raw[len(codec.ContextMagic) + 1] == codec.CodecPlain
+    assert decodeContext(raw) == short
+
+
+def test_unknown_format_version_is_rejected():
+    raw = bytearray(encodeContext(Context))
+    raw[len(codec.ContextMagic)] = codec.ContextFormatVersion + 1
+    with pytest.raises(ValueError):
+        decodeContext(bytes(raw))
+
+
+def test_json_and_binary_rows_read_back_alike():
+    jsonRow = contextProperties(Context, ContextEncodingJson)
+    binaryRow = contextProperties(Context, ContextEncodingBinary)
+    assert isinstance(jsonRow['context'], str) and not isEncodedContext(jsonRow['context'])
+    assert isEncodedContext(binaryRow['context'])
+    assert loadContextAsList(joinContextProperties(jsonRow)) == Context
+    assert loadContextAsList(joinContextProperties(binaryRow)) == Context
+
+
+def test_long_binary_contexts_are_split_over_chunks():
+    context = randomContext(3 * codec.MaxPropertyBytes)
+    row = contextProperties(context, ContextEncodingBinary)
+    chunks = -(-len(encodeContext(context)) // codec.MaxPropertyBytes)
+    assert row['contextChunks'] == chunks >= 3
+    assert all(len(row[codec.contextChunkName(i)]) <= codec.MaxPropertyBytes for i in range(chunks))
+    assert loadContextAsList(joinContextProperties(row)) == context
+
+
+def test_contexts_larger_than_a_row_are_refused():
+    with pytest.raises(ContextTooLargeError):
+        contextProperties(randomContext((codec.MaxContextChunks + 1) * codec.MaxPropertyBytes), ContextEncodingBinary)
+    # Escaped non-ASCII characters count twice in the UTF-16 of a string property
+    text = 'ä' * (codec.MaxStringPropertyBytes // 12 + 1)
+    assert len(json.dumps(text)) * 2 > codec.MaxStringPropertyBytes
+    with pytest.raises(ContextTooLargeError):
+        contextProperties([{"role": "user", "content": text}], ContextEncodingJson)
+    # ContextTooLargeError is a ValueError, callers catching those still do
+    assert issubclass(ContextTooLargeError, ValueError)
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import asyncio
+import os
+import pytest
+from benchmarks.fakes import AsyncInMemoryTableService, InMemoryTableService
+from shared_lib import codec, tokens
+from shared_lib.codec import ContextEncodingBinary, ContextEncodingJson, SessionStorageTurns, contextProperties
+from shared_lib.compaction import saveTurn
+from shared_lib.db import AsyncPersistenceLayer
+from shared_lib.handler import Message, OpenaiHandler
+from shared_lib.summary import isSummaryEntry
+from shared_lib.types.errors import ContextTooLargeError
+
+
+@pytest.fixture(autouse=True)
+def jsonRows(monkeypatch):
+    monkeypatch.setattr(codec, 'ContextEncoding', ContextEncodingJson)
+    monkeypatch.setattr(codec, 'SessionStorageMode', codec.SessionStorageBlob)
+    monkeypatch.setattr(tokens, 'CompactionTokenRatio', 0.75)
+
+
+def test_compaction_threshold_is_capped_by_the_row_capacity(monkeypatch):
+    # 32768 characters of json context, at 4 characters per token, held twice over
+    assert tokens.getCompactionThreshold('gpt-4-32k') == 4096
+    assert tokens.getCompactionThreshold('gpt-35-turbo') == 3072
+    monkeypatch.setattr(codec, 'ContextEncoding', ContextEncodingBinary)
+    assert tokens.getCompactionThreshold('gpt-4-32k') == 24576
+    monkeypatch.setattr(codec, 'ContextEncoding', ContextEncodingJson)
+    monkeypatch.setattr(codec, 'SessionStorageMode', SessionStorageTurns)
+    assert tokens.getCompactionThreshold('gpt-4-32k') == 24576
+
+
+def test_a_turn_past_the_row_limit_is_compacted_and_saved(monkeypatch):
+    summarized = []
+
+    async def asummarize(self, summary: str, entries: list[dict]) -> str:
+        summarized.extend(entries)
+        return 'the chat so far'
+    monkeypatch.setattr(OpenaiHandler, 'asummarize', asummarize)
+
+    async def run() -> None:
+        db = AsyncPersistenceLayer(service=AsyncInMemoryTableService(InMemoryTableService()), batchDelaySeconds=0) # type: ignore
+        context = []
+        for _ in range(30):
+            context.append({"role": "user", "content": os.urandom(300).hex()})
+            context.append({"role": "assistant", "content": os.urandom(300).hex()})
+        message = Message('', '', context)
+        message.owner = 'alice'
+        with pytest.raises(ContextTooLargeError):
+            contextProperties(context)
+
+        await saveTurn(db, OpenaiHandler(message))
+        sessionData = await db.loadSession(message.pk, message.sessionId)
+        assert sessionData is not None
+        stored = sessionData['context']
+        assert isSummaryEntry(stored[0])
+        assert stored[1:] == context[-(len(stored) - 1):]
+        assert summarized == context[:len(context) - len(stored) + 1]
+    asyncio.run(run())
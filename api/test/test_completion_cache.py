@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import asyncio
+import pytest
+from shared_lib.cache import completion
+from shared_lib.cache.completion import CachedCompletion, CompletionCache
+
+Chat = [{"role": "system", "content": "Be brief."}, {"role": "user", "content": "Hello?"}]
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    class NoRedis:
+        async def GetCompletion(self, key: str):
+            raise ConnectionError('no Redis')
+
+        async def SetCompletion(self, *args):
+            raise ConnectionError('no Redis')
+    monkeypatch.setattr(completion, 'RedisClientInst', NoRedis())
+    return CompletionCache(enabled=True)
+
+
+def test_reformatted_chats_share_a_key(cache):
+    resent = [{"role": "System", "content": " Be brief.\r\n"}, {"role": "user", "content": "Hello?\n"}]
+    assert cache.key('gpt-35-turbo', Chat) == cache.key('gpt-35-turbo', resent)
+    assert cache.key('gpt-35-turbo', Chat) != cache.key('gpt-4', Chat)
+    assert CompletionCache(enabled=False).key('gpt-35-turbo', Chat) is None
+
+
+def test_sampling_parameters_are_part_of_the_key(cache):
+    default = cache.key('gpt-35-turbo', Chat)
+    assert cache.key('gpt-35-turbo', Chat, {}) == default
+    assert cache.key('gpt-35-turbo', Chat, {"temperature": None}) == default
+    # Arguments that don't change the answer are left out
+    assert cache.key('gpt-35-turbo', Chat, {"request_timeout": 10}) == default
+    keys = {default}
+    for params in [{"temperature": 0}, {"temperature": 1.5}, {"top_p": 0.1}, {"max_tokens": 16}, {"n": 2}]:
+        keys.add(cache.key('gpt-35-turbo', Chat, params))
+    assert len(keys) == 6
+    assert cache.key('gpt-35-turbo', Chat, {"n": 2, "top_p": 0.1}) == cache.key('gpt-35-turbo', Chat, {"top_p": 0.1, "n": 2})
+
+
+def test_answers_are_kept_in_process_when_redis_fails(cache, monkeypatch):
+    monkeypatch.setattr(completion, 'CompletionCacheMaxChars', 10)
+
+    async def run() -> None:
+        key = cache.key('gpt-35-turbo', Chat)
+        assert await cache.get(key) is None
+        await cache.put(key, CachedCompletion('Hi.', tokens=12, latencyMs=300))
+        cached = await cache.get(key)
+        assert (cached.content, cached.tokens) == ('Hi.', 12)
+        # Longer answers are not cached
+        other = cache.key('gpt-35-turbo', Chat, {"temperature": 0})
+        await cache.put(other, CachedCompletion('A much longer answer.'))
+        assert await cache.get(other) is None
+    asyncio.run(run())
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import asyncio
+import base64
+import uuid
+import pytest
+from benchmarks.fakes import AsyncInMemoryTableService, InMemoryTableService
+from shared_lib.db import AsyncPersistenceLayer, SessionIndexTableName, TableName, rebaseMessage, sessionListQuery
+from shared_lib.handler import Message
+
+
+def test_session_list_query_starts_after_the_continuation_token():
+    query = sessionListQuery('alice', '', 10)
+    assert query['parameters'] == {"owner": 'alice', "after": ''}
+    assert query['results_per_page'] == 11
+    assert 'RowKey' in query['select']
+
+    token = base64.urlsafe_b64encode(b'row-5').decode()
+    assert sessionListQuery('alice', token, 10)['parameters']['after'] == 'row-5'
+    # Owner and token are passed as parameters, never spliced into the filter
+    assert 'alice' not in query['query_filter']
+
+
+@pytest.mark.parametrize('token', ['not base64!', base64.urlsafe_b64encode(b'row').decode() + 'x'])
+def test_session_list_query_rejects_forged_tokens(token):
+    with pytest.raises(ValueError):
+        sessionListQuery('alice', token, 10)
+
+
+def test_sessions_of_an_owner_are_listed_in_pages():
+    async def run() -> None:
+        db = AsyncPersistenceLayer(service=AsyncInMemoryTableService(InMemoryTableService()), batchDelaySeconds=0) # type: ignore
+        saved = []
+        for i in range(5):
+            message = Message('', '', [{"role": "user", "content": f"chat {i}"}])
+            message.owner = 'alice'
+            await db.saveSession(message)
+            saved.append(message.sessionId)
+        other = Message('', '', [{"role": "user", "content": "not hers"}])
+        other.owner = 'bob'
+        await db.saveSession(other)
+
+        listed, token, pages = [], '', 0
+        while True:
+            items, token = await db.listSessions('alice', 2, token)
+            listed += [item['sessionId'] for item in items]
+            pages += 1
+            if token is None:
+                break
+        assert pages == 3
+        assert sorted(listed) == sorted(saved)
+    asyncio.run(run())
+
+
+def test_rebase_puts_the_new_turns_after_the_stored_ones():
+    message = Message('bucket1', 'bucket1-session', [{"role": "user", "content": "hi"}])
+    message.restoreStoreState({"storedTurns": 1, "tokenCounts": [3], "etag": 'old'})
+    message.context.append({"role": "assistant", "content": "mine"})
+    newCount = message.contextTokenCounts()[1]
+
+    stored = [{"role": "user", "content": "hi"}, {"role": "assistant", "content": "theirs"}]
+    rebaseMessage(message, {
+        "context": stored,
+        "pk": 'bucket2',
+        "storedTurns": 2,
+        "tokenCounts": [3, 4],
+        "etag": 'new',
+    })
+    assert message.context == stored + [{"role": "assistant", "content": "mine"}]
+    assert message.pk == 'bucket2'
+    assert message._etag == 'new'
+    assert message._storedTurns == 2
+    assert message.contextTokenCounts() == [3, 4, newCount]
+    assert message.tokenTotal == 7 + newCount
+
+
+def test_unknown_session_ids_cost_point_reads_only():
+    async def run() -> None:
+        tables = InMemoryTableService()
+        service = AsyncInMemoryTableService(tables)
+        db = AsyncPersistenceLayer(service=service, batchDelaySeconds=0) # type: ignore
+        message = Message('', '', [{"role": "user", "content": "hi"}])
+        await db.saveSession(message)
+        legacyId = str(uuid.uuid4())
+        tables.get_table_client(TableName).upsert_entity({"PartitionKey": '20230801', "RowKey": legacyId, "context": '[]', "sessionId": legacyId})
+
+        assert (await db.checkIfSessionExist(message.sessionId))['sessionId'] == message.sessionId
+        assert (await db.checkIfSessionExist(legacyId, '20230801'))['sessionId'] == legacyId
+
+        calls = service.calls
+        for sessionId in [str(uuid.uuid4()), legacyId, f'{Message.parsePartitionKey(message.sessionId)}_{uuid.uuid4()}']:
+            assert await db.checkIfSessionExist(sessionId) is None
+        # The index and the hash bucket of plain ids, the prefix partition and the
+        # hash bucket of the other
+        assert service.calls - calls == 6
+        assert list(tables.get_table_client(SessionIndexTableName).list_entities()) == []
+    asyncio.run(run())
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import asyncio
+import pytest
+from shared_lib.cache import redis
+from shared_lib.cache.redis import CacheManager, QuoteState
+
+fakeredis = pytest.importorskip('fakeredis')
+
+
+def manager(leaseSize: int, client=None) -> CacheManager:
+    return CacheManager(client or fakeredis.aioredis.FakeRedis(decode_responses=True), leaseSize=leaseSize)
+
+
+async def remaining(cache: CacheManager, userId: str) -> int:
+    return int(await cache.client.get(f'users.quote.{userId}'))
+
+
+def test_a_burst_claims_one_lease():
+    async def run() -> None:
+        cache = manager(leaseSize=10)
+        await cache.SetUserQuote('alice', 25)
+        states = await asyncio.gather(*[cache.CheckUserQuote('alice') for _ in range(10)])
+        assert states == [QuoteState.OK] * 10
+        assert await remaining(cache, 'alice') == 15
+        await cache.ReleaseQuotaLeases()
+    asyncio.run(run())
+
+
+def test_leases_stop_at_the_quota_and_give_back_unspent_units():
+    async def run() -> None:
+        cache = manager(leaseSize=10)
+        other = manager(leaseSize=10, client=cache.client)
+        await cache.SetUserQuote('alice', 12)
+        states = [await cache.CheckUserQuote('alice') for _ in range(3)]
+        assert states == [QuoteState.OK] * 3
+        # The other worker gets what the first lease left in Redis
+        states = [await other.CheckUserQuote('alice') for _ in range(3)]
+        assert states == [QuoteState.OK, QuoteState.OK, QuoteState.EXCEEDED]
+        assert await remaining(cache, 'alice') == 0
+        await cache.ReleaseQuotaLeases()
+        assert await remaining(cache, 'alice') == 7
+        assert await cache.CheckUserQuote('bob') == QuoteState.NOTEXIST
+    asyncio.run(run())
+
+
+def test_expired_leases_are_returned(monkeypatch):
+    monkeypatch.setattr(redis, 'QuotaLeaseSeconds', 0.05)
+
+    async def run() -> None:
+        cache = manager(leaseSize=10)
+        await cache.SetUserQuote('alice', 20)
+        assert await cache.CheckUserQuote('alice') == QuoteState.OK
+        assert await remaining(cache, 'alice') == 10
+        await asyncio.sleep(0.2)
+        assert await remaining(cache, 'alice') == 19
+        assert cache._leases == {}
+    asyncio.run(run())
+
+
+def test_without_leases_every_request_spends_in_redis():
+    async def run() -> None:
+        cache = manager(leaseSize=1)
+        await cache.SetUserQuote('alice', 2)
+        states = [await cache.CheckUserQuote('alice') for _ in range(3)]
+        assert states == [QuoteState.OK, QuoteState.OK, QuoteState.EXCEEDED]
+        assert await cache.ClaimUserQuote('alice', 5) == 0
+    asyncio.run(run())
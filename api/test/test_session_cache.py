@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import asyncio
+import pytest
+from benchmarks.fakes import AsyncInMemoryTableService, InMemoryTableService
+from shared_lib.cache import session
+from shared_lib.cache.redis import CacheManager
+from shared_lib.cache.session import SessionCache
+from shared_lib.db import AsyncPersistenceLayer
+from shared_lib.handler import Message
+
+fakeredis = pytest.importorskip('fakeredis')
+
+
+@pytest.fixture(autouse=True)
+def redisClient(monkeypatch):
+    monkeypatch.setattr(session, 'RedisClientInst', CacheManager(fakeredis.aioredis.FakeRedis(decode_responses=True)))
+    monkeypatch.setattr(session, 'SessionWriteBehindSeconds', 0)
+
+
+def test_flushes_keep_the_owner_index_stamp(monkeypatch):
+    ownerWrites = []
+    saveSessionOwner = AsyncPersistenceLayer._saveSessionOwner
+
+    async def countOwnerWrites(self, message: Message) -> None:
+        ownerWrites.append(message.listed)
+        await saveSessionOwner(self, message)
+    monkeypatch.setattr(AsyncPersistenceLayer, '_saveSessionOwner', countOwnerWrites)
+
+    async def run() -> None:
+        db = AsyncPersistenceLayer(service=AsyncInMemoryTableService(InMemoryTableService()), batchDelaySeconds=0) # type: ignore
+        cache = SessionCache(db)
+        message = Message('', '', [{"role": "user", "content": "Hello?"}])
+        message.owner = 'alice'
+        await cache.saveSession(message)
+        assert len(ownerWrites) == 1
+
+        # The next turns are saved from the cached session, its stamp was set by the flush
+        for turn in range(3):
+            sessionData = await cache.loadSession(message.pk, message.sessionId)
+            assert sessionData is not None
+            turnMessage = Message(message.pk, message.sessionId, sessionData['context'])
+            turnMessage.restoreStoreState(sessionData)
+            turnMessage.context.append({"role": "assistant", "content": f"Turn {turn}."})
+            await cache.saveSession(turnMessage)
+        assert ownerWrites == [ownerWrites[0]]
+        assert (await db.loadSession(message.pk, message.sessionId) or {})['listed'] == ownerWrites[0]
+    asyncio.run(run())
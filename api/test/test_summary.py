@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import pytest
+from shared_lib import summary
+from shared_lib.summary import SummaryPrefix, foldBatches, isSummaryEntry, splitContext, summaryEntry
+
+
+@pytest.fixture(autouse=True)
+def budgets(monkeypatch):
+    monkeypatch.setattr(summary, 'getTokenBudget', lambda model=None: 1000)
+    monkeypatch.setattr(summary, 'getCompactionThreshold', lambda model=None: 750)
+    monkeypatch.setattr(summary, 'CompactionKeepTurns', 2)
+
+
+def turns(count: int) -> list[dict]:
+    context = []
+    for i in range(count):
+        context.append({"role": "user", "content": f"question {i}"})
+        context.append({"role": "assistant", "content": f"answer {i}"})
+    return context
+
+
+def test_split_keeps_the_last_turns_after_the_prompt_and_summary():
+    context = [{"role": "system", "content": "You are terse."}, summaryEntry('earlier')] + turns(4)
+    found, pinned, start, keepFrom = splitContext(context, [10] * len(context))
+    assert (found, pinned, start) == ('earlier', 1, 2)
+    # Two turns of four entries are kept
+    assert keepFrom == len(context) - 4
+    assert context[keepFrom]['content'] == 'question 2'
+
+
+def test_split_without_summary_starts_after_the_prompts():
+    context = [{"role": "system", "content": "a"}, {"role": "system", "content": "b"}] + turns(3)
+    found, pinned, start, keepFrom = splitContext(context, [10] * len(context))
+    assert (found, pinned, start, keepFrom) == ('', 2, 2, 4)
+
+
+def test_legacy_summary_without_prefix_is_kept_like_a_prompt():
+    context = [{"role": "system", "content": "Old summary of the chat"}] + turns(3)
+    found, pinned, start, _ = splitContext(context, [10] * len(context))
+    assert (found, pinned, start) == ('', 1, 1)
+    assert not isSummaryEntry(context[0])
+    assert isSummaryEntry(summaryEntry('x'))
+    assert summaryEntry('x')['content'] == SummaryPrefix + 'x'
+
+
+def test_split_keeps_fewer_turns_over_half_the_threshold_but_always_the_last():
+    context = turns(3)
+    counts = [10] * len(context)
+    counts[-2:] = [300, 300]
+    assert splitContext(context, counts)[3] == len(context) - 2
+    counts[-2:] = [500, 500]
+    assert splitContext(context, counts)[3] == len(context) - 2
+
+
+def test_fold_batches_fit_the_budget_and_keep_order():
+    entries = turns(10)
+    # 1000 - 3 * 100 tokens per batch
+    batches = foldBatches(entries, [150] * len(entries))
+    assert [len(batch) for batch in batches] == [4] * 5
+    assert [entry for batch in batches for entry in batch] == entries
+    # An entry over the limit gets a batch of its own
+    batches = foldBatches(entries[:3], [100, 2000, 100])
+    assert [len(batch) for batch in batches] == [1, 1, 1]
+    assert foldBatches([], []) == []
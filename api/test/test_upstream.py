@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Upstream pool against local fake endpoints.
+# Run from the api folder: python -m pytest -q test
+
+import asyncio
+import time
+import openai
+import pytest
+from benchmarks.fakes import FakeOpenaiServer
+from shared_lib import clients, upstream
+from shared_lib.upstream import UpstreamEndpoint, UpstreamPool
+
+
+@pytest.fixture(autouse=True)
+def fastPool(monkeypatch):
+    monkeypatch.setattr(upstream, 'UpstreamBackoffSeconds', 0.001)
+    monkeypatch.setattr(upstream, 'UpstreamMaxBackoffSeconds', 0.001)
+    # Of two available endpoints the first listed is picked, so tests choose
+    # where a call goes
+    monkeypatch.setattr(upstream.random, 'choices', lambda candidates, weights, k: [candidates[0]] * k)
+
+
+async def complete(endpoint: UpstreamEndpoint):
+    clients.useOpenaiSession()
+    return await openai.ChatCompletion.acreate(messages=[{"role": "user", "content": "hello"}], **endpoint.requestArgs())
+
+
+# Run scenario with a pool of fake endpoints a and b, made with the given settings.
+def runWithServers(scenario, a: dict, b: dict | None = None) -> None:
+    async def run() -> None:
+        servers = [FakeOpenaiServer(**a), FakeOpenaiServer(**(b or {"latencySeconds": 0}))]
+        try:
+            endpoints = []
+            for name, server in zip('ab', servers):
+                url = await server.start()
+                endpoints.append(UpstreamEndpoint(name, url, 'fake-key', 'gpt-35-turbo', 'azure', '2023-05-15'))
+            await scenario(UpstreamPool(endpoints), *servers)
+        finally:
+            for server in servers:
+                await server.stop()
+            await clients.closeAsyncClients()
+    asyncio.run(run())
+
+
+def test_breaker_opens_after_failures_and_lets_one_probe_through(monkeypatch):
+    monkeypatch.setattr(upstream, 'UpstreamMaxAttempts', 1)
+    monkeypatch.setattr(upstream, 'UpstreamBreakerFailures', 3)
+    monkeypatch.setattr(upstream, 'UpstreamBreakerSeconds', 0.3)
+
+    async def scenario(pool: UpstreamPool, serverA: FakeOpenaiServer, serverB: FakeOpenaiServer) -> None:
+        a = pool.endpoints[0]
+        for _ in range(3):
+            with pytest.raises(openai.error.ServiceUnavailableError):
+                await pool.call(complete)
+        assert a.failures == 3
+        assert pool.stats()[0]['breakerOpen']
+
+        # While the breaker is open every call goes to b
+        for _ in range(3):
+            await pool.call(complete)
+        assert serverA.calls == 3
+        assert serverB.calls == 3
+
+        # Once it may close, a single call probes a, the others keep going to b
+        await asyncio.sleep(0.3)
+        serverA.failureRate = 0
+        serverA.latencySeconds = 0.2
+        await asyncio.gather(*[pool.call(complete) for _ in range(5)])
+        assert serverA.calls == 4
+        assert serverB.calls == 7
+        assert a.failures == 0
+        assert not a.probing
+        assert a.isAvailable(time.monotonic())
+
+    runWithServers(scenario, {"latencySeconds": 0, "failureRate": 1, "failStatus": 503})
+
+
+def test_retry_after_of_a_429_keeps_the_endpoint_out(monkeypatch):
+    monkeypatch.setattr(upstream, 'UpstreamMaxAttempts', 2)
+
+    async def scenario(pool: UpstreamPool, serverA: FakeOpenaiServer, serverB: FakeOpenaiServer) -> None:
+        a = pool.endpoints[0]
+        start = time.monotonic()
+        # The throttled call is retried on b
+        await pool.call(complete)
+        assert (serverA.calls, serverB.calls) == (1, 1)
+        assert a.failures < upstream.UpstreamBreakerFailures
+        assert a.openUntil >= start + 30
+        assert not a.isAvailable(time.monotonic())
+
+        # a stays out for the seconds it asked for
+        for _ in range(3):
+            await pool.call(complete)
+        assert (serverA.calls, serverB.calls) == (1, 4)
+
+    runWithServers(scenario, {"latencySeconds": 0, "failureRate": 1, "failStatus": 429, "retryAfter": 30})
+
+
+def test_request_errors_are_not_retried(monkeypatch):
+    monkeypatch.setattr(upstream, 'UpstreamMaxAttempts', 3)
+
+    async def scenario(pool: UpstreamPool, serverA: FakeOpenaiServer, serverB: FakeOpenaiServer) -> None:
+        a = pool.endpoints[0]
+        with pytest.raises(openai.error.InvalidRequestError):
+            await pool.call(complete)
+        assert (serverA.calls, serverB.calls) == (1, 0)
+        # A rejected request says nothing about the endpoint
+        assert a.failures == 0
+        assert a.errorRate == 0
+        assert a.inflight == 0
+        assert a.isAvailable(time.monotonic())
+
+    runWithServers(scenario, {"latencySeconds": 0, "failureRate": 1, "failStatus": 400})
+
+
+def test_cancelled_calls_release_the_endpoint_and_its_probe(monkeypatch):
+    monkeypatch.setattr(upstream, 'UpstreamBreakerFailures', 3)
+
+    async def scenario(pool: UpstreamPool, serverA: FakeOpenaiServer, serverB: FakeOpenaiServer) -> None:
+        a = pool.endpoints[0]
+        # The breaker of a may close, the next call is its probe
+        a.failures = 3
+        task = asyncio.ensure_future(pool.call(complete))
+        await asyncio.sleep(0.1)
+        assert (a.inflight, a.probing) == (1, True)
+
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        assert (a.inflight, a.probing) == (0, False)
+        assert a.failures == 3
+        # The next call probes a again
+        serverA.latencySeconds = 0
+        await pool.call(complete)
+        assert a.failures == 0
+        assert serverB.calls == 0
+
+    runWithServers(scenario, {"latencySeconds": 1})
+
+
+def test_retry_after_is_read_from_either_header_case():
+    class Err(Exception):
+        def __init__(self, headers) -> None:
+            self.headers = headers
+
+    assert upstream.retryAfterOf(Err({'retry-after': '7'})) == 7
+    assert upstream.retryAfterOf(Err({'Retry-After': '1.5'})) == 1.5
+    assert upstream.retryAfterOf(Err({'Retry-After': 'soon'})) is None
+    assert upstream.retryAfterOf(Exception()) is None
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import asyncio
+import pytest
+from benchmarks.fakes import AsyncInMemoryTableService, InMemoryTableService
+from shared_lib import passwords, user
+from shared_lib.db import AsyncPersistenceLayer, UserTableName
+from shared_lib.types.errors import AuthError
+from shared_lib.types.models import UserInfo
+
+
+@pytest.fixture
+def db(monkeypatch):
+    monkeypatch.setattr(passwords, 'BcryptRounds', 4)
+    layer = AsyncPersistenceLayer(service=AsyncInMemoryTableService(InMemoryTableService()), batchDelaySeconds=0) # type: ignore
+    monkeypatch.setattr(user, 'db', layer)
+    return layer
+
+
+def test_users_saved_without_password_cannot_log_in(db):
+    async def run() -> None:
+        # As the throttle creates a user it has no row of
+        await db.saveUser(UserInfo(email='victim@example.com'))
+        assert not await db.checkUserPassword(UserInfo('victim@example.com', ''))
+        assert not await db.checkUserPassword(UserInfo('victim@example.com', 'guess'))
+        with pytest.raises(AuthError):
+            await user.UserLogin('victim@example.com', '')
+        with pytest.raises(AuthError):
+            await user.UserLogin('victim@example.com', 'guess')
+    asyncio.run(run())
+
+
+def test_empty_passwords_are_refused(db):
+    async def run() -> None:
+        with pytest.raises(AuthError):
+            await user.UserCreate('alice@example.com', '')
+        await db.saveUser(UserInfo('alice@example.com', 'secret'))
+        assert await db.checkUserPassword(UserInfo('alice@example.com', 'secret'))
+        assert not await db.checkUserPassword(UserInfo('alice@example.com', ''))
+    asyncio.run(run())
+
+
+def test_hashes_of_a_lower_cost_are_upgraded_on_login(db, monkeypatch):
+    async def storedHash() -> bytes:
+        tableClient = db._getTableClient(UserTableName)
+        entity = await tableClient.get_entity(partition_key=UserInfo.generatePartitionKey('alice@example.com'), row_key='alice@example.com')
+        return entity['HashedPassword']
+
+    async def run() -> None:
+        await db.saveUser(UserInfo('alice@example.com', 'secret'))
+        assert (await storedHash()).startswith(b'$2b$04$')
+        monkeypatch.setattr(passwords, 'BcryptRounds', 5)
+        # A failed login leaves the hash alone
+        assert not await db.checkUserPassword(UserInfo('alice@example.com', 'guess'))
+        assert (await storedHash()).startswith(b'$2b$04$')
+        assert await db.checkUserPassword(UserInfo('alice@example.com', 'secret'))
+        upgraded = await storedHash()
+        assert upgraded.startswith(b'$2b$05$') and not passwords.needsRehash(upgraded)
+        assert await db.checkUserPassword(UserInfo('alice@example.com', 'secret'))
+        assert await storedHash() == upgraded
+    asyncio.run(run())
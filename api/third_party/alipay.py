@@ -2,12 +2,16 @@
 # -*- coding: utf-8 -*-
 
 import logging
-from alipay.aop.api.AlipayClientConfig import AlipayClientConfig
-from alipay.aop.api.DefaultAlipayClient import DefaultAlipayClient
-from alipay.aop.api.constant.ParamConstants import *
-from alipay.aop.api.domain.AlipayTradeCreateModel import AlipayTradeCreateModel
-from alipay.aop.api.request.AlipayTradeCreateRequest import AlipayTradeCreateRequest
-from alipay.aop.api.response.AlipayTradeCreateResponse import AlipayTradeCreateResponse
 
-config = AlipayClientConfig(sandbox_debug=True)
-client = DefaultAlipayClient(config)
+_client = None
+
+# The Alipay SDK is imported and its client built on first use, cold starts
+# of the functions that take no payments skip both.
+def getAlipayClient():
+    global _client
+    if _client is None:
+        from alipay.aop.api.AlipayClientConfig import AlipayClientConfig
+        from alipay.aop.api.DefaultAlipayClient import DefaultAlipayClient
+        config = AlipayClientConfig(sandbox_debug=True)
+        _client = DefaultAlipayClient(config)
+    return _client
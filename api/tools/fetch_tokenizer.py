@@ -0,0 +1,28 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Download the BPE file of the tokenizer into the tiktoken_cache folder of the
+# function app, so it is deployed with the app and workers load it from disk
+# instead of downloading it on their first chat, see shared_lib.tokens.
+#
+# Run from the api folder before publishing the app:
+#   python -m tools.fetch_tokenizer
+
+import os
+import sys
+from shared_lib.tokens import TokenizerCacheDir, TokenizerCacheFile
+
+
+def main() -> None:
+    os.makedirs(TokenizerCacheDir, exist_ok=True)
+    os.environ['TIKTOKEN_CACHE_DIR'] = TokenizerCacheDir
+    import tiktoken
+    encoding = tiktoken.get_encoding('cl100k_base')
+    path = os.path.join(TokenizerCacheDir, TokenizerCacheFile)
+    if not os.path.exists(path):
+        sys.exit(f'tiktoken did not cache the BPE file as {path}, update TokenizerCacheFile')
+    print(f'{encoding.name}: {path} ({os.path.getsize(path)} bytes)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Move sessions out of date partitions, e.g. "20230801", into their hash
+# bucket, see SESSION_PARTITION_SCHEME. Sessions keep their ids and are read
+# from either partition while the tool runs, so it can run next to the
+# function app. A session that is saved while it is being moved stays where
+# it is and is counted as changed, run the tool again to move it.
+#
+# Run from the api folder with the storage settings of the function app, e.g.:
+#   python -m tools.migrate_sessions --concurrency 32 --dry-run
+#   python -m tools.migrate_sessions --partitions 20230801,20230802
+
+import argparse
+import asyncio
+import logging
+import time
+from azure.core import MatchConditions
+from azure.core.exceptions import HttpResponseError, ResourceNotFoundError
+from azure.data.tables import UpdateMode
+from shared_lib import clients
+from shared_lib.batching import splitTransactions
+from shared_lib.db import SessionIndexTableName, TableName, TurnRowKeySeparator, isConditionNotSatisfied, sessionIndexEntity, sessionRangeQuery
+from shared_lib.handler import Message
+
+Moved = 'moved'
+Changed = 'changed'
+Failed = 'failed'
+
+
+# Partition and id of every session in a date partition, from its session row.
+async def legacySessions(tableClient, partitions: list[str]):
+    if partitions:
+        queries = [tableClient.query_entities(query_filter='PartitionKey eq @pk', parameters={"pk": pk}, select=['PartitionKey', 'RowKey'])
+            for pk in partitions]
+    else:
+        queries = [tableClient.list_entities(select=['PartitionKey', 'RowKey'])]
+    for query in queries:
+        async for entity in query:
+            pk, rowKey = entity['PartitionKey'], entity['RowKey']
+            if Message.isDatePartitionKey(pk) and TurnRowKeySeparator not in rowKey:
+                yield pk, rowKey
+
+
+async def submitAll(tableClient, operations: list) -> None:
+    for transaction in splitTransactions(operations):
+        await tableClient.submit_transaction(transaction)
+
+
+# Copy the rows of a session to its bucket, then delete them from the date
+# partition. The session row is copied last and deleted first, on condition
+# that it did not change since it was read; if it did, the copy is removed.
+async def moveSession(tableClient, indexClient, pk: str, sessionId: str, dryRun: bool) -> tuple[str, int]:
+    rows = [entity async for entity in tableClient.query_entities(**sessionRangeQuery(pk, sessionId))]
+    header = next((row for row in rows if row['RowKey'] == sessionId), None)
+    if header is None:
+        return Changed, 0
+    if dryRun:
+        return Moved, len(rows)
+    newPk = Message.hashPartitionKey(sessionId)
+    turns = [row for row in rows if row is not header]
+
+    await submitAll(tableClient, [('upsert', {**row, "PartitionKey": newPk}, {'mode': UpdateMode.REPLACE}) for row in turns + [header]])
+    try:
+        await tableClient.delete_entity(partition_key=pk, row_key=sessionId,
+            etag=header.metadata.get('etag'), match_condition=MatchConditions.IfNotModified)
+    except HttpResponseError as err:
+        if not isConditionNotSatisfied(err):
+            raise
+        await submitAll(tableClient, [('delete', {"PartitionKey": newPk, "RowKey": row['RowKey']}) for row in [header] + turns])
+        return Changed, 0
+    await submitAll(tableClient, [('delete', {"PartitionKey": pk, "RowKey": row['RowKey']}) for row in turns])
+
+    # Legacy ids without a partition prefix are resolved through the index
+    if Message.parsePartitionKey(sessionId) is None:
+        try:
+            await indexClient.update_entity(sessionIndexEntity(sessionId, newPk), mode=UpdateMode.MERGE)
+        except ResourceNotFoundError:
+            pass
+    return Moved, len(rows)
+
+
+async def main(args: argparse.Namespace) -> None:
+    service = clients.getAsyncTableService()
+    tableClient = service.get_table_client(table_name=TableName)
+    indexClient = service.get_table_client(table_name=SessionIndexTableName)
+    queue: asyncio.Queue = asyncio.Queue(maxsize=args.concurrency * 4)
+    counts = {Moved: 0, Changed: 0, Failed: 0}
+    movedRows = 0
+    start = time.perf_counter()
+
+    async def worker() -> None:
+        nonlocal movedRows
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            pk, sessionId = item
+            try:
+                outcome, rows = await moveSession(tableClient, indexClient, pk, sessionId, args.dry_run)
+            except Exception as ex:
+                logging.warning(f'Move of session {sessionId} failed: {ex}')
+                outcome, rows = Failed, 0
+            counts[outcome] += 1
+            movedRows += rows
+            done = sum(counts.values())
+            if done % 1000 == 0:
+                print(f'{done} sessions, {done / (time.perf_counter() - start):.0f}/s: {counts}')
+
+    workers = [asyncio.create_task(worker()) for _ in range(args.concurrency)]
+    try:
+        sent = 0
+        async for item in legacySessions(tableClient, args.partitions):
+            if args.limit and sent >= args.limit:
+                break
+            await queue.put(item)
+            sent += 1
+        for _ in workers:
+            await queue.put(None)
+        await asyncio.gather(*workers)
+    finally:
+        for task in workers:
+            task.cancel()
+        await clients.closeAsyncClients()
+
+    elapsed = time.perf_counter() - start
+    verb = 'would move' if args.dry_run else 'moved'
+    print(f'{verb} {counts[Moved]} sessions ({movedRows} rows), {counts[Changed]} changed while moving, '
+        f'{counts[Failed]} failed, in {elapsed:.1f}s')
+
+
+def partitionList(value: str) -> list[str]:
+    return [item for item in value.split(',') if item]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Move date partitioned sessions into their hash bucket.')
+    parser.add_argument('--concurrency', type=int, default=16, help='sessions moved at once')
+    parser.add_argument('--partitions', type=partitionList, default=[], help='only these date partitions, comma separated, default all')
+    parser.add_argument('--limit', type=int, default=0, help='move at most this many sessions, 0 for all')
+    parser.add_argument('--dry-run', action='store_true', help='count the sessions to move without moving them')
+    asyncio.run(main(parser.parse_args()))
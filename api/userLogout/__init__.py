@@ -0,0 +1,23 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+
+import azure.functions as func
+from shared_lib.handler import CreateCORSResponseHeaders
+from shared_lib.types.errors import AuthError
+
+from shared_lib.user import UserLogout
+
+
+async def main(req: func.HttpRequest) -> func.HttpResponse:
+    logging.info('User logout api triggered.')
+
+    token = req.headers.get('Authorization', '').split(' ')[-1]
+    allDevices = req.params.get('all', '').lower() in ('1', 'true')
+
+    try:
+        await UserLogout(token, allDevices)
+        return func.HttpResponse("Logged out", status_code=200, headers=CreateCORSResponseHeaders())
+    except AuthError as ex:
+        return func.HttpResponse(f"Auth failed: {ex}", status_code=401, headers=CreateCORSResponseHeaders())